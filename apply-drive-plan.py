@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+import os
+
+from googleapiclient.discovery import build
+
+from migrate_google import (
+    LOGGER, authenticate, configure_logging, configure_requests, read_plan,
+    Checkpoint, PlanExecutor,
+)
+
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Apply a plan from plan-drive-migration.py or '
+                                        'summarize-drive-metadata.py')
+    parser.add_argument('credentials_path', help='Path to credentials json file')
+    parser.add_argument('plan_path', help='Path to jsonl plan file')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='Number of operations to apply in parallel')
+    parser.add_argument('--max-rate', type=float,
+                        help='Maximum number of API requests per second '
+                             '(default: unlimited)')
+    parser.add_argument('--metrics',
+                        help='Path to write metrics of API requests to as json')
+    parser.add_argument('--progress-interval', type=float,
+                        help='Log request progress every this many seconds')
+    parser.add_argument('--shard', type=int, default=0,
+                        help='Index of the shard of the plan to apply (from 0)')
+    parser.add_argument('--num-shards', type=int, default=1,
+                        help='Number of shards the plan is split into, e.g. one per machine')
+    parser.add_argument('--checkpoint',
+                        help='Path to checkpoint journal for resuming '
+                             '(default: <plan path>-<shard>.checkpoint)')
+    args = parser.parse_args()
+    if not 0 <= args.shard < args.num_shards:
+        parser.error('shard must be between 0 and {}'.format(args.num_shards - 1))
+
+    credentials_name = os.path.splitext(os.path.basename(args.credentials_path))[0]
+    configure_logging('apply-drive-plan-{}.log'.format(credentials_name))
+    configure_requests(max_rate=args.max_rate, metrics_path=args.metrics,
+                       progress_interval=args.progress_interval)
+
+    creds = authenticate(args.credentials_path, token_path=credentials_name + '.pickle')
+
+    checkpoint = Checkpoint(
+        args.checkpoint or '{}-{}.checkpoint'.format(args.plan_path, args.shard))
+    executor = PlanExecutor(
+        lambda: build('drive', 'v3', credentials=creds), num_workers=args.workers)
+    num_done = 0
+    num_failed = 0
+    for (operation, error) in executor.apply(
+            read_plan(args.plan_path, shard=args.shard, num_shards=args.num_shards),
+            checkpoint=checkpoint):
+        if error is None:
+            num_done += 1
+        else:
+            num_failed += 1
+
+    LOGGER.info('Applied {} operations; {} failed'.format(num_done, num_failed))
+    if num_failed == 0:
+        checkpoint.end_page(None)
+    else:
+        LOGGER.warning('Run again to retry failed operations')
+    checkpoint.close()
+
+
+if __name__ == '__main__':
+    main()
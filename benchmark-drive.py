@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import os
+import tempfile
+import time
+
+from migrate_google import (
+    LOGGER, EXECUTOR, configure_logging, configure_requests, walk, compare_drive_files,
+    compare_metadata_streaming, load_drive_files, get_summary_analyzers, summarize_drive_files,
+    DuplicateMetadataAnalyzer, open_snapshot_writer, FileMetadataDownloader, SUMMARY_CHECKS,
+)
+from fake_drive import FakeDrive
+
+
+BENCHMARKS = ('walk', 'list', 'load', 'compare', 'compare-streaming', 'summarize')
+SNAPSHOT_FORMATS = ('jsonl', 'jsonl.zst', 'msgpack', 'msgpack.zst')
+
+
+def write_snapshot(metadata_iter, path):
+    with open_snapshot_writer(path) as f:
+        for metadata in metadata_iter:
+            f.write(metadata)
+
+
+def bench_walk(drive, paths, args):
+    service = drive.build()
+    num_items = 0
+    for (root, dir_entries, file_entries) in walk(
+            '/', service.files(), fields=('id', 'name', 'mimeType', 'md5Checksum'),
+            files_factory=(lambda: drive.build().files()) if args.workers else None,
+            num_workers=args.workers or 1):
+        num_items += len(dir_entries) + len(file_entries)
+    return num_items
+
+
+def bench_list(drive, paths, args):
+    service = drive.build()
+    downloader = FileMetadataDownloader(
+        service.files(), service.permissions(),
+        service=service if args.batch else None,
+        inline_permissions=args.inline_permissions)
+    num_items = 0
+    for metadata in downloader.list():
+        num_items += 1
+    return num_items
+
+
+def bench_load(drive, paths, args):
+    drive_files = load_drive_files(paths['old'])
+    return len(drive_files.file_ids)
+
+
+def bench_compare(drive, paths, args):
+    # As compare-drive-metadata.py does in memory
+    num_items = 0
+    for row in compare_drive_files(load_drive_files(paths['old']), load_drive_files(paths['new'])):
+        num_items += 1
+    return num_items
+
+
+def bench_compare_streaming(drive, paths, args):
+    num_items = 0
+    for row in compare_metadata_streaming(paths['old'], paths['new'], tmp_dir=paths['tmp_dir']):
+        num_items += 1
+    return num_items
+
+
+def bench_summarize(drive, paths, args):
+    # The checks of summarize-drive-metadata.py, without the API calls
+    drive_files = load_drive_files(paths['old'])
+    analyzers = get_summary_analyzers(
+        SUMMARY_CHECKS, drive_files, root_id=drive.root_id, email=drive.email,
+        num_top_files=args.num_top_files)
+    summarize_drive_files(drive_files, analyzers)
+    return sum(len(a.duplicates) for a in analyzers if isinstance(a, DuplicateMetadataAnalyzer))
+
+
+def run_benchmarks(num_files, args):
+    print('Generating drive with {} files'.format(num_files), flush=True)
+    drive = FakeDrive.generate(
+        num_files=num_files, depth=args.depth, fan_out=args.fan_out,
+        folder_ratio=args.folder_ratio, multi_parent_ratio=args.multi_parent_ratio,
+        duplicate_ratio=args.duplicate_ratio,
+        latency=args.latency, jitter=args.jitter, quota_error_rate=args.quota_error_rate,
+        seed=args.seed)
+
+    results = []
+    with tempfile.TemporaryDirectory(dir=args.tmp_dir) as tmp_path:
+        paths = dict(
+            old=os.path.join(tmp_path, 'old.' + args.snapshot_format),
+            new=os.path.join(tmp_path, 'new.' + args.snapshot_format),
+            tmp_dir=tmp_path)
+        if set(args.benchmarks) - {'walk', 'list'}:
+            # The new snapshot is missing one file in a hundred
+            write_snapshot(drive.iter_metadata(), paths['old'])
+            write_snapshot(
+                (metadata for (i, metadata) in enumerate(drive.iter_metadata()) if i % 100 != 1),
+                paths['new'])
+
+        for name in args.benchmarks:
+            num_requests = drive.num_requests
+            start = time.perf_counter()
+            num_items = globals()['bench_' + name.replace('-', '_')](drive, paths, args)
+            elapsed = time.perf_counter() - start
+            result = dict(
+                benchmark=name, num_files=num_files, seconds=elapsed, num_items=num_items,
+                num_requests=drive.num_requests - num_requests)
+            print('{:<18} {:>9} files {:>10.3f}s {:>12.0f} files/s {:>9} requests'.format(
+                name, num_files, elapsed, num_files / elapsed if elapsed > 0 else 0,
+                result['num_requests']), flush=True)
+            results.append(result)
+
+    return results
+
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(
+        description='Time the drive scripts against a synthetic drive served in-process')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000],
+                        help='Numbers of files in the drives to benchmark')
+    parser.add_argument('--benchmarks', nargs='+', choices=BENCHMARKS, default=list(BENCHMARKS),
+                        help='Benchmarks to run')
+    parser.add_argument('--depth', type=int, default=4, help='Depth of the folder tree')
+    parser.add_argument('--fan-out', type=int, default=8,
+                        help='Number of subfolders of each folder')
+    parser.add_argument('--folder-ratio', type=float, default=0.1,
+                        help='Maximum fraction of files that are folders')
+    parser.add_argument('--multi-parent-ratio', type=float, default=0.01,
+                        help='Fraction of files with a second parent')
+    parser.add_argument('--duplicate-ratio', type=float, default=0.01,
+                        help='Fraction of files duplicating another file')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds each request (or batch) takes')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='Maximum random seconds added to latency')
+    parser.add_argument('--quota-error-rate', type=float, default=0.0,
+                        help='Fraction of requests failing with rateLimitExceeded')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the synthetic drive')
+    parser.add_argument('--max-rate', type=float,
+                        help='Maximum number of API requests per second '
+                             '(default: unlimited)')
+    parser.add_argument('--metrics',
+                        help='Path to write metrics of API requests to as json')
+    parser.add_argument('--progress-interval', type=float,
+                        help='Log request progress every this many seconds')
+    parser.add_argument('--retry-delay', type=float, default=0.01,
+                        help='Base delay in seconds before retrying a failed request')
+    parser.add_argument('--workers', type=int,
+                        help='Number of folder listings to run concurrently in walk')
+    parser.add_argument('--batch', action='store_true',
+                        help='Look up permissions in batch requests when listing')
+    parser.add_argument('--inline-permissions', action='store_true',
+                        help='Request permissions in the file listing')
+    parser.add_argument('--num-top-files', type=int, default=100,
+                        help='Number of top (largest) files to find when summarizing')
+    parser.add_argument('--snapshot-format', choices=SNAPSHOT_FORMATS, default='jsonl',
+                        help='Format of the snapshots loaded and compared')
+    parser.add_argument('--tmp-dir', help='Directory for snapshots and temporary files')
+    parser.add_argument('--output', help='Path to write results to as json')
+    parser.add_argument('--verbose', action='store_true',
+                        help='Log as the scripts would, rather than only errors')
+    args = parser.parse_args()
+
+    configure_logging('benchmark-drive.log')
+    if not args.verbose:
+        LOGGER.setLevel(logging.ERROR)
+    EXECUTOR.base_delay = args.retry_delay
+    configure_requests(rate=args.max_rate, max_rate=args.max_rate, metrics_path=args.metrics,
+                       progress_interval=args.progress_interval)
+
+    results = []
+    for num_files in args.sizes:
+        results.extend(run_benchmarks(num_files, args))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,11 @@
 #!/usr/bin/env python3
 
-import json
+from humanfriendly import format_size
 
-from migrate_google import LOGGER, configure_logging, DriveFiles
+from migrate_google import (
+    LOGGER, configure_logging, compare_drive_files, compare_metadata_streaming, load_drive_files,
+    IndexedDriveFiles,
+)
 
 
 def main():
@@ -10,35 +13,46 @@ def main():
     parser = ArgumentParser(description='Load and compare metadata from drive files')
     parser.add_argument('old_path', help='Path to jsonl metadata for old drive')
     parser.add_argument('new_path', help='Path to jsonl metadata for new drive')
+    parser.add_argument('--old-index', help='Path to SQLite index of old drive metadata, '
+                                            'built if missing or out of date')
+    parser.add_argument('--new-index', help='Path to SQLite index of new drive metadata, '
+                                            'built if missing or out of date')
+    parser.add_argument('--streaming', action='store_true',
+                        help='Compare in bounded memory, holding only the folder tree and '
+                             'spilling the rest to temporary files')
+    parser.add_argument('--tmp-dir', help='Directory for temporary files when streaming')
     args = parser.parse_args()
 
     configure_logging('compare-drive-metadata.log')
 
-    drive_files = dict(old=DriveFiles(), new=DriveFiles())
-    for (version, path) in (('old', args.old_path), ('new', args.new_path)):
+    if args.streaming:
+        LOGGER.info('Looking for files in old drive but not in new')
+        for (name, size, num_old, num_new) in compare_metadata_streaming(
+                args.old_path, args.new_path, tmp_dir=args.tmp_dir):
+            LOGGER.info('{:<8}: {:<20}: {:>3} x old, {:>3} x new'.format(
+                format_size(size), name, num_old, num_new))
+        return
+
+    drive_files = dict()
+    for (version, path, index_path) in (
+            ('old', args.old_path, args.old_index),
+            ('new', args.new_path, args.new_index)):
         LOGGER.info('Loading {} data from {}'.format(version, path))
-        with open(path) as f:
-            for line in f:
-                drive_files[version].add(json.loads(line))
-
-    metadata_map = dict()
-    for version in ('old', 'new'):
-        for df in drive_files[version].list():
-            key = (df.name, df.size, df.md5_checksum)
-            if key not in metadata_map:
-                metadata_map[key] = dict(old=[], new=[])
-            metadata_map[key][version].append(df)
+        drive_files[version] = load_drive_files(path, index_path=index_path)
 
-    LOGGER.info('Looking for files in old drive but not in new')
-    for key in sorted(metadata_map, key=lambda k: k[1], reverse=True):
-        copies_map = metadata_map[key]
-        if len(copies_map['old']) > len(copies_map['new']):
-            example_df = copies_map['old'][0]
+    if all(isinstance(drive_files[version], IndexedDriveFiles) for version in ('old', 'new')):
+        LOGGER.info('Looking for files in old drive but not in new')
+        for (name, size, num_old, num_new) in drive_files['old'].index.missing_from(
+                drive_files['new'].index):
             LOGGER.info('{:<8}: {:<20}: {:>3} x old, {:>3} x new'.format(
-                example_df.human_friendly_size,
-                example_df.name,
-                len(copies_map['old']),
-                len(copies_map['new'])))
+                format_size(size), name, num_old, num_new))
+        return
+
+    LOGGER.info('Looking for files in old drive but not in new')
+    for (name, size, num_old, num_new) in compare_drive_files(
+            drive_files['old'], drive_files['new']):
+        LOGGER.info('{:<8}: {:<20}: {:>3} x old, {:>3} x new'.format(
+            format_size(size), name, num_old, num_new))
 
 
 if __name__ == '__main__':
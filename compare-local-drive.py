@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from googleapiclient.discovery import build
+
+from migrate_google import (
+    LOGGER, authenticate, configure_logging, configure_requests, get_drive_tree_checksums,
+    diff_tree_checksums, LocalHashCache, LocalTreeHasher, PathCache,
+)
+
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Compare the files under a local directory to those '
+                                        'under a drive path by md5sum, printing the relative '
+                                        'paths of files missing from drive, extra in drive '
+                                        'or with different content')
+    parser.add_argument('credentials_path', help='Path to credentials json file')
+    parser.add_argument('local_path', help='Path of local directory to compare')
+    parser.add_argument('drive_path', help='Path of drive directory to compare')
+    parser.add_argument('--max-rate', type=float,
+                        help='Maximum number of API requests per second '
+                             '(default: unlimited)')
+    parser.add_argument('--metrics',
+                        help='Path to write metrics of API requests to as json')
+    parser.add_argument('--progress-interval', type=float,
+                        help='Log request progress every this many seconds')
+    parser.add_argument('--path-cache',
+                        help='Path to file caching path lookups between runs')
+    parser.add_argument('--hash-cache',
+                        help='Path to file caching md5sums of local files between runs, '
+                             'reused while their size and modification time are unchanged')
+    parser.add_argument('--hash-workers', type=int,
+                        help='Number of processes hashing local files (default: one per CPU)')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Number of drive folder listings to run concurrently')
+    args = parser.parse_args()
+
+    credentials_name = os.path.splitext(os.path.basename(args.credentials_path))[0]
+    configure_logging('compare-local-drive-{}.log'.format(credentials_name))
+    configure_requests(max_rate=args.max_rate, metrics_path=args.metrics,
+                       progress_interval=args.progress_interval)
+
+    creds = authenticate(args.credentials_path, token_path=credentials_name + '.pickle')
+    service = build('drive', 'v3', credentials=creds)
+    files = service.files()
+
+    path_cache = PathCache(path=args.path_cache)
+    hash_cache = LocalHashCache(path=args.hash_cache)
+    hasher = LocalTreeHasher(num_workers=args.hash_workers, cache=hash_cache)
+
+    # Walk drive on a thread while the local tree is hashed
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        drive_future = executor.submit(
+            get_drive_tree_checksums, args.drive_path, files,
+            files_factory=lambda: build('drive', 'v3', credentials=creds).files(),
+            num_workers=args.workers, path_cache=path_cache)
+        local_checksums = dict(
+            (rel_path, md5_checksum)
+            for (rel_path, size, md5_checksum) in hasher.hash(args.local_path))
+        LOGGER.info('Checked {} local files ({} from cache)'.format(
+            len(local_checksums), hasher.num_cached))
+        hash_cache.save()
+        (drive_checksums, num_skipped) = drive_future.result()
+    LOGGER.info('Listed {} drive files ({} without md5sums skipped)'.format(
+        sum(len(c) for c in drive_checksums.values()), num_skipped))
+
+    num_differences = 0
+    for (status, path) in diff_tree_checksums(local_checksums, drive_checksums):
+        print('{:<8}  {}'.format(status, path))
+        num_differences += 1
+    LOGGER.info('{} differences'.format(num_differences))
+
+    path_cache.save()
+
+
+if __name__ == '__main__':
+    main()
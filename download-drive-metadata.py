@@ -1,37 +1,131 @@
 #!/usr/bin/env python3
 
+import asyncio
 import os
-import json
-import time
 
 from googleapiclient.discovery import build
 
-from migrate_google import authenticate, configure_logging, FileMetadataDownloader
+from migrate_google import (
+    authenticate, configure_logging, configure_requests, FileMetadataDownloader,
+    PipelinedFileMetadataDownloader, Checkpoint, get_changes_token_path, save_start_page_token,
+    ShardedLister, get_query_shards, AsyncDriveClient, AsyncFileMetadataDownloader,
+    open_snapshot_writer,
+)
+
+
+def download(creds, service, checkpoint, output_file, args):
+    if args.shards:
+        # Shards are listed from the start each time, skipping files
+        # already downloaded
+        lister = ShardedLister(
+            lambda: build('drive', 'v3', credentials=creds),
+            get_query_shards(by=args.shard_by, num_shards=args.shards),
+            skip_ids=checkpoint.done)
+    else:
+        lister = None
+    if args.workers:
+        downloader = PipelinedFileMetadataDownloader(
+            lambda: build('drive', 'v3', credentials=creds),
+            num_workers=args.workers,
+            batch=args.batch,
+            inline_permissions=args.inline_permissions,
+            lister=lister)
+    else:
+        downloader = FileMetadataDownloader(
+            service.files(), service.permissions(),
+            service=service if args.batch else None,
+            inline_permissions=args.inline_permissions,
+            lister=lister)
+    if lister is not None:
+        for metadata in downloader.list():
+            output_file.write(metadata)
+            checkpoint.mark_done(metadata['id'])
+        checkpoint.end_page(None)
+    else:
+        for (metadata, _) in checkpoint.iter(
+                (metadata, metadata['batch_info'])
+                for metadata in downloader.list(page_token=checkpoint.page_token)):
+            output_file.write(metadata)
+
+
+async def download_async(creds, checkpoint, output_file, max_connections, inline_permissions):
+    async with AsyncDriveClient(creds, max_connections=max_connections) as client:
+        downloader = AsyncFileMetadataDownloader(
+            client, max_pending_files=10 * max_connections,
+            inline_permissions=inline_permissions)
+        async for metadata in downloader.list(page_token=checkpoint.page_token):
+            for (metadata, _) in checkpoint.iter([(metadata, metadata['batch_info'])]):
+                output_file.write(metadata)
 
 
 def main():
     from argparse import ArgumentParser
     parser = ArgumentParser(description='Download and save metadata from drive files')
     parser.add_argument('credentials_path', help='Path to credentials json file')
-    parser.add_argument('output_path', help='Path to output jsonl file')
-    parser.add_argument('--sleep', type=float,
-                        help='Amount of time to sleep between files')
+    parser.add_argument('output_path',
+                        help='Path to output metadata file: jsonl, or columnar msgpack if '
+                             'it ends in .msgpack, compressed with zstandard if .zst follows')
+    parser.add_argument('--max-rate', type=float,
+                        help='Maximum number of API requests per second '
+                             '(default: unlimited)')
+    parser.add_argument('--metrics',
+                        help='Path to write metrics of API requests to as json')
+    parser.add_argument('--progress-interval', type=float,
+                        help='Log request progress every this many seconds')
+    parser.add_argument('--batch', action='store_true',
+                        help='Fetch permissions for each page of files in batch requests')
+    parser.add_argument('--inline-permissions', action='store_true',
+                        help='Request permissions in the file listing where we have access')
+    parser.add_argument('--workers', type=int,
+                        help='Number of threads fetching permissions concurrently')
+    parser.add_argument('--async-connections', type=int,
+                        help='Fetch permissions with asyncio (requires aiohttp) over up to '
+                             'this many connections, instead of threads')
+    parser.add_argument('--shards', type=int,
+                        help='List files in this many shards concurrently rather than '
+                             'page by page')
+    parser.add_argument('--shard-by', choices=('modifiedTime', 'mimeType'),
+                        default='modifiedTime',
+                        help='Split the listing by ranges of modification time or by '
+                             'kind of file (three shards)')
+    parser.add_argument('--checkpoint',
+                        help='Path to checkpoint journal for resuming, with the same '
+                             'sharding options (default: <output_path>.checkpoint)')
     args = parser.parse_args()
+    if args.async_connections and (args.shards or args.workers or args.batch):
+        parser.error('--async-connections cannot be used with --shards, --workers or --batch')
 
     credentials_name = os.path.splitext(os.path.basename(args.credentials_path))[0]
     configure_logging('download-drive-metadata-{}.log'.format(credentials_name))
+    configure_requests(max_rate=args.max_rate, metrics_path=args.metrics,
+                       progress_interval=args.progress_interval)
 
     creds = authenticate(args.credentials_path, token_path=credentials_name + '.pickle')
     service = build('drive', 'v3', credentials=creds)
-    files = service.files()
-    perms = service.permissions()
 
-    with open(args.output_path, 'w') as output_file:
-        downloader = FileMetadataDownloader(files, perms)
-        for metadata in downloader.list():
-            output_file.write(json.dumps(metadata) + '\n')
-            if args.sleep:
-                time.sleep(args.sleep)
+    with open_snapshot_writer(args.output_path, mode='a') as output_file:
+        try:
+            checkpoint = Checkpoint(
+                args.checkpoint or args.output_path + '.checkpoint', output_file=output_file,
+                config=dict(shards=args.shards,
+                            shard_by=args.shard_by if args.shards else None))
+        except ValueError as ex:
+            parser.error(str(ex))
+        if checkpoint.resuming:
+            output_file.truncate(checkpoint.offset or 0)
+        else:
+            output_file.truncate(0)
+            # Changes from here on can later be applied with sync-drive-metadata.py
+            save_start_page_token(service.changes(), get_changes_token_path(args.output_path))
+
+        if args.async_connections:
+            asyncio.run(download_async(
+                creds, checkpoint, output_file, args.async_connections,
+                args.inline_permissions))
+        else:
+            download(creds, service, checkpoint, output_file, args)
+
+        checkpoint.close()
 
 
 if __name__ == '__main__':
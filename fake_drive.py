@@ -0,0 +1,645 @@
+#!/usr/bin/env python3
+
+import asyncio
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import httplib2
+
+from googleapiclient.errors import HttpError
+
+from migrate_google import (
+    EXECUTOR, FOLDER_MIME_TYPE, GOOGLE_APPS_MIME_TYPE, AsyncDriveClient, FileMetadataDownloader,
+)
+
+FAKE_EMAIL = 'me@example.com'
+FAKE_OTHER_EMAILS = ('alice@example.com', 'bob@example.com', 'carol@example.com')
+
+FILE_MIME_TYPES = (
+    'application/pdf',
+    'image/jpeg',
+    'text/plain',
+    GOOGLE_APPS_MIME_TYPE + '.document',
+    GOOGLE_APPS_MIME_TYPE + '.spreadsheet',
+)
+
+QUERY_CLAUSES = (
+    ('parents', re.compile(r"^'((?:[^'\\]|\\.)*)' in parents$")),
+    ('owners', re.compile(r"^'((?:[^'\\]|\\.)*)' in owners$")),
+    ('name', re.compile(r"^name (=|!=) '((?:[^'\\]|\\.)*)'$")),
+    ('mimeType', re.compile(r"^mimeType (=|!=) '((?:[^'\\]|\\.)*)'$")),
+    ('mimeTypeContains', re.compile(r"^(not )?mimeType contains '((?:[^'\\]|\\.)*)'$")),
+    ('modifiedTime', re.compile(r"^modifiedTime (<=|>=|<|>|=) '((?:[^'\\]|\\.)*)'$")),
+    ('trashed', re.compile(r"^trashed = (true|false)$")),
+    ('appProperties', re.compile(
+        r"^appProperties has \{ key='((?:[^'\\]|\\.)*)' and value='((?:[^'\\]|\\.)*)' \}$")),
+)
+
+COMPARISONS = {
+    '=': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+}
+
+
+def unescape_query_string(value):
+    return re.sub(r'\\(.)', r'\1', value)
+
+
+def split_query(q, operator):
+    # Split on operator outside of braces, as in appProperties clauses
+    return [
+        part.strip() for part in
+        re.split(r' {} (?![^{{]*\}})'.format(operator), q)
+    ]
+
+
+def expand_query(q):
+    # q as a disjunction of conjunctions, each a list of clauses; q may
+    # start with a parenthesized disjunction, as in "(a or b) and c"
+    m = re.match(r'^\((.*?)\)(?: and (.*))?$', q)
+    if m is None:
+        return [split_query(d, 'and') for d in split_query(q, 'or')]
+    rest = split_query(m.group(2), 'and') if m.group(2) else []
+    return [split_query(d, 'and') + rest for d in split_query(m.group(1), 'or')]
+
+
+def parse_fields(fields):
+    # Parse a fields mask such as "nextPageToken, files(id, permissions(id))"
+    # into a dict mapping each top-level field to its own mask (or None)
+    mask = dict()
+    depth = 0
+    start = 0
+    for (i, c) in enumerate(fields + ','):
+        if c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif c == ',' and depth == 0:
+            field = fields[start:i].strip()
+            start = i + 1
+            if not field:
+                continue
+            if '(' in field:
+                (name, sub_fields) = field.split('(', 1)
+                mask[name.strip()] = parse_fields(sub_fields[:-1])
+            else:
+                mask[field] = None
+    return mask
+
+
+def new_http_error(status, reason, uri=''):
+    content = json.dumps(dict(error=dict(
+        code=status, message=reason, errors=[dict(reason=reason, message=reason)])))
+    return HttpError(httplib2.Response({'status': status}), content.encode('utf-8'), uri=uri)
+
+
+class FakeDrive(object):
+    # In-process stand-in for the Drive v3 files, permissions and changes
+    # endpoints, holding a synthetic drive of files owned by email.  Requests
+    # sleep for latency seconds (plus up to jitter more) and fail with a
+    # rateLimitExceeded error with probability quota_error_rate, so that the
+    # retry and rate limiting paths are exercised too.  build() returns an
+    # object used like the service from googleapiclient.discovery.build;
+    # services share the drive and may be used from several threads.  Files
+    # added with content can also be downloaded with files().get_media.
+    DEFAULT_FIELDS = {'kind': None, 'id': None, 'name': None, 'mimeType': None}
+    MAX_PAGE_SIZE = 1000
+    MAX_QUERY_CACHE_SIZE = 64
+
+    def __init__(self, email=FAKE_EMAIL, latency=0.0, jitter=0.0, quota_error_rate=0.0,
+                 seed=0):
+        self.email = email
+        self.latency = latency
+        self.jitter = jitter
+        self.quota_error_rate = quota_error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.files = OrderedDict()
+        self.contents = dict()
+        self.child_ids = dict()
+        self.changes = []
+        self.query_cache = OrderedDict()
+        self.next_id = 0
+        self.num_requests = 0
+        self.root_id = self.add_file(
+            dict(name='My Drive', mimeType=FOLDER_MIME_TYPE), record_change=False)['id']
+
+    @classmethod
+    def generate(cls, num_files=10000, depth=4, fan_out=8, folder_ratio=0.1,
+                 multi_parent_ratio=0.01, duplicate_ratio=0.01, shared_ratio=0.1, seed=0,
+                 **kwargs):
+        # Synthetic tree: each folder down to depth has fan_out subfolders,
+        # filled breadth-first until folders make up folder_ratio of the
+        # files, and the remaining files are spread over the folders at
+        # random.  A fraction of files have a second parent, duplicate the
+        # content (or name and content) of an earlier file, or are shared
+        # with others.
+        drive = cls(seed=seed, **kwargs)
+        rand = random.Random(seed)
+        max_folders = max(1, int(num_files * folder_ratio))
+        folder_ids = [drive.root_id]
+        level = [drive.root_id]
+        for d in range(depth):
+            next_level = []
+            for parent_id in level:
+                for i in range(fan_out):
+                    if len(folder_ids) >= max_folders:
+                        break
+                    f = drive.add_file(dict(
+                        name='folder-{}-{}'.format(d, i), mimeType=FOLDER_MIME_TYPE,
+                        parents=[parent_id]), record_change=False)
+                    next_level.append(f['id'])
+                    folder_ids.append(f['id'])
+            level = next_level
+
+        files = []
+        for i in range(num_files - len(folder_ids)):
+            parents = [rand.choice(folder_ids)]
+            if rand.random() < multi_parent_ratio:
+                other_parent_id = rand.choice(folder_ids)
+                if other_parent_id != parents[0]:
+                    parents.append(other_parent_id)
+            if files and rand.random() < duplicate_ratio:
+                original = rand.choice(files)
+                if rand.random() < 0.5:
+                    parents = list(original['parents'])
+                metadata = dict(
+                    (k, original.get(k)) for k in ('name', 'mimeType', 'size', 'md5Checksum'))
+            else:
+                mime_type = rand.choice(FILE_MIME_TYPES)
+                metadata = dict(name='file-{}'.format(i), mimeType=mime_type)
+                if GOOGLE_APPS_MIME_TYPE not in mime_type:
+                    metadata['size'] = str(rand.randint(0, 10 * 1024 * 1024))
+                    metadata['md5Checksum'] = hashlib.md5(
+                        str(rand.random()).encode('utf-8')).hexdigest()
+            metadata['parents'] = parents
+            metadata['modifiedTime'] = time.strftime(
+                '%Y-%m-%dT%H:%M:%S.000Z',
+                time.gmtime(rand.uniform(1136073600, 1136073600 + 15 * 365 * 24 * 60 * 60)))
+            metadata['createdTime'] = metadata['modifiedTime']
+            if rand.random() < shared_ratio:
+                metadata['permissions'] = [dict(
+                    type='user', role=rand.choice(('reader', 'writer')),
+                    emailAddress=rand.choice(FAKE_OTHER_EMAILS))]
+            files.append(drive.add_file(metadata, record_change=False))
+        return drive
+
+    def build(self):
+        return FakeService(self)
+
+    def add_file(self, metadata, owner=None, record_change=True, content=None):
+        # Files with content can be downloaded; their size and md5Checksum
+        # are those of content unless given in metadata
+        with self.lock:
+            file_id = 'fake{:08d}'.format(self.next_id)
+            self.next_id += 1
+            f = dict(
+                kind='drive#file', id=file_id, mimeType='application/octet-stream',
+                trashed=False, starred=False, createdTime='2020-01-01T00:00:00.000Z',
+                modifiedTime='2020-01-01T00:00:00.000Z')
+            if content is not None:
+                self.contents[file_id] = content
+                f.update(size=str(len(content)), md5Checksum=hashlib.md5(content).hexdigest())
+            f.update(metadata)
+            f['permissions'] = [
+                dict(id='perm-owner', type='user', role='owner',
+                     emailAddress=owner or self.email)
+            ] + [
+                dict(p, id='perm{}'.format(i))
+                for (i, p) in enumerate(metadata.get('permissions') or [])
+            ]
+            self.files[file_id] = f
+            self.link(f)
+            if record_change:
+                self.record_change(file_id)
+            return f
+
+    def link(self, f):
+        for parent_id in f.get('parents') or []:
+            self.child_ids.setdefault(parent_id, []).append(f['id'])
+        self.query_cache.clear()
+
+    def unlink(self, f):
+        for parent_id in f.get('parents') or []:
+            self.child_ids[parent_id].remove(f['id'])
+        self.query_cache.clear()
+
+    def record_change(self, file_id):
+        self.changes.append(file_id)
+
+    def resolve_id(self, file_id):
+        return self.root_id if file_id == 'root' else file_id
+
+    def get_file(self, file_id):
+        f = self.files.get(self.resolve_id(file_id))
+        if f is None:
+            raise new_http_error(404, 'notFound', 'files/{}'.format(file_id))
+        return f
+
+    def get_permission(self, f, permission_id):
+        for p in f['permissions']:
+            if p['id'] == permission_id:
+                return p
+        raise new_http_error(404, 'notFound', 'files/{}/permissions/{}'.format(
+            f['id'], permission_id))
+
+    def wait(self):
+        # Called once per round trip: for each request, or each batch
+        with self.lock:
+            delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def check_quota(self):
+        # Called for each request, including each part of a batch
+        with self.lock:
+            self.num_requests += 1
+            fail = self.random.random() < self.quota_error_rate
+        if fail:
+            raise new_http_error(403, 'rateLimitExceeded')
+
+    def project(self, item, mask):
+        # Apply a fields mask to an item
+        if mask is None:
+            return dict(item)
+        projected = dict()
+        for (name, sub_mask) in mask.items():
+            if name == '*':
+                return self.project(item, None)
+            value = item.get(name)
+            if name == 'owners':
+                value = [
+                    dict(kind='drive#user', emailAddress=p['emailAddress'],
+                         me=p['emailAddress'] == self.email)
+                    for p in item.get('permissions', []) if p['role'] == 'owner']
+            if value is None:
+                continue
+            if sub_mask is not None and isinstance(value, list):
+                value = [self.project(v, sub_mask) for v in value]
+            elif sub_mask is not None and isinstance(value, dict):
+                value = self.project(value, sub_mask)
+            projected[name] = value
+        return projected
+
+    def match_clause(self, f, clause):
+        for (kind, pattern) in QUERY_CLAUSES:
+            m = pattern.match(clause)
+            if m is None:
+                continue
+            groups = [unescape_query_string(g) if g is not None else None for g in m.groups()]
+            if kind == 'parents':
+                return self.resolve_id(groups[0]) in (f.get('parents') or [])
+            elif kind == 'owners':
+                return any(p['role'] == 'owner' and p['emailAddress'] == groups[0]
+                           for p in f['permissions'])
+            elif kind == 'name':
+                return COMPARISONS[groups[0]](f.get('name'), groups[1])
+            elif kind == 'mimeType':
+                return COMPARISONS[groups[0]](f.get('mimeType'), groups[1])
+            elif kind == 'mimeTypeContains':
+                return (groups[1] in f.get('mimeType', '')) != (groups[0] is not None)
+            elif kind == 'modifiedTime':
+                return COMPARISONS[groups[0]](f.get('modifiedTime', ''), groups[1])
+            elif kind == 'trashed':
+                return f.get('trashed', False) == (groups[0] == 'true')
+            elif kind == 'appProperties':
+                return (f.get('appProperties') or {}).get(groups[0]) == groups[1]
+        raise new_http_error(400, 'invalidQuery')
+
+    def query(self, q):
+        # Ids of the files matching q, cached so that paging through a query
+        # does not run it again for every page
+        with self.lock:
+            if q in self.query_cache:
+                self.query_cache.move_to_end(q)
+                return self.query_cache[q]
+
+            file_ids = OrderedDict()
+            for clauses in expand_query(q) if q else [[]]:
+                m = QUERY_CLAUSES[0][1].match(clauses[0]) if clauses else None
+                if m is not None:
+                    # Only look at the children of the folder named
+                    candidate_ids = self.child_ids.get(
+                        self.resolve_id(unescape_query_string(m.group(1))), [])
+                    clauses = clauses[1:]
+                else:
+                    candidate_ids = self.files
+                for file_id in candidate_ids:
+                    if all(self.match_clause(self.files[file_id], clause) for clause in clauses):
+                        file_ids[file_id] = None
+            file_ids = list(file_ids)
+
+            self.query_cache[q] = file_ids
+            while len(self.query_cache) > self.MAX_QUERY_CACHE_SIZE:
+                self.query_cache.popitem(last=False)
+            return file_ids
+
+    def get_page(self, items, page_token, page_size):
+        start = int(page_token or 0)
+        end = start + min(page_size or 100, self.MAX_PAGE_SIZE)
+        return (items[start:end], str(end) if end < len(items) else None)
+
+    def files_list(self, q=None, pageToken=None, pageSize=100, fields=None, **kwargs):
+        mask = parse_fields(fields) if fields else dict(files=self.DEFAULT_FIELDS)
+        file_ids = self.query(q)
+        (page, next_page_token) = self.get_page(file_ids, pageToken, pageSize)
+        with self.lock:
+            response = dict(files=[
+                self.project(self.files[file_id], mask.get('files'))
+                for file_id in page if file_id in self.files])
+        if next_page_token is not None:
+            response['nextPageToken'] = next_page_token
+        return response
+
+    def files_get(self, fileId, fields=None, **kwargs):
+        with self.lock:
+            return self.project(
+                self.get_file(fileId), parse_fields(fields) if fields else self.DEFAULT_FIELDS)
+
+    def files_update(self, fileId, body=None, addParents=None, removeParents=None, fields=None,
+                     **kwargs):
+        with self.lock:
+            f = self.get_file(fileId)
+            self.unlink(f)
+            f.update(body or {})
+            removed = (removeParents or '').split(',')
+            parents = [p for p in f.get('parents') or [] if p not in removed]
+            parents.extend(p for p in (addParents or '').split(',') if p and p not in parents)
+            f['parents'] = parents
+            self.link(f)
+            self.record_change(f['id'])
+            return self.project(f, parse_fields(fields) if fields else self.DEFAULT_FIELDS)
+
+    def files_copy(self, fileId, body=None, fields=None, **kwargs):
+        with self.lock:
+            original = self.get_file(fileId)
+            metadata = dict(
+                (k, list(v) if isinstance(v, list) else v)
+                for (k, v) in original.items() if k not in ('id', 'permissions'))
+            metadata.update(body or {})
+            f = self.add_file(metadata)
+            return self.project(f, parse_fields(fields) if fields else self.DEFAULT_FIELDS)
+
+    def files_delete(self, fileId, **kwargs):
+        with self.lock:
+            f = self.get_file(fileId)
+            self.unlink(f)
+            del self.files[f['id']]
+            self.contents.pop(f['id'], None)
+            self.record_change(f['id'])
+            return ''
+
+    def files_get_media(self, fileId, start=0, end=None):
+        # Return (content in the range, total size), as for a Range header
+        with self.lock:
+            f = self.get_file(fileId)
+            if f['id'] not in self.contents:
+                raise new_http_error(403, 'fileNotDownloadable', 'files/{}'.format(fileId))
+            content = self.contents[f['id']]
+            return (content[start:None if end is None else end + 1], len(content))
+
+    def permissions_list(self, fileId, pageToken=None, pageSize=100, fields=None, **kwargs):
+        mask = parse_fields(fields) if fields else dict(permissions=None)
+        with self.lock:
+            perms = self.get_file(fileId)['permissions']
+            (page, next_page_token) = self.get_page(perms, pageToken, pageSize)
+            response = dict(permissions=[self.project(p, mask.get('permissions')) for p in page])
+        if next_page_token is not None:
+            response['nextPageToken'] = next_page_token
+        return response
+
+    def permissions_create(self, fileId, body=None, transferOwnership=False, fields=None,
+                           **kwargs):
+        with self.lock:
+            f = self.get_file(fileId)
+            self.demote_owner(f, transferOwnership and body.get('role') == 'owner')
+            p = dict(body, id='perm{}'.format(self.next_id))
+            self.next_id += 1
+            f['permissions'].append(p)
+            self.record_change(f['id'])
+            return self.project(p, parse_fields(fields) if fields else None)
+
+    def permissions_update(self, fileId, permissionId, body=None, transferOwnership=False,
+                           fields=None, **kwargs):
+        with self.lock:
+            f = self.get_file(fileId)
+            p = self.get_permission(f, permissionId)
+            self.demote_owner(f, transferOwnership and body.get('role') == 'owner')
+            p.update(body or {})
+            self.record_change(f['id'])
+            return self.project(p, parse_fields(fields) if fields else None)
+
+    def permissions_delete(self, fileId, permissionId, **kwargs):
+        with self.lock:
+            f = self.get_file(fileId)
+            f['permissions'].remove(self.get_permission(f, permissionId))
+            self.record_change(f['id'])
+            return ''
+
+    def demote_owner(self, f, transfer):
+        if transfer:
+            for p in f['permissions']:
+                if p['role'] == 'owner':
+                    p['role'] = 'writer'
+
+    def changes_getStartPageToken(self, **kwargs):
+        with self.lock:
+            return dict(startPageToken=str(len(self.changes)))
+
+    def changes_list(self, pageToken, pageSize=100, includeRemoved=False, fields=None, **kwargs):
+        mask = parse_fields(fields) if fields else dict(changes=None)
+        change_mask = mask.get('changes') or dict(changeType=None, fileId=None, removed=None,
+                                                   file=None)
+        with self.lock:
+            start = int(pageToken)
+            end = min(len(self.changes), start + min(pageSize, self.MAX_PAGE_SIZE))
+            changes = []
+            for file_id in self.changes[start:end]:
+                f = self.files.get(file_id)
+                if f is None and not includeRemoved:
+                    continue
+                change = dict(kind='drive#change', changeType='file', fileId=file_id,
+                              removed=f is None)
+                if f is not None:
+                    change['file'] = f
+                changes.append(self.project(change, change_mask))
+            response = dict(changes=changes)
+            if end < len(self.changes):
+                response['nextPageToken'] = str(end)
+            else:
+                response['newStartPageToken'] = str(end)
+            return response
+
+    def iter_metadata(self, file_fields=FileMetadataDownloader.DEFAULT_FILE_FIELDS,
+                      perm_fields=('id', 'type', 'role', 'emailAddress')):
+        # Records as FileMetadataDownloader writes them to a snapshot,
+        # straight from the drive without going through the API
+        num_files = len(self.files)
+        for (i, f) in enumerate(list(self.files.values())):
+            metadata = dict((k, f.get(k)) for k in file_fields)
+            metadata['permissions'] = [
+                dict((k, p.get(k)) for k in perm_fields) for p in f['permissions']]
+            metadata['error'] = None
+            metadata['batch_info'] = dict(next_page_token=None, item_index=i, num_items=num_files)
+            yield metadata
+
+
+class FakeRequest(object):
+    def __init__(self, drive, method, kwargs):
+        self.drive = drive
+        self.method = method
+        self.kwargs = kwargs
+        self.methodId = 'drive.' + method.replace('_', '.')
+
+    def execute(self, **kwargs):
+        self.drive.wait()
+        return self.execute_in_batch()
+
+    def execute_in_batch(self):
+        self.drive.check_quota()
+        return getattr(self.drive, self.method)(**self.kwargs)
+
+
+class FakeMediaRequest(object):
+    # Request for file content, downloaded as by the real client: through
+    # MediaIoBaseDownload, which sends requests with a Range header to http
+    def __init__(self, drive, file_id):
+        self.drive = drive
+        self.file_id = file_id
+        self.methodId = 'drive.files.get_media'
+        self.uri = 'files/{}?alt=media'.format(file_id)
+        self.headers = dict()
+        self.http = FakeMediaHttp(drive, file_id)
+
+    def execute(self, **kwargs):
+        (_, content) = self.http.request(self.uri)
+        return content
+
+
+class FakeMediaHttp(object):
+    def __init__(self, drive, file_id):
+        self.drive = drive
+        self.file_id = file_id
+
+    def request(self, uri, method='GET', headers=None, **kwargs):
+        self.drive.wait()
+        self.drive.check_quota()
+        match = re.match(r'^bytes=(\d+)-(\d+)$', (headers or {}).get('range', ''))
+        if match is None:
+            (content, total_size) = self.drive.files_get_media(self.file_id)
+            return (httplib2.Response({'status': 200, 'content-length': str(total_size)}),
+                    content)
+        (start, end) = (int(match.group(1)), int(match.group(2)))
+        (content, total_size) = self.drive.files_get_media(self.file_id, start, end)
+        if total_size == 0 or start >= total_size:
+            return (httplib2.Response({'status': 416, 'content-range': 'bytes */{}'.format(
+                total_size)}), b'')
+        return (httplib2.Response({'status': 206, 'content-range': 'bytes {}-{}/{}'.format(
+            start, start + len(content) - 1, total_size)}), content)
+
+
+class FakeResource(object):
+    def __init__(self, drive, name):
+        self.drive = drive
+        self.name = name
+
+    def __getattr__(self, method):
+        if method == 'get_media' and self.name == 'files':
+            return lambda fileId, **kwargs: FakeMediaRequest(self.drive, fileId)
+        if method.startswith('_') or not hasattr(self.drive, '{}_{}'.format(self.name, method)):
+            raise AttributeError(method)
+        return lambda **kwargs: FakeRequest(self.drive, '{}_{}'.format(self.name, method), kwargs)
+
+    def list_next(self, previous_request, previous_response):
+        if previous_response.get('nextPageToken') is None:
+            return None
+        return FakeRequest(self.drive, previous_request.method, dict(
+            previous_request.kwargs, pageToken=previous_response['nextPageToken']))
+
+
+class FakeBatchRequest(object):
+    # Requests in a batch succeed or fail independently; the batch itself
+    # costs one round trip.  Requests are kept as in googleapiclient's
+    # BatchHttpRequest, which RequestExecutor.is_idempotent looks into
+    def __init__(self, drive, callback=None):
+        self.drive = drive
+        self.callback = callback
+        self._requests = dict()
+        self._callbacks = dict()
+        self._order = []
+
+    def add(self, request, callback=None, request_id=None):
+        if request_id is None:
+            request_id = str(len(self._order) + 1)
+        if request_id in self._requests:
+            raise KeyError('A request with this ID already exists: {}'.format(request_id))
+        self._requests[request_id] = request
+        self._callbacks[request_id] = callback or self.callback
+        self._order.append(request_id)
+
+    def execute(self, **kwargs):
+        self.drive.wait()
+        for request_id in self._order:
+            callback = self._callbacks[request_id]
+            try:
+                response = self._requests[request_id].execute_in_batch()
+            except HttpError as ex:
+                callback(request_id, None, ex)
+            else:
+                callback(request_id, response, None)
+
+
+class FakeService(object):
+    def __init__(self, drive):
+        self.drive = drive
+
+    def files(self):
+        return FakeResource(self.drive, 'files')
+
+    def permissions(self):
+        return FakeResource(self.drive, 'permissions')
+
+    def changes(self):
+        return FakeResource(self.drive, 'changes')
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatchRequest(self.drive, callback=callback)
+
+
+class FakeAsyncClient(AsyncDriveClient):
+    # Stand-in for AsyncDriveClient on drive, sending each REST request to
+    # the method of drive its endpoint names (as drive.files.list to
+    # files_list), so the async functions run without aiohttp or a network
+    def __init__(self, drive, executor=None):
+        self.drive = drive
+        self.executor = executor if executor is not None else EXECUTOR
+
+    async def __aenter__(self):
+        return self
+
+    async def close(self):
+        pass
+
+    async def request(self, method, path, params=None, body=None, cost=1, idempotent=None):
+        kwargs = dict(params or {})
+        parts = path.split('/')
+        if len(parts) > 1:
+            kwargs['fileId'] = parts[1]
+        if len(parts) > 3:
+            kwargs['permissionId'] = parts[3]
+        if body is not None:
+            kwargs['body'] = body
+        await asyncio.sleep(0)
+        self.drive.wait()
+        self.drive.check_quota()
+        (_, resource, action) = self.get_endpoint(method, path).split('.')
+        return getattr(self.drive, '{}_{}'.format(resource, action))(**kwargs)
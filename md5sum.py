@@ -4,7 +4,10 @@ import os
 
 from googleapiclient.discovery import build
 
-from migrate_google import LOGGER, authenticate, walk, configure_logging
+from migrate_google import (
+    LOGGER, authenticate, walk, configure_logging, configure_requests, ContentVerifier,
+    PathCache,
+)
 
 
 def main():
@@ -12,21 +15,71 @@ def main():
     parser = ArgumentParser(description='Print md5sum(s) for file/directory')
     parser.add_argument('credentials_path', help='Path to credentials json file')
     parser.add_argument('path', help='Path of file/directory to print md5sum(s) for')
+    parser.add_argument('--max-rate', type=float,
+                        help='Maximum number of API requests per second '
+                             '(default: unlimited)')
+    parser.add_argument('--metrics',
+                        help='Path to write metrics of API requests to as json')
+    parser.add_argument('--progress-interval', type=float,
+                        help='Log request progress every this many seconds')
+    parser.add_argument('--path-cache',
+                        help='Path to file caching path lookups between runs')
+    parser.add_argument('--verify', action='store_true',
+                        help='Download the content of each file and check it against its '
+                             'md5sum, printing OK or FAILED for each file')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Number of files to download at once when verifying')
+    parser.add_argument('--chunk-size', type=int, default=ContentVerifier.CHUNK_SIZE,
+                        help='Number of bytes to download in each request when verifying')
     args = parser.parse_args()
 
     credentials_name = os.path.splitext(os.path.basename(args.credentials_path))[0]
     configure_logging('md5sum-{}.log'.format(credentials_name))
+    configure_requests(max_rate=args.max_rate, metrics_path=args.metrics,
+                       progress_interval=args.progress_interval)
 
     creds = authenticate(args.credentials_path, token_path=credentials_name + '.pickle')
     service = build('drive', 'v3', credentials=creds)
     files = service.files()
 
-    LOGGER.debug('Printing md5sum(s) under {} ...'.format(args.path))
-    for (root, dir_entries, file_entries) in walk(
-            args.path, files, fields=('id', 'name', 'mimeType', 'md5Checksum')):
-        for file_entry in file_entries:
-            if file_entry.get('name') and file_entry.get('md5Checksum'):
-                print('{}  {}'.format(file_entry['md5Checksum'], file_entry['name']))
+    path_cache = PathCache(path=args.path_cache)
+
+    def iter_file_entries():
+        for (root, dir_entries, file_entries) in walk(
+                args.path, files, fields=('id', 'name', 'mimeType', 'md5Checksum'),
+                path_cache=path_cache):
+            for file_entry in file_entries:
+                if file_entry.get('name') and file_entry.get('md5Checksum'):
+                    yield file_entry
+
+    if args.verify:
+        LOGGER.debug('Verifying md5sum(s) under {} ...'.format(args.path))
+        verifier = ContentVerifier(
+            lambda: build('drive', 'v3', credentials=creds),
+            num_workers=args.workers, chunk_size=args.chunk_size)
+        num_failed = 0
+        for (file_entry, result) in verifier.verify(iter_file_entries()):
+            if result['error'] is not None:
+                print('{}: FAILED open or read'.format(file_entry['name']))
+                num_failed += 1
+            elif result['md5Checksum'] != file_entry['md5Checksum']:
+                print('{}: FAILED'.format(file_entry['name']))
+                LOGGER.warning('Checksum mismatch for {} ({}): expected {}, computed {}'.format(
+                    file_entry['name'], file_entry['id'], file_entry['md5Checksum'],
+                    result['md5Checksum']))
+                num_failed += 1
+            else:
+                print('{}: OK'.format(file_entry['name']))
+        for line in verifier.format_worker_stats():
+            LOGGER.info(line)
+        if num_failed:
+            LOGGER.warning('{} files did not verify'.format(num_failed))
+    else:
+        LOGGER.debug('Printing md5sum(s) under {} ...'.format(args.path))
+        for file_entry in iter_file_entries():
+            print('{}  {}'.format(file_entry['md5Checksum'], file_entry['name']))
+
+    path_cache.save()
 
 
 if __name__ == '__main__':
@@ -3,9 +3,11 @@
 import os
 
 from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
 
-from migrate_google import LOGGER, authenticate, service_method_iter, configure_logging
+from migrate_google import (
+    LOGGER, authenticate, service_page_iter, configure_logging, configure_requests,
+    Checkpoint, OwnershipTransferer,
+)
 
 
 def main():
@@ -14,48 +16,58 @@ def main():
     parser.add_argument('credentials_path', help='Path to credentials json file')
     parser.add_argument('from_email', help='Email address of current owner')
     parser.add_argument('to_email', help='Email address of new owner')
+    parser.add_argument('--max-rate', type=float,
+                        help='Maximum number of API requests per second '
+                             '(default: unlimited)')
+    parser.add_argument('--metrics',
+                        help='Path to write metrics of API requests to as json')
+    parser.add_argument('--progress-interval', type=float,
+                        help='Log request progress every this many seconds')
+    parser.add_argument('--batch-size', type=int, default=OwnershipTransferer.BATCH_SIZE,
+                        help='Number of files whose ownership is transferred per batch request')
+    parser.add_argument('--checkpoint',
+                        help='Path to checkpoint journal for resuming '
+                             '(default: migrate-drive-1-<credentials name>.checkpoint)')
     args = parser.parse_args()
 
     credentials_name = os.path.splitext(os.path.basename(args.credentials_path))[0]
     configure_logging('migrate-drive-1-{}.log'.format(credentials_name))
+    configure_requests(max_rate=args.max_rate, metrics_path=args.metrics,
+                       progress_interval=args.progress_interval)
 
     creds = authenticate(args.credentials_path, token_path=credentials_name + '.pickle')
     service = build('drive', 'v3', credentials=creds)
     files = service.files()
-    perms = service.permissions()
 
     LOGGER.debug('Searching for files owned by {} ...'.format(args.from_email))
+    checkpoint = Checkpoint(
+        args.checkpoint or 'migrate-drive-1-{}.checkpoint'.format(credentials_name))
     file_request = files.list(
+        pageToken=checkpoint.page_token,
         q="'{}' in owners and mimeType contains 'application/vnd.google-apps'".format(args.from_email),
         pageSize=100,
         fields="nextPageToken, files(id, name)")
-    for (f, _1) in service_method_iter(file_request, 'files', files.list_next):
-        LOGGER.info('Changing owner of {} to {}'.format(f['name'], args.to_email))
-        try:
-            perm_request = perms.list(
-                fileId=f['id'], pageSize=10,
-                fields="nextPageToken, permissions(id, type, emailAddress)")
-            for (p, _2) in service_method_iter(perm_request, 'permissions', perms.list_next):
-                if p['type'] == 'user' and p['emailAddress'] == args.to_email:
-                    LOGGER.debug('Updating permission to owner for {}'.format(args.to_email))
-                    perms.update(
-                        fileId=f['id'], permissionId=p['id'],
-                        transferOwnership=True,
-                        body={'role': 'owner'},
-                    ).execute()
-                    break
-
+    transferer = OwnershipTransferer(service, args.to_email, batch_size=args.batch_size)
+    failed = 0
+    for page in service_page_iter(file_request, 'files', files.list_next):
+        pending = [f for (f, _) in page if not checkpoint.is_done(f['id'])]
+        results = transferer.transfer(pending)
+        for f in pending:
+            if results[f['id']] is None:
+                checkpoint.mark_done(f['id'])
             else:
-                LOGGER.debug('Adding owner permission for {}'.format(args.to_email))
-                perms.create(
-                    fileId=f['id'],
-                    transferOwnership=True,
-                    enforceSingleParent=True,
-                    body={'role': 'owner', 'type': 'user', 'emailAddress': args.to_email},
-                ).execute()
-
-        except HttpError as ex:
-            LOGGER.warning('Caught exception: {}'.format(ex))
+                LOGGER.warning('Could not change owner of {} (error {})'.format(
+                    f['name'], results[f['id']]))
+                failed += 1
+        # Only files transferred are marked done, and the checkpoint only
+        # moves past pages once every file so far has been, so that a
+        # resumed run retries the files that failed
+        if page and not failed:
+            checkpoint.end_page(page[-1][1]['next_page_token'])
+
+    if failed:
+        LOGGER.warning('Could not change owner of {} files'.format(failed))
+    checkpoint.close()
 
 
 if __name__ == '__main__':
@@ -6,8 +6,8 @@ from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
 from migrate_google import (
-    LOGGER, authenticate, service_method_iter, configure_logging, FileCache,
-    remove_user_permissions,
+    LOGGER, authenticate, service_page_iter, configure_logging, configure_requests,
+    read_snapshot, FileCache, Checkpoint, copy_once, remove_user_permissions,
 )
 
 
@@ -17,38 +17,68 @@ def main():
     parser.add_argument('credentials_path', help='Path to credentials json file')
     parser.add_argument('from_email', help='Email address whose shared files will be copied')
     parser.add_argument('to_email', help='Email address to which files will be copied')
+    parser.add_argument('--max-rate', type=float,
+                        help='Maximum number of API requests per second '
+                             '(default: unlimited)')
+    parser.add_argument('--metrics',
+                        help='Path to write metrics of API requests to as json')
+    parser.add_argument('--progress-interval', type=float,
+                        help='Log request progress every this many seconds')
+    parser.add_argument('--file-cache',
+                        help='Path to SQLite file caching folder ownership between runs '
+                             '(default: <credentials name>-file-cache.sqlite)')
+    parser.add_argument('--metadata-path',
+                        help='Path to jsonl metadata for this drive, used to check folder '
+                             'ownership without API calls')
+    parser.add_argument('--checkpoint',
+                        help='Path to checkpoint journal for resuming '
+                             '(default: migrate-drive-3-<credentials name>.checkpoint)')
     args = parser.parse_args()
 
     credentials_name = os.path.splitext(os.path.basename(args.credentials_path))[0]
     configure_logging('migrate-drive-3-{}.log'.format(credentials_name))
+    configure_requests(max_rate=args.max_rate, metrics_path=args.metrics,
+                       progress_interval=args.progress_interval)
 
     creds = authenticate(args.credentials_path, token_path=credentials_name + '.pickle')
     service = build('drive', 'v3', credentials=creds)
     files = service.files()
     perms = service.permissions()
-    parents_cache = FileCache(files)
+    parents_cache = FileCache(
+        files, service=service,
+        path=args.file_cache or '{}-file-cache.sqlite'.format(credentials_name))
+    if args.metadata_path is not None:
+        LOGGER.info('Loading folder ownership from {}'.format(args.metadata_path))
+        parents_cache.load_metadata(read_snapshot(args.metadata_path), args.to_email)
 
     LOGGER.debug('Searching for files owned by {} ...'.format(args.from_email))
+    checkpoint = Checkpoint(
+        args.checkpoint or 'migrate-drive-3-{}.checkpoint'.format(credentials_name))
     file_request = files.list(
+        pageToken=checkpoint.page_token,
         q="'{}' in owners and not mimeType contains 'application/vnd.google-apps'".format(args.from_email),
         pageSize=100,
         fields="nextPageToken, files(id, name, starred, owners, parents)")
-    for (f, _) in service_method_iter(file_request, 'files', files.list_next):
-        try:
-            if not all(parents_cache.is_owned(parent_id) for parent_id in f.get('parents', [])):
-                LOGGER.warning('Skipping {} in folder owned by someone else'.format(f['name']))
-            else:
-                LOGGER.info('Copying {} and removing {}'.format(f['name'], args.from_email))
-                copy_response = files.copy(
-                    fileId=f['id'], enforceSingleParent=True,
-                    fields='id',
-                    body=dict((k, f[k]) for k in ('name', 'starred'))).execute()
-                remove_user_permissions(perms, copy_response['id'], args.from_email)
-                LOGGER.debug('Copied file id: {}; deleting {}'.format(copy_response['id'], f['id']))
-                remove_user_permissions(perms, f['id'], args.to_email)
-
-        except HttpError as ex:
-            LOGGER.warning('Caught exception: {}'.format(ex))
+    for page in service_page_iter(file_request, 'files', files.list_next):
+        parents_cache.prefetch(
+            parent_id for (f, _) in page for parent_id in f.get('parents', []))
+        for (f, _) in checkpoint.iter(page):
+            try:
+                if not all(parents_cache.is_owned(parent_id) for parent_id in f.get('parents', [])):
+                    LOGGER.warning('Skipping {} in folder owned by someone else'.format(f['name']))
+                else:
+                    LOGGER.info('Copying {} and removing {}'.format(f['name'], args.from_email))
+                    copy_id = copy_once(
+                        files, f['id'], dict((k, f[k]) for k in ('name', 'starred')))
+                    remove_user_permissions(perms, copy_id, args.from_email)
+                    LOGGER.debug('Copied file id: {}; deleting {}'.format(copy_id, f['id']))
+                    remove_user_permissions(perms, f['id'], args.to_email)
+
+            except HttpError as ex:
+                LOGGER.warning('Caught exception: {}'.format(ex))
+
+    parents_cache.close()
+    checkpoint.close()
 
 
 if __name__ == '__main__':
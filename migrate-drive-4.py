@@ -1,12 +1,14 @@
 #!/usr/bin/env python3
 
 import os
-import time
 
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
-from migrate_google import LOGGER, authenticate, service_method_iter, configure_logging
+from migrate_google import (
+    LOGGER, authenticate, service_method_iter, configure_logging, configure_requests, execute,
+    Checkpoint,
+)
 
 
 def main():
@@ -14,12 +16,22 @@ def main():
     parser = ArgumentParser(description='Remove unshared orphaned files')
     parser.add_argument('credentials_path', help='Path to credentials json file')
     parser.add_argument('email', help='Email address whose unshared files will be deleted')
-    parser.add_argument('--sleep', type=float,
-                        help='Amount of time to sleep between modifying files')
+    parser.add_argument('--max-rate', type=float,
+                        help='Maximum number of API requests per second '
+                             '(default: unlimited)')
+    parser.add_argument('--metrics',
+                        help='Path to write metrics of API requests to as json')
+    parser.add_argument('--progress-interval', type=float,
+                        help='Log request progress every this many seconds')
+    parser.add_argument('--checkpoint',
+                        help='Path to checkpoint journal for resuming '
+                             '(default: migrate-drive-4-<credentials name>.checkpoint)')
     args = parser.parse_args()
 
     credentials_name = os.path.splitext(os.path.basename(args.credentials_path))[0]
     configure_logging('migrate-drive-4-{}.log'.format(credentials_name))
+    configure_requests(max_rate=args.max_rate, metrics_path=args.metrics,
+                       progress_interval=args.progress_interval)
 
     creds = authenticate(args.credentials_path, token_path=credentials_name + '.pickle')
     service = build('drive', 'v3', credentials=creds)
@@ -27,11 +39,14 @@ def main():
     perms = service.permissions()
 
     LOGGER.debug('Searching for files owned by {} ...'.format(args.email))
+    checkpoint = Checkpoint(
+        args.checkpoint or 'migrate-drive-4-{}.checkpoint'.format(credentials_name))
     file_request = files.list(
+        pageToken=checkpoint.page_token,
         q="'{}' in owners and not mimeType contains 'application/vnd.google-apps'".format(args.email),
         pageSize=100,
         fields="nextPageToken, files(id, name, owners, parents)")
-    for (f, _1) in service_method_iter(file_request, 'files', files.list_next):
+    for (f, _1) in checkpoint.iter(service_method_iter(file_request, 'files', files.list_next)):
         if not f.get('parents'):
             try:
                 perm_request = perms.list(
@@ -42,13 +57,12 @@ def main():
                         break
                 else:
                     LOGGER.info('Removing orphaned file {}'.format(f['name']))
-                    files.delete(fileId=f['id']).execute()
+                    execute(files.delete(fileId=f['id']))
 
             except HttpError as ex:
                 LOGGER.warning('Caught exception: {}'.format(ex))
 
-            if args.sleep:
-                time.sleep(args.sleep)
+    checkpoint.close()
 
 
 if __name__ == '__main__':
@@ -1,14 +1,57 @@
 #!/usr/bin/env python3
 
+import asyncio
+import atexit
+import hashlib
+import heapq
+import io
+import itertools
+import json
 import logging
+import mmap
 import pickle
 import os
+import queue
+import random
+import socket
+import sqlite3
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from array import array
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+import httplib2
 from humanfriendly import format_size
 
 from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaIoBaseDownload
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 
+# Optional dependencies, only needed for what uses them: aiohttp for
+# AsyncDriveClient (download-drive-metadata.py --async-connections),
+# msgpack and zstandard for snapshots in those formats
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 LOGGER = logging.getLogger(__name__)
 LOG_FORMAT = '%(asctime)-15s %(levelname)-8s %(message)s'
 
@@ -19,21 +62,592 @@ SCOPES = ('https://www.googleapis.com/auth/drive',)
 FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
 
 
-def service_method_iter(request, response_key, service_method_next):
+class RateLimiter(object):
+    # Token bucket whose rate adapts to the quota actually available: it
+    # creeps up additively while requests succeed and is cut multiplicatively
+    # whenever the API reports a quota error.
+    def __init__(self, rate=10.0, burst=10, min_rate=0.5, max_rate=1000.0,
+                 increase=0.05, decrease=0.5, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = float(burst)
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def reserve(self, cost=1):
+        # Take cost tokens and return how long to wait before using them.
+        # Tokens may go negative, which reserves a slot in the future for
+        # this caller; concurrent callers then queue up behind it.
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= cost
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+    def acquire(self, cost=1):
+        wait = self.reserve(cost)
+        if wait > 0:
+            self.sleep(wait)
+
+    def on_success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_quota_error(self):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self.tokens = min(self.tokens, 0)
+        LOGGER.debug('Reduced request rate to {:.2f}/s'.format(self.rate))
+
+
+def get_error_reason(ex):
+    try:
+        content = json.loads(ex.content.decode('utf-8'))
+        return content['error']['errors'][0]['reason']
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+def get_endpoint(request):
+    # e.g. drive.files.list; batch requests have no method id
+    return getattr(request, 'methodId', None) or 'batch'
+
+
+def get_response_size(response):
+    # googleapiclient hands back the decoded response, so this is the size
+    # of its JSON encoding rather than of what came over the wire
+    return len(json.dumps(response)) if response else 0
+
+
+class RequestMetrics(object):
+    # Per-endpoint counts of requests (weighted by cost), response bytes,
+    # items listed, retries and errors by reason, with a histogram of request
+    # latencies, plus the total time spent waiting on the rate limiter.
+    # Comparing that wait with the time spent in requests tells whether a
+    # run is quota-bound or latency-bound.  If interval is given, start()
+    # logs a progress line every interval seconds and saves the metrics to
+    # path, if given, which close() does a last time.
+    LATENCY_BUCKETS = (0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, path=None, interval=None, rate_limiter=None, clock=time.monotonic):
+        self.path = path
+        self.interval = interval
+        self.rate_limiter = rate_limiter
+        self.clock = clock
+        self.started = clock()
+        self.endpoints = dict()
+        self.errors = defaultdict(int)
+        self.throttled_seconds = 0.0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.reporter = None
+
+    def get_stats(self, endpoint):
+        stats = self.endpoints.get(endpoint)
+        if stats is None:
+            stats = self.endpoints[endpoint] = dict(
+                requests=0, cost=0, bytes=0, items=0, retries=0, failures=0,
+                errors=defaultdict(int), seconds=0.0, max_seconds=0.0,
+                latency_counts=[0] * (len(self.LATENCY_BUCKETS) + 1))
+        return stats
+
+    def record_request(self, endpoint, seconds, num_bytes=0, cost=1):
+        with self.lock:
+            stats = self.get_stats(endpoint)
+            stats['requests'] += 1
+            stats['cost'] += cost
+            stats['bytes'] += num_bytes
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            bucket = 0
+            while bucket < len(self.LATENCY_BUCKETS) and seconds > self.LATENCY_BUCKETS[bucket]:
+                bucket += 1
+            stats['latency_counts'][bucket] += 1
+
+    def record_error(self, endpoint, error, retry):
+        with self.lock:
+            stats = self.get_stats(endpoint)
+            stats['errors'][str(error)] += 1
+            stats['retries' if retry else 'failures'] += 1
+            self.errors[str(error)] += 1
+
+    def record_items(self, endpoint, num_items):
+        with self.lock:
+            self.get_stats(endpoint)['items'] += num_items
+
+    def record_throttle(self, seconds):
+        with self.lock:
+            self.throttled_seconds += seconds
+
+    def get_percentile(self, latency_counts, p):
+        # Upper bound of the bucket holding the pth percentile latency
+        threshold = p * sum(latency_counts)
+        total = 0
+        for (bucket, count) in enumerate(latency_counts):
+            total += count
+            if count and total >= threshold:
+                break
+        else:
+            return None
+        return self.LATENCY_BUCKETS[bucket] if bucket < len(self.LATENCY_BUCKETS) else None
+
+    def summarize(self):
+        with self.lock:
+            elapsed = self.clock() - self.started
+            endpoints = dict()
+            for (endpoint, stats) in self.endpoints.items():
+                endpoints[endpoint] = dict(
+                    stats,
+                    errors=dict(stats['errors']),
+                    # [upper bound in seconds (None for the last), count]
+                    latency_counts=[
+                        [bound, count] for (bound, count) in zip(
+                            self.LATENCY_BUCKETS + (None,), stats['latency_counts'])],
+                    mean_seconds=(
+                        stats['seconds'] / stats['requests'] if stats['requests'] else None),
+                    p50_seconds=self.get_percentile(stats['latency_counts'], 0.5),
+                    p90_seconds=self.get_percentile(stats['latency_counts'], 0.9),
+                    p99_seconds=self.get_percentile(stats['latency_counts'], 0.99),
+                    items_per_second=stats['items'] / elapsed if elapsed > 0 else None)
+            return dict(
+                elapsed_seconds=elapsed,
+                throttled_seconds=self.throttled_seconds,
+                quota_errors=sum(
+                    count for (error, count) in self.errors.items()
+                    if error in [str(e) for e in RequestExecutor.QUOTA_ERRORS]),
+                errors=dict(self.errors),
+                rate=self.rate_limiter.rate if self.rate_limiter is not None else None,
+                endpoints=endpoints)
+
+    def format_progress(self):
+        summary = self.summarize()
+        elapsed = max(summary['elapsed_seconds'], 1e-9)
+        endpoints = summary['endpoints'].values()
+        num_requests = sum(stats['cost'] for stats in endpoints)
+        num_items = sum(stats['items'] for stats in endpoints)
+        return (
+            '{} requests ({:.1f}/s), {} items ({:.1f}/s), {} retries, {} quota errors, '
+            '{:.0f}% of time throttled{}'.format(
+                num_requests, num_requests / elapsed, num_items, num_items / elapsed,
+                sum(stats['retries'] for stats in endpoints), summary['quota_errors'],
+                100 * summary['throttled_seconds'] / elapsed,
+                '' if summary['rate'] is None else ', rate limit {:.1f}/s'.format(summary['rate'])))
+
+    def save(self):
+        if self.path is not None:
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self.summarize(), f, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.path)
+
+    def start(self):
+        if self.interval is not None:
+            self.reporter = threading.Thread(target=self.report, daemon=True)
+            self.reporter.start()
+
+    def report(self):
+        while not self.stopped.wait(self.interval):
+            LOGGER.info(self.format_progress())
+            self.save()
+
+    def close(self):
+        self.stopped.set()
+        if self.reporter is not None:
+            self.reporter.join()
+            self.reporter = None
+            LOGGER.info(self.format_progress())
+        self.save()
+
+
+class RequestExecutor(object):
+    # Maximum number of retries by error reason, falling back to HTTP status.
+    DEFAULT_RETRY_POLICIES = {
+        'rateLimitExceeded': 10,
+        'userRateLimitExceeded': 10,
+        'sharingRateLimitExceeded': 5,
+        'backendError': 5,
+        'internalError': 5,
+        'transientError': 5,
+        429: 10,
+        500: 5,
+        502: 5,
+        503: 5,
+        504: 5,
+        'connectionError': 5,
+    }
+    QUOTA_ERRORS = ('rateLimitExceeded', 'userRateLimitExceeded', 'sharingRateLimitExceeded', 429)
+    # Requests which may have taken effect when they fail with a server or
+    # connection error, so retrying them could create a second copy,
+    # permission or file; quota errors are rejected up front and still retried
+    NON_IDEMPOTENT_METHODS = ('drive.files.copy', 'drive.files.create', 'drive.permissions.create')
+
+    def __init__(self, rate_limiter=None, retry_policies=DEFAULT_RETRY_POLICIES,
+                 base_delay=1.0, max_delay=64.0, sleep=time.sleep, metrics=None):
+        self.rate_limiter = rate_limiter
+        self.metrics = metrics
+        self.retry_policies = retry_policies
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.sleep = sleep
+
+    def classify(self, ex):
+        if isinstance(ex, HttpError):
+            reason = get_error_reason(ex)
+            if reason in self.retry_policies:
+                return reason
+            else:
+                return ex.resp.status
+        else:
+            return 'connectionError'
+
+    def should_retry(self, ex, attempt, endpoint='batch', idempotent=True):
+        # Errors of requests in a batch are checked here too, so count them
+        # here against endpoint
+        error = self.classify(ex)
+        if error in self.QUOTA_ERRORS and self.rate_limiter is not None:
+            self.rate_limiter.on_quota_error()
+        retry = (
+            attempt < self.retry_policies.get(error, 0) and
+            (idempotent or error in self.QUOTA_ERRORS))
+        if self.metrics is not None:
+            self.metrics.record_error(endpoint, error, retry)
+        return retry
+
+    def is_idempotent(self, request):
+        # A batch is retried whole, so it is only as idempotent as the least
+        # idempotent request in it (googleapiclient keeps them in _requests)
+        batch_requests = getattr(request, '_requests', None)
+        if batch_requests is not None:
+            return all(self.is_idempotent(r) for r in batch_requests.values())
+        return get_endpoint(request) not in self.NON_IDEMPOTENT_METHODS
+
+    def throttle(self, cost):
+        if self.rate_limiter is not None:
+            if self.metrics is not None:
+                start = time.monotonic()
+                self.rate_limiter.acquire(cost)
+                self.metrics.record_throttle(time.monotonic() - start)
+            else:
+                self.rate_limiter.acquire(cost)
+
+    def backoff(self, attempt):
+        # Exponential backoff with full jitter
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def execute(self, request, cost=1, idempotent=None, **kwargs):
+        # cost is the number of API calls the request counts as, e.g. the
+        # number of requests in a batch; unless idempotent is given, requests
+        # of NON_IDEMPOTENT_METHODS (and batches with any) are only retried
+        # on quota errors
+        endpoint = get_endpoint(request)
+        if idempotent is None:
+            idempotent = self.is_idempotent(request)
+        attempt = 0
+        while True:
+            self.throttle(cost)
+            start = time.monotonic()
+            try:
+                response = request.execute(**kwargs)
+            except (HttpError, httplib2.HttpLib2Error, ConnectionError, socket.timeout) as ex:
+                if not self.should_retry(ex, attempt, endpoint, idempotent):
+                    raise
+                delay = self.backoff(attempt)
+                LOGGER.warning('Retrying in {:.1f}s after exception: {}'.format(delay, ex))
+                self.sleep(delay)
+                attempt += 1
+            else:
+                if self.metrics is not None:
+                    self.metrics.record_request(
+                        endpoint, time.monotonic() - start, get_response_size(response), cost)
+                if self.rate_limiter is not None:
+                    self.rate_limiter.on_success()
+                return response
+
+
+EXECUTOR = RequestExecutor()
+
+
+def configure_requests(rate=None, max_rate=None, retry_policies=None, metrics_path=None,
+                       progress_interval=None):
+    # Requests are not rate limited unless rate or max_rate is given, which
+    # starts an adaptive RateLimiter.  If metrics_path or progress_interval
+    # is given, requests are measured and the metrics reported as the process
+    # runs and when it exits
+    if (rate is not None or max_rate is not None) and EXECUTOR.rate_limiter is None:
+        EXECUTOR.rate_limiter = RateLimiter()
+    rate_limiter = EXECUTOR.rate_limiter
+    if max_rate is not None:
+        rate_limiter.max_rate = max_rate
+        rate_limiter.rate = min(rate_limiter.rate, max_rate)
+    if rate is not None:
+        rate_limiter.rate = rate
+    if retry_policies is not None:
+        EXECUTOR.retry_policies = dict(EXECUTOR.retry_policies, **retry_policies)
+    if (metrics_path is not None or progress_interval is not None) and EXECUTOR.metrics is None:
+        EXECUTOR.metrics = RequestMetrics(
+            path=metrics_path, interval=progress_interval, rate_limiter=rate_limiter)
+        EXECUTOR.metrics.start()
+        atexit.register(EXECUTOR.metrics.close)
+
+
+def execute(request, cost=1, idempotent=None, **kwargs):
+    return EXECUTOR.execute(request, cost=cost, idempotent=idempotent, **kwargs)
+
+
+def service_page_iter(request, response_key, service_method_next):
     while request is not None:
-        response = request.execute()
+        response = execute(request)
         items = response.get(response_key, [])
-        for (i, item) in enumerate(items):
-            yield (
+        if EXECUTOR.metrics is not None:
+            EXECUTOR.metrics.record_items(get_endpoint(request), len(items))
+        yield [
+            (
                 item,
                 dict(next_page_token=response.get('nextPageToken'),
                      item_index=i,
                      num_items=len(items)),
             )
+            for (i, item) in enumerate(items)
+        ]
         request = service_method_next(request, response)
 
 
-def get_file_by_path(path, files, fields=('id', 'name')):
+def service_method_iter(request, response_key, service_method_next):
+    for page in service_page_iter(request, response_key, service_method_next):
+        for (item, batch_info) in page:
+            yield (item, batch_info)
+
+
+def get_query_shards(by='modifiedTime', num_shards=16, start_time=None, end_time=None):
+    # Split the space of files into disjoint query clauses which together
+    # match every file: num_shards modifiedTime ranges between start_time and
+    # end_time (as seconds since the epoch; open-ended at either end), or the
+    # three kinds of mimeType (folders, other Google Apps files, and the rest)
+    if by == 'mimeType':
+        return [
+            "mimeType = '{}'".format(FOLDER_MIME_TYPE),
+            "mimeType contains 'application/vnd.google-apps' and mimeType != '{}'".format(
+                FOLDER_MIME_TYPE),
+            "not mimeType contains 'application/vnd.google-apps'",
+        ]
+    elif by == 'modifiedTime':
+        if start_time is None:
+            # Launch of Google Docs, before which nothing can be modified
+            start_time = time.mktime((2006, 1, 1, 0, 0, 0, 0, 0, 0))
+        if end_time is None:
+            end_time = time.time()
+        if num_shards < 2:
+            return [None]
+        cutoffs = [
+            time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(
+                start_time + (end_time - start_time) * i / num_shards))
+            for i in range(1, num_shards)
+        ]
+        return (
+            ["modifiedTime < '{}'".format(cutoffs[0])] +
+            ["modifiedTime >= '{}' and modifiedTime < '{}'".format(lower, upper)
+             for (lower, upper) in zip(cutoffs, cutoffs[1:])] +
+            ["modifiedTime >= '{}'".format(cutoffs[-1])]
+        )
+    else:
+        raise ValueError('cannot shard by {}'.format(by))
+
+
+class ShardedLister(object):
+    # Lists files by paging the query shards from get_query_shards
+    # concurrently, each on a worker with its own service from
+    # service_factory, at the maximum page size.  Pages are yielded as they
+    # arrive, without files already seen (a file modified during the listing
+    # can move between shards) or in skip_ids.  Files moving between shards
+    # can also be missed, as with any listing of a changing drive; a later
+    # sync from the changes feed picks them up.
+    PAGE_SIZE = 1000
+
+    def __init__(self, service_factory, shards, num_workers=None, page_size=PAGE_SIZE,
+                 skip_ids=None):
+        self.service_factory = service_factory
+        self.shards = shards
+        self.num_workers = num_workers or len(shards)
+        self.page_size = page_size
+        self.skip_ids = skip_ids
+
+    def iter_pages(self, new_request, response_key='files'):
+        # new_request(files, q) returns the request listing the files
+        # matching q, a shard, with the given files resource
+        seen = set(self.skip_ids or ())
+        pages = queue.Queue(maxsize=2 * self.num_workers)
+        stop = threading.Event()
+        LOGGER.debug('Listing {} shards with {} workers ...'.format(
+            len(self.shards), self.num_workers))
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            futures = [
+                executor.submit(self.list_shard, new_request, response_key, shard, pages, stop)
+                for shard in self.shards
+            ]
+            try:
+                num_listed = 0
+                while num_listed < len(futures):
+                    page = pages.get()
+                    if page is None:
+                        num_listed += 1
+                        continue
+                    page = [(item, batch_info) for (item, batch_info) in page
+                            if item['id'] not in seen]
+                    seen.update(item['id'] for (item, _) in page)
+                    if page:
+                        yield page
+            finally:
+                stop.set()
+            for future in futures:
+                # Raise any exception from the workers
+                future.result()
+
+    def list_shard(self, new_request, response_key, shard, pages, stop):
+        try:
+            files = self.service_factory().files()
+            request = new_request(files, shard)
+            for page in service_page_iter(request, response_key, files.list_next):
+                if not self.put(pages, page, stop):
+                    return
+        finally:
+            # Tell the consumer this shard is finished
+            self.put(pages, None, stop)
+
+    def put(self, pages, page, stop):
+        # Wait for room in the queue unless the consumer has stopped
+        while not stop.is_set():
+            try:
+                pages.put(page, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+
+def escape_query_string(value):
+    return value.replace('\\', '\\\\').replace("'", "\\'")
+
+
+class PathCache(object):
+    # Resolved (parent id, name) -> id entries, i.e. the edges of a trie of
+    # paths rooted at 'root', with LRU eviction beyond max_size entries and
+    # expiry after ttl seconds.  If path is given, entries are loaded from
+    # and saved to that JSON file so they survive between runs.
+    def __init__(self, max_size=100000, ttl=24 * 60 * 60, path=None, clock=time.time):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path
+        self.clock = clock
+        self.entries = OrderedDict()
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def get(self, parent_id, name):
+        key = (parent_id, name)
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        (file_id, updated) = entry
+        if self.ttl is not None and self.clock() - updated > self.ttl:
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return file_id
+
+    def set(self, parent_id, name, file_id):
+        key = (parent_id, name)
+        self.entries[key] = (file_id, self.clock())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, parent_id, name):
+        self.entries.pop((parent_id, name), None)
+
+    def load(self):
+        LOGGER.debug('Reading path cache from {}'.format(self.path))
+        with open(self.path) as f:
+            for (parent_id, name, file_id, updated) in json.load(f):
+                self.entries[(parent_id, name)] = (file_id, updated)
+
+    def save(self):
+        if self.path is not None:
+            LOGGER.debug('Writing path cache to {}'.format(self.path))
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump([
+                    (parent_id, name, file_id, updated)
+                    for ((parent_id, name), (file_id, updated)) in self.entries.items()
+                ], f)
+            os.replace(tmp_path, self.path)
+
+
+# The helpers below build the queries and keep the path cache for both the
+# functions using a files resource and their async_ versions using an
+# AsyncDriveClient, which only differ in how requests are made.
+
+def get_child_by_name_params(parent_id, name, fields):
+    # Trashed files keep their parents, so are left out explicitly
+    return dict(
+        q="'{}' in parents and name = '{}' and trashed = false".format(
+            parent_id, escape_query_string(name)),
+        fields='nextPageToken, files({})'.format(', '.join(fields)),
+        pageSize=100)
+
+
+def keep_first_child(child, f, name):
+    # Of several files named name in a folder, the first listed is used
+    if child is None:
+        return f
+    LOGGER.warning('Ignoring file {} also named {}'.format(f['id'], name))
+    return child
+
+
+def iter_path_lookups(names, path_cache):
+    # Resolves the folders along names from root as far as possible from
+    # path_cache, yielding (parent_id, name) for each child to look up in
+    # between, to be sent back the file found (or None if there is none).
+    # The file at the end of the path is always looked up, so that one
+    # since deleted, moved or trashed is never returned from the cache.
+    # Returns that file, or None if an entry from path_cache turned out to
+    # be stale, after invalidating the entries used.
+    parent_id = 'root'
+    cached_keys = []
+    for (i, name) in enumerate(names):
+        file_id = None
+        if path_cache is not None and i + 1 < len(names):
+            file_id = path_cache.get(parent_id, name)
+        if file_id is None:
+            f = yield (parent_id, name)
+            if f is None:
+                if cached_keys:
+                    break
+                raise Exception('No file {} found'.format(name))
+            if path_cache is not None:
+                path_cache.set(parent_id, name, f['id'])
+        else:
+            cached_keys.append((parent_id, name))
+            f = dict(id=file_id, name=name)
+        parent_id = f['id']
+
+    else:
+        return f
+
+    for (parent_id, name) in cached_keys:
+        path_cache.invalidate(parent_id, name)
+    return None
+
+
+def split_path(path, fields):
+    # Returns the names along path (none for the root) and the fields to
+    # get of the file there, which always include id and name
     fields = tuple(set(fields).union({'id', 'name'}))
 
     if path.startswith('/'):
@@ -42,53 +656,274 @@ def get_file_by_path(path, files, fields=('id', 'name')):
         path = path[:-1]
 
     LOGGER.debug('Getting file at normalized path {} ...'.format(path))
-    if path:
-        parent_id = 'root'
+    return (path.split('/') if path else [], fields)
+
+
+def get_child_by_name(files, parent_id, name, fields):
+    request = files.list(**get_child_by_name_params(parent_id, name, fields))
+    child = None
+    for (f, _) in service_method_iter(request, 'files', files.list_next):
+        child = keep_first_child(child, f, name)
+    return child
+
+
+def resolve_path(names, files, fields, path_cache):
+    # Returns None if an entry from path_cache turned out to be stale, after
+    # invalidating the entries used.
+    lookups = iter_path_lookups(names, path_cache)
+    f = None
+    try:
+        while True:
+            (parent_id, name) = lookups.send(f)
+            f = get_child_by_name(files, parent_id, name, fields)
+    except StopIteration as ex:
+        return ex.value
+
+
+def get_file_by_path(path, files, fields=('id', 'name'), path_cache=None):
+    (names, fields) = split_path(path, fields)
+    if names:
         f = None
-        for name in path.split('/'):
-            request = files.list(
-                q="'{}' in parents and name = '{}'".format(parent_id, name),
-                fields='nextPageToken, files({})'.format(', '.join(fields)),
-                pageSize=100)
-            parent_id = None
-            for (f, _) in service_method_iter(request, 'files', files.list_next):
-                if parent_id is None:
-                    parent_id = f['id']
-                else:
-                    LOGGER.warning('Ignoring file {} also named {}'.format(f['id'], name))
-            if parent_id is None:
-                raise Exception('No file {} found'.format(name))
+        while f is None:
+            f = resolve_path(names, files, fields, path_cache)
+            if f is None:
+                LOGGER.debug('Cached path {} is stale, resolving again'.format(path))
+        return f
+
+    else:
+        return execute(files.get(fileId='root', fields=', '.join(fields)))
+
+
+def get_files_by_path(paths, files, fields=('id', 'name'), path_cache=None):
+    # Paths sharing a prefix only look up the shared components once
+    if path_cache is None:
+        path_cache = PathCache()
+    for path in paths:
+        yield get_file_by_path(path, files, fields=fields, path_cache=path_cache)
+
+
+def list_children_params(parent_ids, fields):
+    # List the (untrashed) children of several folders with one query, then
+    # split the results back out by parent with add_child.
+    list_fields = tuple(set(fields).union({'parents'}))
+    return dict(
+        q='({}) and trashed = false'.format(
+            ' or '.join("'{}' in parents".format(parent_id) for parent_id in parent_ids)),
+        fields='nextPageToken, files({})'.format(', '.join(list_fields)),
+        pageSize=1000)
+
+
+def add_child(children, f, fields):
+    # Add f to the lists in children of those of its parents listed
+    f_parent_ids = f.get('parents', [])
+    if 'parents' not in fields:
+        f = dict((k, v) for (k, v) in f.items() if k != 'parents')
+    for parent_id in f_parent_ids:
+        if parent_id in children:
+            children[parent_id].append(f)
+
+
+def list_children(files, parent_ids, fields):
+    request = files.list(**list_children_params(parent_ids, fields))
+    children = dict((parent_id, []) for parent_id in parent_ids)
+    for (f, _) in service_method_iter(request, 'files', files.list_next):
+        add_child(children, f, fields)
+    return children
+
+
+def walk(path, files, fields=('id', 'name', 'mimeType'), folders_per_query=20,
+         files_factory=None, num_workers=4, path_cache=None):
+    # Breadth-first walk listing up to folders_per_query folders per query.
+    # If files_factory is given, up to num_workers queries run concurrently,
+    # each worker using its own files resource from the factory.  A folder
+    # with several parents is yielded under each but only walked once.
+    fields = tuple(set(fields).union({'id', 'name', 'mimeType'}))
 
-        if f is None:
-            raise Exception('Error getting file at {}'.format(path))
+    local = threading.local()
+
+    def list_group(group):
+        if files_factory is None:
+            group_files = files
         else:
-            return f
+            if getattr(local, 'files', None) is None:
+                local.files = files_factory()
+            group_files = local.files
+        return (group, list_children(group_files, [parent['id'] for parent in group], fields))
+
+    root = get_file_by_path(path, files, fields=fields, path_cache=path_cache)
+    unlisted = deque([root])
+    seen = {root['id']}
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        pending = deque()
+        while unlisted or pending:
+            while unlisted and len(pending) < (1 if files_factory is None else num_workers):
+                group = pop_group(unlisted, folders_per_query)
+                if files_factory is None:
+                    future = Future()
+                    future.set_result(list_group(group))
+                else:
+                    future = executor.submit(list_group, group)
+                pending.append(future)
 
-    else:
-        return files.get(fileId='root', fields=', '.join(fields)).execute()
+            (group, children) = pending.popleft().result()
+            for entry in walk_group(group, children, seen, unlisted):
+                yield entry
 
 
-def walk(path, files, fields=('id', 'name', 'mimeType')):
-    fields = tuple(set(fields).union({'id', 'name', 'mimeType'}))
+def pop_group(unlisted, folders_per_query):
+    # The next (up to) folders_per_query folders to list in one query
+    return [unlisted.popleft() for _ in range(min(folders_per_query, len(unlisted)))]
+
 
-    stack = [get_file_by_path(path, files, fields=fields)]
-    while stack:
-        parent = stack.pop()
-        request = files.list(
-            q="'{}' in parents".format(parent['id']),
-            fields='nextPageToken, files({})'.format(', '.join(fields)),
-            pageSize=100)
+def walk_group(group, children, seen, unlisted):
+    # Split the children of each folder in group into folders and files,
+    # queueing folders not yet seen to be walked
+    for parent in group:
         dir_entries = []
         file_entries = []
-        for (f, _) in service_method_iter(request, 'files', files.list_next):
+        for f in children[parent['id']]:
             if f.get('mimeType') == FOLDER_MIME_TYPE:
                 dir_entries.append(f)
-                stack.append(f)
+                if f['id'] not in seen:
+                    seen.add(f['id'])
+                    unlisted.append(f)
             else:
                 file_entries.append(f)
         yield (parent, dir_entries, file_entries)
 
 
+class Checkpoint(object):
+    # Journal of progress through a paginated listing, so a long-running
+    # script can resume where it stopped.  Records are buffered and written
+    # with an fsync every flush_every items or flush_interval seconds, and at
+    # the end of each page:
+    #   {"page_token": ...}  the page to restart from
+    #   {"done": id}         an item on that page already handled
+    #   {"offset": n}        size of output_file once those items were written
+    #   {"complete": true}   the listing finished
+    #   {"config": ...}      how the listing was made, e.g. its sharding
+    # If output_file is given it is flushed and fsync'd before the journal,
+    # and on resume should be truncated to offset, so that it holds exactly
+    # the items recorded as done.  A listing can only be resumed with the
+    # config it was started with, as the page and items done mean nothing
+    # to another; resuming with a different one raises ValueError.
+    def __init__(self, path, output_file=None, flush_every=100, flush_interval=5.0,
+                 clock=time.monotonic, config=None):
+        self.path = path
+        self.output_file = output_file
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.clock = clock
+
+        self.page_token = None
+        self.done = set()
+        self.offset = None
+        self.complete = False
+        # Journals written before configs were recorded have none to check
+        self.config = config
+        if os.path.exists(path):
+            self.load()
+        if self.complete:
+            LOGGER.info('Previous run recorded in {} completed; starting over'.format(path))
+            self.page_token = None
+            self.done = set()
+            self.offset = None
+            self.complete = False
+        elif self.page_token is not None or self.done:
+            if self.config != config:
+                raise ValueError('{} was recorded with {}, not {}; resume with the same '
+                                 'options or remove it to start over'.format(
+                                     path, self.config, config))
+            LOGGER.info('Resuming from {} ({} items done on current page)'.format(
+                path, len(self.done)))
+        self.config = config
+
+        # Compact the journal to the state just loaded
+        self.buffer = []
+        self.journal = open(path + '.tmp', 'w')
+        self.write([dict(config=config)] + [dict(page_token=self.page_token)] +
+                   [dict(done=item_id) for item_id in sorted(self.done)] +
+                   ([dict(offset=self.offset)] if self.offset is not None else []))
+        os.replace(path + '.tmp', path)
+        self.last_flush = clock()
+
+    @property
+    def resuming(self):
+        return self.page_token is not None or bool(self.done)
+
+    def load(self):
+        LOGGER.debug('Reading checkpoint {}'.format(self.path))
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Partly written record from a crash
+                    break
+                if 'page_token' in record:
+                    self.page_token = record['page_token']
+                    self.done = set()
+                elif 'done' in record:
+                    self.done.add(record['done'])
+                elif 'offset' in record:
+                    self.offset = record['offset']
+                elif 'complete' in record:
+                    self.complete = True
+                elif 'config' in record:
+                    self.config = record['config']
+
+    def write(self, records):
+        for record in records:
+            self.journal.write(json.dumps(record) + '\n')
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+
+    def flush(self):
+        if self.output_file is not None:
+            self.output_file.flush()
+            os.fsync(self.output_file.fileno())
+            self.buffer.append(dict(offset=self.output_file.tell()))
+        self.write(self.buffer)
+        self.buffer = []
+        self.last_flush = self.clock()
+
+    def is_done(self, item_id):
+        return item_id in self.done
+
+    def mark_done(self, item_id):
+        self.done.add(item_id)
+        self.buffer.append(dict(done=item_id))
+        if (len(self.buffer) >= self.flush_every or
+                self.clock() - self.last_flush >= self.flush_interval):
+            self.flush()
+
+    def end_page(self, next_page_token):
+        self.page_token = next_page_token
+        self.done = set()
+        self.buffer.append(dict(page_token=next_page_token))
+        if next_page_token is None:
+            self.complete = True
+            self.buffer.append(dict(complete=True))
+        self.flush()
+
+    def iter(self, items, key=lambda item: item['id']):
+        # Filter (item, batch_info) pairs from service_method_iter (or one
+        # page of service_page_iter) down to those not yet done.  An item is
+        # marked done once the caller asks for the next one, and the page is
+        # recorded as finished after its last item.
+        for (item, batch_info) in items:
+            item_id = key(item)
+            if item_id not in self.done:
+                yield (item, batch_info)
+                self.mark_done(item_id)
+            if batch_info['item_index'] + 1 == batch_info['num_items']:
+                self.end_page(batch_info['next_page_token'])
+
+    def close(self):
+        self.flush()
+        self.journal.close()
+
+
 def add_handler(logger, handler, level=logging.INFO, fmt=LOG_FORMAT):
     handler.setLevel(level)
     handler.setFormatter(logging.Formatter(fmt))
@@ -133,21 +968,112 @@ def configure_logging(log_path=None):
         add_handler(LOGGER, logging.FileHandler(log_path, encoding='utf-8'), level=logging.DEBUG)
 
 
+def is_owned_by(metadata, email):
+    return any(
+        p.get('type') == 'user' and p.get('role') == 'owner' and p.get('emailAddress') == email
+        for p in metadata.get('permissions') or [])
+
+
 class FileCache(object):
-    def __init__(self, files):
+    # Whether files (typically parent folders) are owned by the authenticated
+    # user.  Lookups check, in order: an in-memory LRU of up to max_size
+    # entries; ownership loaded from a metadata snapshot; a SQLite store at
+    # path (one per account) whose entries expire after ttl seconds; and
+    # finally the API, batched per page of files if service is given.
+    BATCH_SIZE = 100
+
+    def __init__(self, files, max_size=100000, path=None, ttl=24 * 60 * 60, service=None,
+                 clock=time.time):
         self.files = files
-        self.file_id_map = {}
+        self.max_size = max_size
+        self.ttl = ttl
+        self.service = service
+        self.clock = clock
+        self.file_id_map = OrderedDict()
+        self.snapshot = {}
+        self.db = None
+        if path is not None:
+            LOGGER.debug('Opening file cache {}'.format(path))
+            self.db = sqlite3.connect(path)
+            self.db.execute(
+                'CREATE TABLE IF NOT EXISTS file_owned '
+                '(file_id TEXT PRIMARY KEY, owned INTEGER, updated REAL)')
+
+    def load_metadata(self, metadata_iter, email):
+        for metadata in metadata_iter:
+            if not metadata.get('error'):
+                self.snapshot[metadata['id']] = is_owned_by(metadata, email)
+
+    def _lookup(self, file_id):
+        if file_id in self.file_id_map:
+            self.file_id_map.move_to_end(file_id)
+            return self.file_id_map[file_id]
+        if file_id in self.snapshot:
+            return self.snapshot[file_id]
+        if self.db is not None:
+            row = self.db.execute(
+                'SELECT owned, updated FROM file_owned WHERE file_id = ?', (file_id,)).fetchone()
+            if row is not None and (self.ttl is None or self.clock() - row[1] <= self.ttl):
+                self._remember(file_id, bool(row[0]))
+                return bool(row[0])
+        return None
+
+    def _remember(self, file_id, owned):
+        self.file_id_map[file_id] = owned
+        self.file_id_map.move_to_end(file_id)
+        while len(self.file_id_map) > self.max_size:
+            self.file_id_map.popitem(last=False)
+
+    def _set(self, file_id, owned):
+        self._remember(file_id, owned)
+        if self.db is not None:
+            self.db.execute(
+                'INSERT OR REPLACE INTO file_owned (file_id, owned, updated) VALUES (?, ?, ?)',
+                (file_id, int(owned), self.clock()))
 
     def _get(self, file_id):
-        if file_id not in self.file_id_map:
-            file_response = self.files.get(fileId=file_id, fields="owners").execute()
-            self.file_id_map[file_id] = any(owner['me'] for owner in file_response['owners'])
+        owned = self._lookup(file_id)
+        if owned is None:
+            file_response = execute(self.files.get(fileId=file_id, fields="owners"))
+            owned = any(owner['me'] for owner in file_response['owners'])
+            self._set(file_id, owned)
 
-        return self.file_id_map[file_id]
+        return owned
+
+    def prefetch(self, file_ids):
+        # Look up all unknown files at once, in batch requests; failures are
+        # left to be retried one at a time by is_owned
+        if self.service is None:
+            return
+
+        file_ids = sorted(set(file_id for file_id in file_ids if self._lookup(file_id) is None))
+
+        def callback(request_id, response, exception):
+            if exception is None:
+                self._set(request_id, any(owner['me'] for owner in response['owners']))
+
+        for i in range(0, len(file_ids), self.BATCH_SIZE):
+            batch_file_ids = file_ids[i:i + self.BATCH_SIZE]
+            batch = self.service.new_batch_http_request(callback=callback)
+            for file_id in batch_file_ids:
+                batch.add(self.files.get(fileId=file_id, fields="owners"), request_id=file_id)
+            execute(batch, cost=len(batch_file_ids))
+
+        self.commit()
 
     def is_owned(self, file_id):
         return self._get(file_id)
 
+    def commit(self):
+        if self.db is not None:
+            self.db.commit()
+
+    def close(self):
+        if self.db is not None:
+            self.db.commit()
+            self.db.close()
+            self.db = None
+
 
 def remove_user_permissions(perms, file_id, email_address):
     perm_request = perms.list(
@@ -156,59 +1082,1682 @@ def remove_user_permissions(perms, file_id, email_address):
     for (p, _) in service_method_iter(perm_request, 'permissions', perms.list_next):
         if p['type'] == 'user' and p['emailAddress'] == email_address:
             LOGGER.debug('Removing permission for {}'.format(email_address))
-            perms.delete(fileId=file_id, permissionId=p['id']).execute()
+            execute(perms.delete(fileId=file_id, permissionId=p['id']))
+
+
+class OwnershipTransferer(object):
+    # Transfers ownership of files to to_email in rounds: the permissions of
+    # all pending files are looked up in batch requests, then the new owner's
+    # permission is updated (or created) in batch requests.  Files whose
+    # lookup or mutation fails with a retryable error are requeued for the
+    # next round, after a backoff; both steps are safe to repeat.
+    BATCH_SIZE = 100
+    MAX_ROUNDS = 5
+
+    def __init__(self, service, to_email, batch_size=BATCH_SIZE, max_rounds=MAX_ROUNDS):
+        self.service = service
+        self.perms = service.permissions()
+        self.to_email = to_email
+        self.batch_size = batch_size
+        self.max_rounds = max_rounds
+
+    def transfer(self, files):
+        # Return a dict mapping each file id to None on success, or else the
+        # HTTP status of the error that made us give up on it
+        results = {}
+        pending = list(files)
+        for attempt in range(self.max_rounds):
+            requeued = []
+            for i in range(0, len(pending), self.batch_size):
+                requeued.extend(self.transfer_batch(pending[i:i + self.batch_size], results))
+            if not requeued:
+                break
+            pending = [f for (f, _) in requeued]
+            if attempt + 1 < self.max_rounds:
+                delay = EXECUTOR.backoff(attempt)
+                LOGGER.warning('Requeueing {} files in {:.1f}s'.format(len(pending), delay))
+                EXECUTOR.sleep(delay)
+        else:
+            for (f, ex) in requeued:
+                self.set_error(f, ex, results)
+        return results
+
+    def transfer_batch(self, files, results):
+        requeued = []
+        mutations = []
+
+        def lookup_callback(request_id, response, exception):
+            f = files[int(request_id)]
+            if exception is not None:
+                self.handle_error(f, exception, results, requeued)
+                return
+            perm_id = self.find_permission(response.get('permissions', []))
+            if perm_id is None and response.get('nextPageToken') is not None:
+                # Rare enough to page through on its own
+                try:
+                    perm_id = self.find_permission(
+                        p for (p, _) in service_method_iter(
+                            self.perms.list_next(lookup_requests[int(request_id)], response),
+                            'permissions', self.perms.list_next))
+                except HttpError as ex:
+                    self.handle_error(f, ex, results, requeued)
+                    return
+            mutations.append((f, self.new_mutation_request(f['id'], perm_id)))
+
+        lookup_requests = [self.new_lookup_request(f['id']) for f in files]
+        self.execute_batch(lookup_requests, lookup_callback)
+
+        def mutation_callback(request_id, response, exception):
+            f = mutations[int(request_id)][0]
+            if exception is not None:
+                self.handle_error(f, exception, results, requeued)
+            else:
+                LOGGER.info('Changed owner of {} to {}'.format(f['name'], self.to_email))
+                results[f['id']] = None
+
+        self.execute_batch([request for (_, request) in mutations], mutation_callback)
+        return requeued
+
+    def execute_batch(self, requests, callback):
+        if not requests:
+            return
+        batch = self.service.new_batch_http_request(callback=callback)
+        for (i, request) in enumerate(requests):
+            batch.add(request, request_id=str(i))
+        execute(batch, cost=len(requests))
+
+    def new_lookup_request(self, file_id):
+        return self.perms.list(
+            fileId=file_id, pageSize=100,
+            fields="nextPageToken, permissions(id, type, emailAddress)")
+
+    def find_permission(self, perms):
+        for p in perms:
+            if p['type'] == 'user' and p.get('emailAddress') == self.to_email:
+                return p['id']
+        return None
+
+    def new_mutation_request(self, file_id, perm_id):
+        if perm_id is not None:
+            LOGGER.debug('Updating permission to owner for {}'.format(self.to_email))
+            return self.perms.update(
+                fileId=file_id, permissionId=perm_id,
+                transferOwnership=True,
+                body={'role': 'owner'},
+            )
+        else:
+            LOGGER.debug('Adding owner permission for {}'.format(self.to_email))
+            return self.perms.create(
+                fileId=file_id,
+                transferOwnership=True,
+                enforceSingleParent=True,
+                body={'role': 'owner', 'type': 'user', 'emailAddress': self.to_email},
+            )
+
+    def handle_error(self, f, ex, results, requeued):
+        # Per-item errors in a batch are not retried by execute, so check the
+        # same retry policy here (which also slows down on quota errors)
+        if EXECUTOR.should_retry(ex, 0):
+            requeued.append((f, ex))
+        else:
+            self.set_error(f, ex, results)
+
+    def set_error(self, f, ex, results):
+        LOGGER.warning('Failed to change owner of {}: {}'.format(f['name'], ex))
+        results[f['id']] = ex.resp.status
+
+
+def get_permissions_signature(perms):
+    return tuple(sorted(
+        (p.get('type'), p.get('role'), p.get('emailAddress')) for p in perms or []))
+
+
+def find_duplicates(drive_files, email=None, same_path=True):
+    # Yield groups of duplicate files (as dicts of the fields DuplicateRemover
+    # needs), in two steps so that only files sharing a size are examined
+    # further: files with content are bucketed by size, then each bucket
+    # with several files is split by checksum and permissions signature (and
+    # by name and parents, if same_path).  Only files owned by email, if
+    # given, are considered.  Files without md5Checksums (Google Docs and
+    # the like) cannot be compared, so are counted and skipped.
+    size_buckets = defaultdict(list)
+    num_skipped = 0
+    for df in drive_files.list():
+        if df.trashed or df.error:
+            continue
+        if df.md5_checksum is not None:
+            size_buckets[df.own_size].append(df.id)
+        elif df.mime_type != FOLDER_MIME_TYPE and (
+                email is None or
+                ('user', 'owner', email) in get_permissions_signature(df.permissions)):
+            num_skipped += 1
+    if num_skipped:
+        LOGGER.info('Skipped {} files without md5Checksums (e.g. Google Docs), whose '
+                    'content cannot be compared'.format(num_skipped))
+
+    for file_ids in size_buckets.values():
+        if len(file_ids) < 2:
+            continue
+        groups = defaultdict(list)
+        for file_id in file_ids:
+            df = drive_files.get(file_id)
+            signature = get_permissions_signature(df.permissions)
+            if email is not None and ('user', 'owner', email) not in signature:
+                continue
+            key = (df.md5_checksum, signature)
+            if same_path:
+                key += (df.name, tuple(sorted(df.parent_ids)))
+            groups[key].append(dict(
+                id=df.id, name=df.name, path=df.path, size=df.own_size,
+                md5Checksum=df.md5_checksum, permissions=df.permissions,
+                parents=df.parent_ids, createdTime=(df.metadata or {}).get('createdTime')))
+        for group in groups.values():
+            if len(group) > 1:
+                yield group
+
+
+class DuplicateRemover(object):
+    # Deletes all but one file of each group of duplicates from
+    # find_duplicates.  Groups are handled a chunk of at least chunk_size
+    # files at a time: every file is first fetched again in batch requests,
+    # and only files that still exist untrashed, owned by us, with the same
+    # size, checksum and permissions (and name and parents, if same_path) as
+    # the rest of their group are kept in it.  The keeper of each group is
+    # then chosen by policy and the others deleted in batch requests.  As in
+    # OwnershipTransferer, requests failing with a retryable error are
+    # requeued for the next round, after a backoff; both steps are safe to
+    # repeat.
+    KEEP_POLICIES = ('first', 'oldest', 'shortest-path', 'most-shared')
+    VERIFY_FIELDS = ('id, name, parents, size, md5Checksum, trashed, createdTime, '
+                     'owners(me), permissions(type, role, emailAddress)')
+    BATCH_SIZE = 100
+    CHUNK_SIZE = 1000
+    MAX_ROUNDS = 5
+
+    def __init__(self, service, keep='first', same_path=True, batch_size=BATCH_SIZE,
+                 chunk_size=CHUNK_SIZE, max_rounds=MAX_ROUNDS):
+        if keep not in self.KEEP_POLICIES:
+            raise ValueError('unknown keep policy {}'.format(keep))
+        self.service = service
+        self.files = service.files()
+        self.keep = keep
+        self.same_path = same_path
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.max_rounds = max_rounds
+
+    @classmethod
+    def choose_keeper(cls, group, keep='first'):
+        # Groups are in listing order, which breaks ties
+        if keep == 'oldest':
+            return min(group, key=lambda f: f.get('createdTime') or '\uffff')
+        elif keep == 'shortest-path':
+            return min(group, key=lambda f: (len(f.get('path') or ''), f.get('path') or ''))
+        elif keep == 'most-shared':
+            return max(group, key=lambda f: len(f.get('permissions') or []))
+        else:
+            return group[0]
+
+    @staticmethod
+    def get_group_id(group):
+        # Stable however the keeper is chosen, to checkpoint groups by
+        return min(f['id'] for f in group)
+
+    def remove(self, groups, checkpoint=None):
+        # Yield (group, keeper, results) for each group, where results maps
+        # each other file id to None once deleted or else the HTTP status of
+        # the error that made us give up on it (or skip it, if it did not
+        # verify).  keeper is None if fewer than two files verified.
+        # Groups are marked done in checkpoint, if given, and skipped when
+        # removing again.
+        chunk = []
+        num_files = 0
+        for group in groups:
+            if checkpoint is not None and checkpoint.is_done(self.get_group_id(group)):
+                continue
+            chunk.append(group)
+            num_files += len(group)
+            if num_files >= self.chunk_size:
+                for result in self.remove_chunk(chunk, checkpoint):
+                    yield result
+                chunk = []
+                num_files = 0
+        for result in self.remove_chunk(chunk, checkpoint):
+            yield result
+
+    def remove_chunk(self, groups, checkpoint):
+        if not groups:
+            return
+        verified = self.run_batches(
+            [f['id'] for group in groups for f in group],
+            lambda file_id: self.files.get(fileId=file_id, fields=self.VERIFY_FIELDS),
+            missing_ok=True)
+
+        keepers = []
+        doomed = []
+        for group in groups:
+            keeper = self.verify_group(group, verified)
+            keepers.append(keeper)
+            if keeper is not None:
+                doomed.extend(f['id'] for f in group if f['id'] != keeper['id'] and
+                              isinstance(verified.get(f['id']), dict))
+
+        deleted = self.run_batches(
+            doomed, lambda file_id: self.files.delete(fileId=file_id), missing_ok=True)
+
+        for (group, keeper) in zip(groups, keepers):
+            results = dict()
+            for f in group:
+                if keeper is None or f['id'] == keeper['id']:
+                    continue
+                if not isinstance(verified.get(f['id']), dict):
+                    results[f['id']] = verified.get(f['id'])
+                else:
+                    results[f['id']] = deleted.get(f['id'])
+            if checkpoint is not None and all(error is None for error in results.values()):
+                checkpoint.mark_done(self.get_group_id(group))
+            yield (group, keeper, results)
+
+    def verify_group(self, group, verified):
+        # Return the keeper among the files that still match the snapshot, or
+        # None if fewer than two do; files that no longer match are left alone
+        expected_key = self.get_verify_key(group[0])
+        matching = []
+        for f in group:
+            response = verified.get(f['id'])
+            if self.is_verified(response, expected_key):
+                matching.append(dict(f, createdTime=response.get('createdTime')))
+            elif isinstance(response, dict):
+                LOGGER.warning('{} changed since the snapshot; skipping'.format(f['id']))
+                verified[f['id']] = 'changed'
+        if len(matching) < 2:
+            return None
+        return self.choose_keeper(matching, self.keep)
+
+    def verify_duplicate(self, file_id, keep_id):
+        # Whether file_id is still a copy of keep_id, both fetched now, e.g.
+        # before applying a planned delete
+        verified = self.run_batches(
+            [keep_id, file_id],
+            lambda file_id: self.files.get(fileId=file_id, fields=self.VERIFY_FIELDS),
+            missing_ok=True)
+        if not isinstance(verified.get(keep_id), dict):
+            return False
+        expected_key = self.get_verify_key(verified[keep_id])
+        return (self.is_verified(verified[keep_id], expected_key) and
+                self.is_verified(verified.get(file_id), expected_key))
+
+    def get_verify_key(self, f):
+        # What duplicates share, from a snapshot entry or a response with
+        # VERIFY_FIELDS
+        k = (str(f.get('size')), f.get('md5Checksum'),
+             get_permissions_signature(f.get('permissions')))
+        if self.same_path:
+            k += (f.get('name'), tuple(sorted(f.get('parents') or [])))
+        return k
+
+    def is_verified(self, response, expected_key):
+        # Whether response is of a file that still exists untrashed, owned by
+        # us, with expected_key
+        return (isinstance(response, dict) and not response.get('trashed') and
+                any(owner.get('me') for owner in response.get('owners', [])) and
+                'permissions' in response and self.get_verify_key(response) == expected_key)
+
+    def run_batches(self, file_ids, new_request, missing_ok=False):
+        # Return a dict mapping each file id to its response (None if empty),
+        # or to the HTTP status of the error that made us give up on it (None
+        # for a missing file, if missing_ok)
+        results = dict()
+        pending = list(file_ids)
+        for attempt in range(self.max_rounds):
+            requeued = []
+            for i in range(0, len(pending), self.batch_size):
+                batch_ids = pending[i:i + self.batch_size]
+
+                def callback(request_id, response, exception, batch_ids=batch_ids):
+                    file_id = batch_ids[int(request_id)]
+                    if exception is None:
+                        # Deletes respond with an empty body
+                        results[file_id] = response if isinstance(response, dict) else None
+                    elif missing_ok and exception.resp.status == 404:
+                        results[file_id] = None
+                    elif EXECUTOR.should_retry(exception, 0) and attempt + 1 < self.max_rounds:
+                        requeued.append(file_id)
+                    else:
+                        LOGGER.warning('Failed request for {}: {}'.format(file_id, exception))
+                        results[file_id] = exception.resp.status
+
+                batch = self.service.new_batch_http_request(callback=callback)
+                for (j, file_id) in enumerate(batch_ids):
+                    batch.add(new_request(file_id), request_id=str(j))
+                execute(batch, cost=len(batch_ids))
+            if not requeued:
+                break
+            pending = requeued
+            delay = EXECUTOR.backoff(attempt)
+            LOGGER.warning('Requeueing {} files in {:.1f}s'.format(len(pending), delay))
+            EXECUTOR.sleep(delay)
+        return results
 
 
 class FileMetadataDownloader(object):
-    DEFAULT_FILE_FIELDS = ('id', 'name', 'parents', 'size', 'mimeType', 'trashed', 'md5Checksum')
+    DEFAULT_FILE_FIELDS = ('id', 'name', 'parents', 'size', 'mimeType', 'trashed', 'starred',
+                           'md5Checksum', 'createdTime')
     DEFAULT_PERM_FIELDS = ('id', 'type', 'role', 'emailAddress')
+    BATCH_SIZE = 100
 
     def __init__(self, files, perms, file_fields=DEFAULT_FILE_FIELDS,
-                 perm_fields=DEFAULT_PERM_FIELDS):
+                 perm_fields=DEFAULT_PERM_FIELDS, service=None, inline_permissions=False,
+                 lister=None):
         self.files = files
         self.perms = perms
         self.file_fields = file_fields
         self.perm_fields = perm_fields
+        # If service is given, permission lookups for each page of files are
+        # grouped into batch requests; if inline_permissions is set, they are
+        # requested in the files.list fields mask, falling back to a lookup
+        # for files whose permissions we are not allowed to see.
+        self.service = service
+        self.inline_permissions = inline_permissions
+        # If lister (a ShardedLister) is given, files are listed through it
+        # rather than page by page from page_token
+        self.lister = lister
 
     def list(self, page_token=None):
         LOGGER.debug('Listing files ...')
-        file_request = self.files.list(
+        for page in self.iter_pages(page_token):
+            for metadata in self.get_page(page):
+                yield metadata
+
+    def iter_pages(self, page_token=None):
+        if self.lister is not None:
+            return self.lister.iter_pages(
+                lambda files, q: self.new_list_request(
+                    files=files, q=q, page_size=self.lister.page_size))
+        else:
+            return service_page_iter(
+                self.new_list_request(page_token), 'files', self.files.list_next)
+
+    def get_list_fields(self):
+        file_fields = tuple(self.file_fields)
+        if self.inline_permissions:
+            file_fields += ('permissions({})'.format(', '.join(self.perm_fields)),)
+        return file_fields
+
+    def new_list_request(self, page_token=None, files=None, q=None, page_size=100):
+        return (files or self.files).list(
             pageToken=page_token,
-            pageSize=100,
-            fields="nextPageToken, files({})".format(', '.join(self.file_fields)))
-        for (f, batch_info) in service_method_iter(file_request, 'files', self.files.list_next):
-            LOGGER.info('Downloading metadata for {}'.format(f['name']))
-            yield self.get(f, batch_info)
+            q=q,
+            pageSize=page_size,
+            fields="nextPageToken, files({})".format(', '.join(self.get_list_fields())))
 
     def get(self, f, batch_info):
+        metadata = self.new_metadata(f, batch_info)
+        self.list_permissions(self.new_perm_request(f['id']), metadata)
+        return metadata
+
+    def get_page(self, page):
+        metadata_list = []
+        pending = []
+        for (f, batch_info) in page:
+            LOGGER.info('Downloading metadata for {}'.format(f['name']))
+            metadata = self.new_metadata(f, batch_info)
+            if f.get('permissions') is not None:
+                metadata['permissions'] = [self.filter_perm(p) for p in f['permissions']]
+            else:
+                pending.append((f, metadata))
+            metadata_list.append(metadata)
+
+        if self.service is None:
+            for (f, metadata) in pending:
+                self.list_permissions(self.new_perm_request(f['id']), metadata)
+        else:
+            for i in range(0, len(pending), self.BATCH_SIZE):
+                self.get_permissions_batch(pending[i:i + self.BATCH_SIZE])
+
+        return metadata_list
+
+    def get_permissions_batch(self, pending):
+        perm_requests = [self.new_perm_request(f['id'], page_size=100) for (f, _) in pending]
+        next_perm_requests = []
+
+        def callback(request_id, response, exception):
+            i = int(request_id)
+            metadata = pending[i][1]
+            if exception is not None:
+                if EXECUTOR.should_retry(exception, 0):
+                    # Retry on its own, with backoff
+                    next_perm_requests.append((self.new_perm_request(pending[i][0]['id']), metadata))
+                else:
+                    self.set_error(metadata, exception)
+            else:
+                for p in response.get('permissions', []):
+                    metadata['permissions'].append(self.filter_perm(p))
+                next_perm_request = self.perms.list_next(perm_requests[i], response)
+                if next_perm_request is not None:
+                    next_perm_requests.append((next_perm_request, metadata))
+
+        batch = self.service.new_batch_http_request(callback=callback)
+        for (i, perm_request) in enumerate(perm_requests):
+            batch.add(perm_request, request_id=str(i))
+        execute(batch, cost=len(perm_requests))
+
+        for (perm_request, metadata) in next_perm_requests:
+            self.list_permissions(perm_request, metadata)
+
+    def new_metadata(self, f, batch_info):
         metadata = dict((k, f.get(k)) for k in self.file_fields)
         metadata['permissions'] = []
         metadata['error'] = None
         metadata['batch_info'] = batch_info
+        return metadata
+
+    def new_perm_request(self, file_id, page_size=10):
+        return self.perms.list(
+            fileId=file_id, pageSize=page_size,
+            fields="nextPageToken, permissions({})".format(', '.join(self.perm_fields)))
+
+    def filter_perm(self, p):
+        return dict((k, p.get(k)) for k in self.perm_fields)
+
+    def list_permissions(self, perm_request, metadata):
         try:
-            perm_request = self.perms.list(
-                fileId=f['id'], pageSize=10,
-                fields="nextPageToken, permissions({})".format(', '.join(self.perm_fields)))
             for (p, _) in service_method_iter(perm_request, 'permissions', self.perms.list_next):
-                metadata['permissions'].append(dict((k, p.get(k)) for k in self.perm_fields))
+                metadata['permissions'].append(self.filter_perm(p))
 
         except HttpError as ex:
-            LOGGER.warning('Caught exception: {}'.format(ex))
-            metadata['error'] = ex.resp.status
+            self.set_error(metadata, ex)
+
+    def set_error(self, metadata, ex):
+        LOGGER.warning('Caught exception: {}'.format(ex))
+        metadata['error'] = ex.resp.status
+
+
+class PipelinedFileMetadataDownloader(FileMetadataDownloader):
+    def __init__(self, service_factory, num_workers=8, max_pending_files=1000,
+                 batch=False, **kwargs):
+        # Files are listed on the calling thread while permissions are fetched
+        # by a pool of workers, each with its own service (and so its own HTTP
+        # connection) from service_factory.  Results are yielded in listing
+        # order so that batch_info stays valid for resuming.
+        service = service_factory()
+        super().__init__(
+            service.files(), service.permissions(),
+            service=service if batch else None, **kwargs)
+        self.service_factory = service_factory
+        self.num_workers = num_workers
+        self.max_pending_files = max_pending_files
+        self.batch = batch
+        self.local = threading.local()
 
-        return metadata
+    def list(self, page_token=None):
+        LOGGER.debug('Listing files with {} workers ...'.format(self.num_workers))
+        chunk_size = self.BATCH_SIZE if self.batch else 1
+
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            pending = deque()
+            num_pending_files = 0
+            for page in self.iter_pages(page_token):
+                for i in range(0, len(page), chunk_size):
+                    chunk = page[i:i + chunk_size]
+                    pending.append(executor.submit(self.get_page_in_worker, chunk))
+                    num_pending_files += len(chunk)
+
+                while num_pending_files > self.max_pending_files:
+                    metadata_list = pending.popleft().result()
+                    num_pending_files -= len(metadata_list)
+                    for metadata in metadata_list:
+                        yield metadata
+
+            while pending:
+                for metadata in pending.popleft().result():
+                    yield metadata
+
+    def get_page_in_worker(self, page):
+        if getattr(self.local, 'downloader', None) is None:
+            service = self.service_factory()
+            self.local.downloader = FileMetadataDownloader(
+                service.files(), service.permissions(),
+                file_fields=self.file_fields, perm_fields=self.perm_fields,
+                service=service if self.batch else None,
+                inline_permissions=self.inline_permissions)
+        return self.local.downloader.get_page(page)
+
+
+class MD5Writer(object):
+    # File-like sink for MediaIoBaseDownload hashing content as it arrives,
+    # so that no more than a chunk of a file is ever held in memory
+    def __init__(self):
+        self.md5 = hashlib.md5()
+        self.num_bytes = 0
+
+    def write(self, data):
+        self.md5.update(data)
+        self.num_bytes += len(data)
+
+    def hexdigest(self):
+        return self.md5.hexdigest()
+
+
+class ContentVerifier(object):
+    # Downloads file content in ranged chunks of chunk_size bytes on a pool
+    # of workers, each with its own service from service_factory, and
+    # checks its md5 against md5Checksum.  Each chunk is a request of its
+    # own, throttled and retried like any other, so a failed chunk is
+    # fetched again rather than the whole file.  Throughput per worker is
+    # kept in worker_stats.
+    CHUNK_SIZE = 8 * 1024 * 1024
+    ENDPOINT = 'drive.files.get_media'
+
+    def __init__(self, service_factory, num_workers=4, chunk_size=CHUNK_SIZE,
+                 max_pending_files=100):
+        self.service_factory = service_factory
+        self.num_workers = num_workers
+        self.chunk_size = chunk_size
+        self.max_pending_files = max_pending_files
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.worker_stats = dict()
+
+    def verify(self, files):
+        # Yield (f, result) for each file dict in files (with at least id and
+        # md5Checksum), in order, where result has the md5Checksum of the
+        # content downloaded, its size in bytes, the seconds taken, the
+        # worker, and the HTTP status (or message) of any error
+        LOGGER.debug('Verifying content with {} workers ...'.format(self.num_workers))
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            pending = deque()
+            for f in files:
+                pending.append((f, executor.submit(self.verify_in_worker, f)))
+                while len(pending) > self.max_pending_files:
+                    (f, future) = pending.popleft()
+                    yield (f, future.result())
+            while pending:
+                (f, future) = pending.popleft()
+                yield (f, future.result())
+
+    def verify_in_worker(self, f):
+        if getattr(self.local, 'files', None) is None:
+            self.local.files = self.service_factory().files()
+            with self.lock:
+                self.local.worker = len(self.worker_stats)
+                self.worker_stats[self.local.worker] = dict(
+                    num_files=0, num_bytes=0, seconds=0.0)
+        start = time.monotonic()
+        writer = MD5Writer()
+        result = dict(md5Checksum=None, error=None, worker=self.local.worker)
+        try:
+            download = MediaIoBaseDownload(
+                writer, self.local.files.get_media(fileId=f['id']), chunksize=self.chunk_size)
+            done = False
+            while not done:
+                done = self.next_chunk(download, writer)
+            result['md5Checksum'] = writer.hexdigest()
+        except HttpError as ex:
+            LOGGER.warning('Could not download {}: {}'.format(f['id'], ex))
+            result['error'] = ex.resp.status
+        except (httplib2.HttpLib2Error, ConnectionError, socket.timeout) as ex:
+            LOGGER.warning('Could not download {}: {}'.format(f['id'], ex))
+            result['error'] = str(ex)
+        result['num_bytes'] = writer.num_bytes
+        result['seconds'] = time.monotonic() - start
+        with self.lock:
+            stats = self.worker_stats[self.local.worker]
+            stats['num_files'] += 1
+            stats['num_bytes'] += result['num_bytes']
+            stats['seconds'] += result['seconds']
+        return result
+
+    def next_chunk(self, download, writer):
+        # Return whether the download is done after fetching the next chunk
+        attempt = 0
+        while True:
+            EXECUTOR.throttle(1)
+            start = time.monotonic()
+            num_bytes = writer.num_bytes
+            try:
+                (_, done) = download.next_chunk()
+            except (HttpError, httplib2.HttpLib2Error, ConnectionError, socket.timeout) as ex:
+                if not EXECUTOR.should_retry(ex, attempt, self.ENDPOINT):
+                    raise
+                delay = EXECUTOR.backoff(attempt)
+                LOGGER.warning('Retrying chunk in {:.1f}s after exception: {}'.format(delay, ex))
+                EXECUTOR.sleep(delay)
+                attempt += 1
+            else:
+                if EXECUTOR.metrics is not None:
+                    EXECUTOR.metrics.record_request(
+                        self.ENDPOINT, time.monotonic() - start, writer.num_bytes - num_bytes)
+                if EXECUTOR.rate_limiter is not None:
+                    EXECUTOR.rate_limiter.on_success()
+                return done
+
+    def format_worker_stats(self):
+        lines = []
+        for (worker, stats) in sorted(self.worker_stats.items()):
+            lines.append('worker {}: {} files, {}, {:.1f} MB/s'.format(
+                worker, stats['num_files'], format_size(stats['num_bytes']),
+                stats['num_bytes'] / 1e6 / stats['seconds'] if stats['seconds'] > 0 else 0.0))
+        return lines
+
+
+def hash_local_file(path, chunk_size=ContentVerifier.CHUNK_SIZE):
+    # md5 of a local file, read through mmap a chunk at a time without
+    # copying; run in worker processes by LocalTreeHasher
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size > 0:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                with memoryview(m) as view:
+                    for i in range(0, len(view), chunk_size):
+                        md5.update(view[i:i + chunk_size])
+    return md5.hexdigest()
+
+
+class LocalHashCache(object):
+    # md5 of local files by absolute path, valid while their size and
+    # modification time are unchanged.  If path is given, entries are
+    # loaded from and saved to that JSON file; only files looked up since
+    # loading are saved, so deleted files drop out.
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = dict()
+        self.seen = dict()
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def get(self, file_path, file_stat):
+        entry = self.entries.get(file_path)
+        if entry is not None and entry[:2] == [file_stat.st_size, file_stat.st_mtime_ns]:
+            self.seen[file_path] = entry
+            return entry[2]
+        return None
+
+    def set(self, file_path, file_stat, md5_checksum):
+        self.seen[file_path] = self.entries[file_path] = [
+            file_stat.st_size, file_stat.st_mtime_ns, md5_checksum]
+
+    def load(self):
+        LOGGER.debug('Reading hash cache from {}'.format(self.path))
+        with open(self.path) as f:
+            self.entries = json.load(f)
+
+    def save(self):
+        if self.path is not None:
+            LOGGER.debug('Writing hash cache to {}'.format(self.path))
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self.seen, f)
+            os.replace(tmp_path, self.path)
+
+
+class LocalTreeHasher(object):
+    # Walks a local directory, hashing files not in cache on a pool of
+    # num_workers processes (default: one per CPU) with at most
+    # max_pending_files queued at a time.  Symbolic links and other special
+    # files are skipped.
+    def __init__(self, num_workers=None, cache=None, max_pending_files=1000):
+        self.num_workers = num_workers
+        self.cache = cache if cache is not None else LocalHashCache()
+        self.max_pending_files = max_pending_files
+        self.num_cached = 0
+        self.num_hashed = 0
+
+    def hash(self, root_path):
+        # Yield (relative path, size, md5Checksum) for each file under
+        # root_path, with paths separated by /, in no particular order
+        root_path = os.path.abspath(root_path)
+        LOGGER.debug('Hashing files under {} ...'.format(root_path))
+        with ProcessPoolExecutor(max_workers=self.num_workers) as executor:
+            pending = deque()
+            for (rel_path, file_path, file_stat) in self.iter_files(root_path):
+                md5_checksum = self.cache.get(file_path, file_stat)
+                if md5_checksum is not None:
+                    self.num_cached += 1
+                    yield (rel_path, file_stat.st_size, md5_checksum)
+                    continue
+                pending.append((rel_path, file_path, file_stat,
+                                executor.submit(hash_local_file, file_path)))
+                while len(pending) > self.max_pending_files:
+                    yield self.finish(*pending.popleft())
+            while pending:
+                yield self.finish(*pending.popleft())
+
+    def finish(self, rel_path, file_path, file_stat, future):
+        md5_checksum = future.result()
+        self.cache.set(file_path, file_stat, md5_checksum)
+        self.num_hashed += 1
+        return (rel_path, file_stat.st_size, md5_checksum)
+
+    def iter_files(self, root_path):
+        for (dir_path, dir_names, file_names) in os.walk(root_path):
+            dir_names.sort()
+            for file_name in sorted(file_names):
+                file_path = os.path.join(dir_path, file_name)
+                file_stat = os.lstat(file_path)
+                if not stat.S_ISREG(file_stat.st_mode):
+                    LOGGER.debug('Skipping special file {}'.format(file_path))
+                    continue
+                rel_path = os.path.relpath(file_path, root_path)
+                yield (rel_path.replace(os.sep, '/'), file_path, file_stat)
+
+
+def get_drive_tree_checksums(path, files, **kwargs):
+    # Walk path in drive, returning a dict mapping the path of each file
+    # relative to path (separated by /) to the md5Checksums of the files
+    # there (several files may share a name), and the number of files
+    # without one (e.g. Google Docs), which are left out.  kwargs are
+    # passed on to walk.
+    checksums = defaultdict(list)
+    num_skipped = 0
+    folder_paths = dict()
+    for (root, dir_entries, file_entries) in walk(
+            path, files, fields=('id', 'name', 'mimeType', 'md5Checksum'), **kwargs):
+        root_path = folder_paths.setdefault(root['id'], '')
+        for dir_entry in dir_entries:
+            folder_paths.setdefault(dir_entry['id'], root_path + dir_entry['name'] + '/')
+        for file_entry in file_entries:
+            if file_entry.get('md5Checksum') is None:
+                num_skipped += 1
+            else:
+                checksums[root_path + file_entry['name']].append(file_entry['md5Checksum'])
+    return (checksums, num_skipped)
+
+
+def diff_tree_checksums(local_checksums, drive_checksums):
+    # Yield (status, path) for each path, in order, that is missing from
+    # drive, extra in drive, or in both but with no drive file matching the
+    # local md5Checksum ('missing', 'extra' or 'mismatch')
+    for path in sorted(set(local_checksums).union(drive_checksums)):
+        if path not in drive_checksums:
+            yield ('missing', path)
+        elif path not in local_checksums:
+            yield ('extra', path)
+        elif local_checksums[path] not in drive_checksums[path]:
+            yield ('mismatch', path)
+
+
+def pack_md5_checksum(md5_checksum):
+    try:
+        return bytes.fromhex(md5_checksum)
+    except (TypeError, ValueError):
+        return md5_checksum
+
+
+def unpack_md5_checksum(md5_checksum):
+    if isinstance(md5_checksum, bytes):
+        return md5_checksum.hex()
+    else:
+        return md5_checksum
+
+
+def get_snapshot_format(path):
+    # (format, compression) of a metadata snapshot from its extension:
+    # .msgpack for columnar msgpack, anything else for jsonl, and either
+    # compressed with zstandard if followed by .zst
+    (base, ext) = os.path.splitext(path)
+    compression = None
+    if ext == '.zst':
+        compression = 'zstd'
+        (base, ext) = os.path.splitext(base)
+    return ('msgpack' if ext == '.msgpack' else 'jsonl', compression)
+
+
+def check_snapshot_format(snapshot_format, compression):
+    if snapshot_format == 'msgpack' and msgpack is None:
+        raise ImportError('msgpack snapshots require msgpack')
+    if compression == 'zstd' and zstandard is None:
+        raise ImportError('zstd-compressed snapshots require zstandard')
+
+
+class SnapshotWriter(object):
+    # Writes metadata records to a snapshot file opened in binary mode,
+    # buffering batch_size records at a time.  Each batch is encoded as a
+    # whole and, if compressed, as its own zstd frame, so that the file is
+    # valid after every flush: it can be truncated to tell() as recorded by
+    # a Checkpoint and appended to.
+    #
+    # In msgpack snapshots each batch is one map of columns, with strings
+    # repeated across files (mime types, permission types, roles and email
+    # addresses, page tokens) interned in a table per batch and checksums
+    # packed to bytes.  Fields missing from some records of a batch are read
+    # back as None.
+    BATCH_SIZE = 1000
+
+    def __init__(self, raw_file, snapshot_format='jsonl', compression=None,
+                 batch_size=BATCH_SIZE, compression_level=3):
+        check_snapshot_format(snapshot_format, compression)
+        self.raw_file = raw_file
+        self.snapshot_format = snapshot_format
+        self.batch_size = batch_size
+        self.compressor = (
+            zstandard.ZstdCompressor(level=compression_level) if compression == 'zstd' else None)
+        self.buffer = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, metadata):
+        self.buffer.append(metadata)
+        if len(self.buffer) >= self.batch_size:
+            self.write_batch()
+
+    def write_batch(self):
+        if not self.buffer:
+            return
+        if self.snapshot_format == 'msgpack':
+            data = msgpack.packb(self.encode_columns(self.buffer), use_bin_type=True)
+        else:
+            data = ''.join(json.dumps(metadata) + '\n' for metadata in self.buffer).encode('utf-8')
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        self.raw_file.write(data)
+        self.buffer = []
+
+    def encode_columns(self, records):
+        strings = dict()
+
+        def intern(value):
+            return None if value is None else strings.setdefault(value, len(strings))
+
+        keys = list(OrderedDict.fromkeys(k for metadata in records for k in metadata))
+        columns = dict()
+        for key in keys:
+            values = [metadata.get(key) for metadata in records]
+            if key == 'mimeType':
+                values = [intern(v) for v in values]
+            elif key == 'size':
+                values = [None if v is None else int(v) for v in values]
+            elif key == 'md5Checksum':
+                values = [pack_md5_checksum(v) for v in values]
+            elif key == 'permissions':
+                perm_keys = list(OrderedDict.fromkeys(
+                    k for perms in values for p in perms or [] for k in p))
+                columns['permission_keys'] = perm_keys
+                values = [
+                    None if perms is None else
+                    [[intern(p.get(k)) for k in perm_keys] for p in perms]
+                    for perms in values]
+            elif key == 'batch_info':
+                values = [
+                    None if v is None else
+                    [intern(v['next_page_token']), v['item_index'], v['num_items']]
+                    for v in values]
+            columns[key] = values
+        return dict(keys=keys, strings=list(strings), columns=columns, count=len(records))
+
+    def flush(self):
+        self.write_batch()
+        self.raw_file.flush()
+
+    def fileno(self):
+        return self.raw_file.fileno()
+
+    def tell(self):
+        return self.raw_file.tell()
+
+    def truncate(self, size):
+        # Move to the new end too: in append mode writes go there anyway, but
+        # tell() (and so the offset a Checkpoint records) would not
+        self.buffer = []
+        self.raw_file.truncate(size)
+        self.raw_file.seek(size)
+
+    def close(self):
+        self.flush()
+        self.raw_file.close()
+
+
+def open_snapshot_writer(path, mode='w', snapshot_format=None, compression=None, **kwargs):
+    # Open a SnapshotWriter on path, in the format given by its extension
+    # unless snapshot_format is given
+    if snapshot_format is None:
+        (snapshot_format, compression) = get_snapshot_format(path)
+    check_snapshot_format(snapshot_format, compression)
+    return SnapshotWriter(
+        open(path, mode + 'b'), snapshot_format=snapshot_format, compression=compression,
+        **kwargs)
+
+
+def decode_columns(batch, raw=False):
+    strings = batch['strings']
+    columns = batch['columns']
+    keys = batch['keys']
+    perm_keys = columns.get('permission_keys', [])
+    perm_cache = dict()
+
+    def lookup(i):
+        return None if i is None else strings[i]
+
+    def decode_permission(p):
+        # Permissions repeat across files, so each is decoded once per batch
+        # (and only shared between records if raw)
+        p = tuple(p)
+        perm = perm_cache.get(p)
+        if perm is None:
+            perm = perm_cache[p] = dict(zip(perm_keys, [lookup(i) for i in p]))
+        return perm if raw else dict(perm)
+
+    values = []
+    for key in keys:
+        column = columns[key]
+        if key == 'mimeType':
+            column = [lookup(v) for v in column]
+        elif key == 'size' and not raw:
+            column = [None if v is None else str(v) for v in column]
+        elif key == 'md5Checksum' and not raw:
+            column = [unpack_md5_checksum(v) for v in column]
+        elif key == 'permissions':
+            column = [
+                None if perms is None else [decode_permission(p) for p in perms]
+                for perms in column]
+        elif key == 'batch_info':
+            column = [
+                None if v is None else
+                dict(next_page_token=lookup(v[0]), item_index=v[1], num_items=v[2])
+                for v in column]
+        values.append(column)
+    for record in zip(*values):
+        yield dict(zip(keys, record))
+
+
+def read_snapshot(path, raw=False, snapshot_format=None, compression=None):
+    # Yield the metadata records in a snapshot, in the format given by its
+    # extension unless snapshot_format is given.  If raw is set, records from
+    # msgpack snapshots keep sizes as ints and checksums packed, which
+    # DriveFiles accepts as they are, and omit batch_info.
+    if snapshot_format is None:
+        (snapshot_format, compression) = get_snapshot_format(path)
+    check_snapshot_format(snapshot_format, compression)
+    with open(path, 'rb') as raw_file:
+        if compression == 'zstd':
+            f = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(
+                raw_file, read_across_frames=True, closefd=False))
+        else:
+            f = raw_file
+        if snapshot_format == 'msgpack':
+            for batch in msgpack.Unpacker(f, raw=False, max_buffer_size=2 ** 31 - 1):
+                if raw:
+                    batch['keys'] = [k for k in batch['keys'] if k != 'batch_info']
+                for metadata in decode_columns(batch, raw=raw):
+                    yield metadata
+        else:
+            for line in f:
+                yield json.loads(line)
+
+
+def iter_snapshot_pages(path, start=0, page_size=1000):
+    # Yield (metadata, batch_info) for the records of a snapshot from the
+    # start-th on, in pages of page_size for Checkpoint.iter, so that a pass
+    # over a snapshot can be resumed like a listing.  Each page token is the
+    # number of records before the next page, and the last page has none.
+    records = itertools.islice(read_snapshot(path), start, None)
+    page = list(itertools.islice(records, page_size))
+    while page:
+        next_page = list(itertools.islice(records, page_size))
+        start += len(page)
+        for (i, metadata) in enumerate(page):
+            yield (metadata, dict(next_page_token=str(start) if next_page else None,
+                                  item_index=i, num_items=len(page)))
+        page = next_page
+
+
+def is_snapshot_complete(path, checkpoint_path=None):
+    # Whether the download writing a snapshot finished, as recorded in its
+    # checkpoint journal (by default <path>.checkpoint).  Snapshots written
+    # without one are taken to be complete if their last record ends the
+    # listing, which only holds for listings that were not sharded.
+    if checkpoint_path is None:
+        checkpoint_path = path + '.checkpoint'
+    if os.path.exists(checkpoint_path):
+        complete = False
+        with open(checkpoint_path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                if 'complete' in record:
+                    complete = True
+                elif 'page_token' in record or 'done' in record:
+                    complete = False
+        return complete
+    batch_info = None
+    for metadata in read_snapshot(path):
+        batch_info = metadata.get('batch_info')
+    return batch_info is None or (
+        batch_info['next_page_token'] is None and
+        batch_info['item_index'] + 1 == batch_info['num_items'])
+
+
+def get_changes_token_path(snapshot_path):
+    return snapshot_path + '.changes-token'
+
+
+def save_start_page_token(changes, token_path):
+    # Record where the changes feed stands now, to sync a snapshot from later
+    token = execute(changes.getStartPageToken())['startPageToken']
+    LOGGER.debug('Writing changes token {} to {}'.format(token, token_path))
+    with open(token_path, 'w') as f:
+        f.write(token + '\n')
+    return token
+
+
+def sync_metadata(snapshot_path, changes, downloader, token_path=None):
+    # Bring a metadata snapshot up to date by applying the changes made
+    # since the token stored next to it: changed files are re-downloaded
+    # (with their permissions) and removed files are dropped.  The snapshot is
+    # replaced atomically before the new token is stored, so an interrupted
+    # sync is simply repeated.
+    if token_path is None:
+        token_path = get_changes_token_path(snapshot_path)
+    with open(token_path) as f:
+        page_token = f.read().strip()
+
+    LOGGER.info('Listing changes since {}'.format(page_token))
+    updates = dict()
+    new_page_token = None
+    while page_token is not None:
+        response = execute(changes.list(
+            pageToken=page_token, pageSize=1000, includeRemoved=True,
+            fields='nextPageToken, newStartPageToken, '
+                   'changes(changeType, fileId, removed, file({}))'.format(
+                       ', '.join(downloader.get_list_fields()))))
+        page = []
+        for change in response.get('changes', []):
+            if change.get('changeType', 'file') != 'file':
+                continue
+            if change.get('removed') or change.get('file') is None:
+                LOGGER.info('Removing metadata for {}'.format(change['fileId']))
+                updates[change['fileId']] = None
+            else:
+                page.append((change['file'], None))
+        for metadata in downloader.get_page(page):
+            updates[metadata['id']] = metadata
+        page_token = response.get('nextPageToken')
+        new_page_token = response.get('newStartPageToken', new_page_token)
+
+    LOGGER.info('Applying {} changes to {}'.format(len(updates), snapshot_path))
+    tmp_path = snapshot_path + '.tmp'
+    batch_info = None
+    (snapshot_format, compression) = get_snapshot_format(snapshot_path)
+    with open_snapshot_writer(tmp_path, snapshot_format=snapshot_format,
+                              compression=compression) as output_file:
+        for metadata in read_snapshot(snapshot_path):
+            batch_info = metadata.get('batch_info')
+            if metadata['id'] in updates:
+                update = updates.pop(metadata['id'])
+                if update is None:
+                    continue
+                # Keep the listing position so resuming still works
+                update['batch_info'] = batch_info
+                metadata = update
+            output_file.write(metadata)
+
+        for metadata in updates.values():
+            if metadata is not None:
+                metadata['batch_info'] = batch_info
+                output_file.write(metadata)
+
+        output_file.flush()
+        os.fsync(output_file.fileno())
+    os.replace(tmp_path, snapshot_path)
+
+    with open(token_path, 'w') as f:
+        f.write(new_page_token + '\n')
+    return new_page_token
 
 
 class DriveFile(object):
-    def __init__(self, metadata, drive_files):
-        self.metadata = dict()
+    # Lightweight view of one file (node) in a DriveFiles column store
+    __slots__ = ('drive_files', 'node')
+
+    def __init__(self, drive_files, node):
         self.drive_files = drive_files
+        self.node = node
 
-        self.children = []
-        self.size = 0
-        self.path = None
+    @property
+    def id(self):
+        return self.drive_files.file_ids[self.node]
 
-        self.update(metadata)
+    @property
+    def error(self):
+        return self.drive_files.errors.get(self.node)
+
+    @property
+    def mime_type(self):
+        return self.drive_files.mime_types[self.node]
+
+    @property
+    def md5_checksum(self):
+        return unpack_md5_checksum(self.drive_files.md5_checksums[self.node])
+
+    @property
+    def trashed(self):
+        return DriveFiles.TRASHED_VALUES[self.drive_files.trashed[self.node]]
+
+    @property
+    def permissions(self):
+        return [dict(items) for items in self.drive_files.permissions[self.node]]
+
+    @property
+    def own_size(self):
+        return self.drive_files.get_own_size(self.node)
+
+    @property
+    def size(self):
+        return self.drive_files.sizes[self.node]
+
+    @property
+    def human_friendly_size(self):
+        return format_size(self.size)
+
+    @property
+    def name(self):
+        return self.drive_files.get_name(self.node)
+
+    @property
+    def has_name(self):
+        return self.drive_files.names[self.node] is not None
+
+    @property
+    def parent_ids(self):
+        return [self.drive_files.file_ids[p] for p in self.drive_files.get_parents(self.node)]
+
+    @property
+    def parents(self):
+        return [DriveFile(self.drive_files, p) for p in self.drive_files.get_parents(self.node)]
+
+    @property
+    def children(self):
+        return [DriveFile(self.drive_files, c) for c in self.drive_files.get_children(self.node)]
+
+    @property
+    def path(self):
+        return self.drive_files.get_path(self.node)
+
+    def all_paths(self):
+        return self.drive_files.iter_paths(self.node)
+
+    @property
+    def metadata(self):
+        return self.drive_files.get_metadata(self.node)
+
+    def update(self, metadata):
+        self.drive_files.update(self.node, metadata)
+
+    def descendants(self):
+        return [DriveFile(self.drive_files, d) for d in self.drive_files.descendants(self.node)]
+
+    def __eq__(self, other):
+        return (isinstance(other, DriveFile) and
+                self.drive_files is other.drive_files and self.node == other.node)
+
+    def __hash__(self):
+        return hash(self.node)
+
+    def __str__(self):
+        return '{} ({})'.format(self.id, self.path)
+
+
+class DriveFiles(object):
+    # Column store of files: each file is an integer node indexing parallel
+    # lists and arrays, and values repeated across files (mime types,
+    # permissions) are interned.  Parent and child links are arrays of nodes.
+    # Files are handed out as DriveFile views.  batch_info, which only
+    # matters while downloading, is dropped; other unknown fields are kept
+    # in a sparse dict.
+    #
+    # Memory target: under 600 MB per million files with typical metadata
+    # (two permissions each), most of it the id, name and path strings of
+    # each file, versus about 2 GB for one dict and object per file.
+    #
+    # Paths are computed when first asked for and memoized until the file or
+    # one of its ancestors is renamed or reparented.  By default a file with
+    # several parents has path {parent path,...}/name; with canonical_paths
+    # only its first parent is used, so every path is a plain path.
+    TRASHED_VALUES = (None, False, True)
+    NO_PARENT = -1
+    NO_SIZE = -1
+
+    def __init__(self, canonical_paths=False):
+        self.canonical_paths = canonical_paths
+        self.node_map = dict()
+        self.file_ids = []
+        self.names = []
+        self.mime_types = []
+        self.md5_checksums = []
+        self.trashed = bytearray()
+        self.starred = set()
+        self.errors = dict()
+        self.own_sizes = array('q')
+        self.sizes = array('q')
+        self.parent_nodes = array('q')
+        self.other_parent_nodes = dict()
+        self.child_nodes = dict()
+        self.permissions = []
+        self.extra = dict()
+        self.paths = []
+        self.interned = dict()
+        self.root_ids = set()
+
+    def get_node(self, file_id):
+        node = self.node_map.get(file_id)
+        if node is None:
+            node = len(self.file_ids)
+            self.node_map[file_id] = node
+            self.file_ids.append(file_id)
+            self.names.append(None)
+            self.mime_types.append(None)
+            self.md5_checksums.append(None)
+            self.trashed.append(0)
+            self.own_sizes.append(self.NO_SIZE)
+            self.sizes.append(0)
+            self.parent_nodes.append(self.NO_PARENT)
+            self.permissions.append(())
+            self.paths.append(None)
+            self.root_ids.add(file_id)
+        return node
+
+    def intern(self, value):
+        return self.interned.setdefault(value, value)
+
+    def set_fields(self, node, metadata):
+        # Copy the fields present in metadata into the columns, without
+        # linking the file to its parents
+        for (key, value) in metadata.items():
+            if key in ('id', 'batch_info'):
+                pass
+            elif key == 'name':
+                self.names[node] = value
+            elif key == 'mimeType':
+                self.mime_types[node] = None if value is None else sys.intern(value)
+            elif key == 'md5Checksum':
+                self.md5_checksums[node] = pack_md5_checksum(value)
+            elif key == 'trashed':
+                self.trashed[node] = 0 if value is None else (2 if value else 1)
+            elif key == 'starred':
+                # Few files are starred, so they are kept in a set
+                if value:
+                    self.starred.add(node)
+                else:
+                    self.starred.discard(node)
+            elif key == 'size':
+                self.own_sizes[node] = self.NO_SIZE if value is None else int(value)
+            elif key == 'parents':
+                parent_nodes = [self.get_node(parent_id) for parent_id in value or []]
+                self.parent_nodes[node] = parent_nodes[0] if parent_nodes else self.NO_PARENT
+                if len(parent_nodes) > 1:
+                    self.other_parent_nodes[node] = tuple(parent_nodes[1:])
+                else:
+                    self.other_parent_nodes.pop(node, None)
+            elif key == 'permissions':
+                self.permissions[node] = tuple(
+                    self.intern(tuple(p.items())) for p in value or [])
+            elif key == 'error':
+                if value is None:
+                    self.errors.pop(node, None)
+                else:
+                    self.errors[node] = value
+            else:
+                self.extra.setdefault(node, dict())[key] = value
+
+    def get_metadata(self, node):
+        own_size = self.own_sizes[node]
+        parent_ids = [self.file_ids[p] for p in self.get_parents(node)]
+        metadata = dict(
+            id=self.file_ids[node],
+            name=self.names[node],
+            parents=parent_ids or None,
+            size=None if own_size == self.NO_SIZE else str(own_size),
+            mimeType=self.mime_types[node],
+            trashed=self.TRASHED_VALUES[self.trashed[node]],
+            starred=node in self.starred,
+            md5Checksum=unpack_md5_checksum(self.md5_checksums[node]),
+            permissions=[dict(items) for items in self.permissions[node]],
+            error=self.errors.get(node),
+        )
+        metadata.update(self.extra.get(node, {}))
+        return metadata
+
+    def get_name(self, node):
+        name = self.names[node]
+        if name is not None:
+            return name
+        else:
+            return '[id={}]'.format(self.file_ids[node])
+
+    def get_own_size(self, node):
+        return max(0, self.own_sizes[node])
+
+    def get_parents(self, node):
+        parent = self.parent_nodes[node]
+        if parent == self.NO_PARENT:
+            return ()
+        else:
+            return (parent,) + self.other_parent_nodes.get(node, ())
+
+    def get_children(self, node):
+        return self.child_nodes.get(node, ())
+
+    def link(self, parent, child):
+        children = self.child_nodes.get(parent)
+        if children is None:
+            children = self.child_nodes[parent] = array('q')
+        children.append(child)
+
+    def unlink(self, parent, child):
+        children = self.child_nodes[parent]
+        children.remove(child)
+        if not children:
+            del self.child_nodes[parent]
+
+    def propagate_size(self, node, delta):
+        # A file's size is counted once under each parent, so the delta is
+        # pushed up every path to the roots; a file already on the current
+        # path is skipped so cycles terminate.
+        if delta == 0:
+            return
+
+        stack = [(node, frozenset())]
+        while stack:
+            (node, visited) = stack.pop()
+            self.sizes[node] += delta
+            visited = visited.union((node,))
+            for parent in self.get_parents(node):
+                if parent not in visited:
+                    stack.append((parent, visited))
+
+    def get_path_parents(self, node):
+        parents = self.get_parents(node)
+        return parents[:1] if self.canonical_paths else parents
+
+    def format_path(self, node):
+        # Parents without paths yet are on a cycle with this file; their
+        # names stand in for their paths
+        parent_paths = [
+            self.paths[p] if self.paths[p] is not None else self.get_name(p)
+            for p in self.get_path_parents(node)]
+        if len(parent_paths) == 0:
+            return self.get_name(node)
+        elif len(parent_paths) == 1:
+            return '{}/{}'.format(parent_paths[0], self.get_name(node))
+        else:
+            return '{{{}}}/{}'.format(','.join(parent_paths), self.get_name(node))
+
+    def get_path(self, node):
+        # Depth-first up the parents, formatting each missing path after
+        # those of its parents.  A file's path is only memoized once all of
+        # its ancestors' paths are.
+        if self.paths[node] is not None:
+            return self.paths[node]
+
+        stack = [(node, iter(self.get_path_parents(node)))]
+        on_stack = {node}
+        while stack:
+            (n, parents) = stack[-1]
+            for parent in parents:
+                if self.paths[parent] is None and parent not in on_stack:
+                    on_stack.add(parent)
+                    stack.append((parent, iter(self.get_path_parents(parent))))
+                    break
+            else:
+                stack.pop()
+                self.paths[n] = self.format_path(n)
+
+        return self.paths[node]
+
+    def invalidate_paths(self, node):
+        # Memoized paths below a file without one were never computed
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if self.paths[node] is not None:
+                self.paths[node] = None
+                stack.extend(self.get_children(node))
+
+    def iter_paths(self, node):
+        # Every path to the file, one parent at a time; a file already on
+        # the current path is skipped so cycles terminate
+        stack = [(node, self.get_name(node), frozenset((node,)))]
+        while stack:
+            (node, path, visited) = stack.pop()
+            parents = [p for p in self.get_parents(node) if p not in visited]
+            if not parents:
+                yield path
+            for parent in reversed(parents):
+                stack.append((
+                    parent, '{}/{}'.format(self.get_name(parent), path), visited.union((parent,))))
+
+    def descendants(self, node):
+        stack = [node]
+        seen = set()
+        while stack:
+            node = stack.pop()
+            if node not in seen:
+                seen.add(node)
+                stack.extend(self.get_children(node))
+                yield node
+
+    def update(self, node, metadata):
+        old_parents = self.get_parents(node)
+        old_own_size = self.get_own_size(node)
+        old_name = self.names[node]
+        self.set_fields(node, metadata)
+        new_parents = self.get_parents(node)
+
+        for parent in old_parents:
+            if parent not in new_parents:
+                self.unlink(parent, node)
+                self.propagate_size(parent, -self.sizes[node])
+
+        delta = self.get_own_size(node) - old_own_size
+        self.sizes[node] += delta
+        for parent in new_parents:
+            if parent in old_parents:
+                self.propagate_size(parent, delta)
+            else:
+                self.link(parent, node)
+                self.propagate_size(parent, self.sizes[node])
+
+        if self.names[node] != old_name or list(new_parents) != list(old_parents):
+            self.invalidate_paths(node)
+
+    def add(self, metadata):
+        node = self.get_node(metadata['id'])
+        self.update(node, metadata)
+
+        if self.parent_nodes[node] == self.NO_PARENT:
+            self.root_ids.add(metadata['id'])
+        else:
+            self.root_ids.discard(metadata['id'])
+
+        return DriveFile(self, node)
+
+    def load(self, metadata_iter):
+        # Bulk version of add: records are ingested without linking, then sizes
+        # for the whole tree are computed in one topological pass.  Later
+        # calls to add update sizes incrementally.
+        for metadata in metadata_iter:
+            self.set_fields(self.get_node(metadata['id']), metadata)
+
+        nodes = range(len(self.file_ids))
+        self.child_nodes = dict()
+        for node in nodes:
+            for parent in self.get_parents(node):
+                self.link(parent, node)
+
+        self.root_ids = set(
+            self.file_ids[node] for node in nodes if self.parent_nodes[node] == self.NO_PARENT)
+        self.update_sizes(nodes)
+        self.paths = [None] * len(nodes)
+
+    def update_sizes(self, nodes):
+        # Kahn's algorithm from the leaves up: each file is summed once, after
+        # all of its children.  Files left over are on a cycle, which is broken
+        # at an arbitrary file using whatever child sizes are known so far.
+        pending = set(nodes)
+        num_children = dict((node, len(self.get_children(node))) for node in pending)
+        for node in pending:
+            self.sizes[node] = self.get_own_size(node)
+        ready = deque(node for node in pending if num_children[node] == 0)
+        while pending:
+            if not ready:
+                ready.append(next(iter(pending)))
+            node = ready.popleft()
+            if node not in pending:
+                continue
+            pending.remove(node)
+
+            self.sizes[node] = self.get_own_size(node) + sum(
+                self.sizes[child] for child in self.get_children(node))
+            for parent in self.get_parents(node):
+                if parent in pending:
+                    num_children[parent] -= 1
+                    if num_children[parent] == 0:
+                        ready.append(parent)
+
+    def get(self, file_id):
+        return DriveFile(self, self.get_node(file_id))
+
+    def list(self):
+        for node in range(len(self.file_ids)):
+            yield DriveFile(self, node)
+
+    def largest(self, n):
+        return heapq.nlargest(n, self.list(), key=lambda df: df.size)
+
+
+class MetadataIndex(object):
+    # On-disk SQLite index of a metadata snapshot, with sizes and paths
+    # materialized so that they need not be recomputed on every load.
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS files ('
+        'id TEXT PRIMARY KEY, name TEXT, mime_type TEXT, own_size INTEGER, size INTEGER, '
+        'md5_checksum TEXT, trashed INTEGER, error INTEGER, path TEXT, metadata TEXT)',
+        'CREATE TABLE IF NOT EXISTS parents (file_id TEXT, parent_id TEXT)',
+        'CREATE TABLE IF NOT EXISTS permissions ('
+        'file_id TEXT, id TEXT, type TEXT, role TEXT, email_address TEXT)',
+        'CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT)',
+    )
+    INDEXES = (
+        'CREATE INDEX IF NOT EXISTS files_md5_checksum ON files (md5_checksum)',
+        'CREATE INDEX IF NOT EXISTS files_size ON files (size)',
+        'CREATE INDEX IF NOT EXISTS files_name ON files (name)',
+        'CREATE INDEX IF NOT EXISTS parents_file_id ON parents (file_id)',
+        'CREATE INDEX IF NOT EXISTS parents_parent_id ON parents (parent_id)',
+        'CREATE INDEX IF NOT EXISTS permissions_file_id ON permissions (file_id)',
+        'CREATE INDEX IF NOT EXISTS permissions_email_address ON permissions (email_address)',
+    )
+    BATCH_SIZE = 10000
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        for statement in self.SCHEMA:
+            self.db.execute(statement)
+
+    def get_info(self, key):
+        row = self.db.execute('SELECT value FROM info WHERE key = ?', (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def build(self, metadata_iter, source=None):
+        # Rows are written as records stream in; only the fields needed to
+        # compute sizes and paths are kept in memory.  Everything is
+        # committed at once, along with the source the index was built from.
+        LOGGER.info('Building metadata index {}'.format(self.path))
+        for table in ('files', 'parents', 'permissions', 'info'):
+            self.db.execute('DELETE FROM {}'.format(table))
+
+        def insert_files():
+            rows = []
+            for metadata in metadata_iter:
+                rows.append(metadata)
+                if len(rows) >= self.BATCH_SIZE:
+                    self._insert(rows)
+                    rows = []
+                yield dict((k, metadata.get(k)) for k in ('id', 'name', 'parents', 'size'))
+            self._insert(rows)
+
+        drive_files = DriveFiles()
+        drive_files.load(insert_files())
+        self.db.executemany(
+            'INSERT OR IGNORE INTO files (id, own_size) VALUES (?, 0)',
+            ((df.id,) for df in drive_files.list()))
+        self.db.executemany(
+            'UPDATE files SET size = ?, path = ? WHERE id = ?',
+            ((df.size, df.path, df.id) for df in drive_files.list()))
+        for statement in self.INDEXES:
+            self.db.execute(statement)
+        self.db.execute("INSERT INTO info (key, value) VALUES ('source', ?)", (source,))
+        self.db.commit()
+
+    def _insert(self, rows):
+        file_ids = [(metadata['id'],) for metadata in rows]
+        self.db.executemany('DELETE FROM parents WHERE file_id = ?', file_ids)
+        self.db.executemany('DELETE FROM permissions WHERE file_id = ?', file_ids)
+        self.db.executemany(
+            'INSERT OR REPLACE INTO files '
+            '(id, name, mime_type, own_size, md5_checksum, trashed, error, metadata) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            ((
+                metadata['id'],
+                metadata.get('name'),
+                metadata.get('mimeType'),
+                int(metadata['size']) if metadata.get('size') is not None else 0,
+                metadata.get('md5Checksum'),
+                metadata.get('trashed'),
+                metadata.get('error'),
+                json.dumps(metadata),
+            ) for metadata in rows))
+        self.db.executemany(
+            'INSERT INTO parents (file_id, parent_id) VALUES (?, ?)',
+            ((metadata['id'], parent_id)
+             for metadata in rows for parent_id in metadata.get('parents') or []))
+        self.db.executemany(
+            'INSERT INTO permissions (file_id, id, type, role, email_address) '
+            'VALUES (?, ?, ?, ?, ?)',
+            ((metadata['id'], p.get('id'), p.get('type'), p.get('role'), p.get('emailAddress'))
+             for metadata in rows for p in metadata.get('permissions') or []))
+
+    def query(self, sql, params=()):
+        return self.db.execute(sql, params)
+
+    def missing_from(self, other):
+        # (name, size, count here, count in other) for each (name, size, md5)
+        # key with fewer copies in other, largest first
+        self.db.execute('ATTACH DATABASE ? AS other', (other.path,))
+        try:
+            key = "COALESCE(name, '[id=' || id || ']') AS key_name, size, md5_checksum"
+            for row in self.db.execute(
+                    'SELECT a.key_name, a.size, a.n, COALESCE(b.n, 0) FROM '
+                    '(SELECT {key}, COUNT(*) AS n FROM main.files GROUP BY 1, 2, 3) AS a '
+                    'LEFT JOIN '
+                    '(SELECT {key}, COUNT(*) AS n FROM other.files GROUP BY 1, 2, 3) AS b '
+                    'ON a.key_name = b.key_name AND a.size = b.size '
+                    'AND a.md5_checksum IS b.md5_checksum '
+                    'WHERE a.n > COALESCE(b.n, 0) '
+                    'ORDER BY a.size DESC'.format(key=key)):
+                yield row
+        finally:
+            self.db.execute('DETACH DATABASE other')
+
+    def close(self):
+        self.db.close()
+
+
+class IndexedDriveFile(object):
+    # DriveFile read from a MetadataIndex row
+    __slots__ = ('drive_files', 'metadata', 'size', 'path')
+
+    def __init__(self, drive_files, metadata, size=0, path=None):
+        self.drive_files = drive_files
+        self.metadata = metadata
+        self.size = size
+        self.path = path if path is not None else self.name
 
     @property
     def id(self):
@@ -232,10 +2781,14 @@ class DriveFile(object):
 
     @property
     def permissions(self):
-        if self.metadata.get('permissions'):
-            return self.metadata['permissions']
+        return self.metadata.get('permissions') or []
+
+    @property
+    def own_size(self):
+        if self.metadata.get('size') is not None:
+            return int(self.metadata['size'])
         else:
-            return []
+            return 0
 
     @property
     def human_friendly_size(self):
@@ -248,71 +2801,1065 @@ class DriveFile(object):
         else:
             return '[id={}]'.format(self.metadata['id'])
 
+    @property
+    def has_name(self):
+        return self.metadata.get('name') is not None
+
     @property
     def parent_ids(self):
-        if self.metadata.get('parents') is not None:
-            return self.metadata['parents']
-        else:
-            return []
+        return self.metadata.get('parents') or []
 
     @property
     def parents(self):
         return [self.drive_files.get(parent_id) for parent_id in self.parent_ids]
 
-    def add(self, child):
-        self.children.append(child)
-        self.update_size()
+    @property
+    def children(self):
+        return self.drive_files.get_children(self.id)
 
-    def update_size(self):
-        self.size = sum(child.size for child in self.children)
-        if self.metadata.get('size') is not None:
-            self.size += int(self.metadata['size'])
+    def __str__(self):
+        return '{} ({})'.format(self.id, self.path)
 
-        for parent in self.parents:
-            parent.update_size()
 
-    def update_path(self):
-        parents = self.parents
-        if len(parents) == 0:
-            self.path = self.name
-        elif len(parents) == 1:
-            self.path = '{}/{}'.format(parents[0].path, self.name)
-        else:
-            self.path = '{{{}}}/{}'.format(','.join(p.path for p in parents), self.name)
+class IndexedDriveFiles(object):
+    # Read-only DriveFiles backed by a MetadataIndex; files are built from
+    # rows on demand rather than held in memory.
+    COLUMNS = 'id, size, path, metadata'
 
-        for child in self.children:
-            child.update_path()
+    def __init__(self, index):
+        self.index = index
 
-    def update(self, metadata):
-        self.metadata.update(metadata)
-        self.update_size()
-        self.update_path()
+    @property
+    def root_ids(self):
+        return set(row[0] for row in self.index.query(
+            'SELECT id FROM files WHERE id NOT IN (SELECT file_id FROM parents)'))
 
-    def __str__(self):
-        return '{} ({})'.format(self.id, self.path)
+    def _drive_file(self, row):
+        (file_id, size, path, metadata) = row
+        return IndexedDriveFile(
+            self, json.loads(metadata) if metadata else dict(id=file_id), size, path)
 
+    def get(self, file_id):
+        row = self.index.query(
+            'SELECT {} FROM files WHERE id = ?'.format(self.COLUMNS), (file_id,)).fetchone()
+        if row is None:
+            return IndexedDriveFile(self, dict(id=file_id))
+        return self._drive_file(row)
+
+    def get_children(self, file_id):
+        return [self._drive_file(row) for row in self.index.query(
+            'SELECT {} FROM files WHERE id IN '
+            '(SELECT file_id FROM parents WHERE parent_id = ?)'.format(self.COLUMNS),
+            (file_id,))]
 
-class DriveFiles(object):
-    def __init__(self):
-        self.file_map = dict()
-        self.root_ids = set()
+    def list(self):
+        for row in self.index.query('SELECT {} FROM files'.format(self.COLUMNS)):
+            yield self._drive_file(row)
+
+    def largest(self, n):
+        return [self._drive_file(row) for row in self.index.query(
+            'SELECT {} FROM files ORDER BY size DESC LIMIT ?'.format(self.COLUMNS), (n,))]
+
+
+PARTITION_RECORDS = 500000
+
+
+def compare_drive_files(old_drive_files, new_drive_files):
+    # The compare-drive-metadata report: yields (name, size, old count, new
+    # count) for each (name, size, md5) key with more copies in the old
+    # drive, largest first, where folder sizes are the sizes of their trees
+    metadata_map = dict()
+    for (version, drive_files) in ((0, old_drive_files), (1, new_drive_files)):
+        for df in drive_files.list():
+            key = (df.name, df.size, df.md5_checksum)
+            if key not in metadata_map:
+                metadata_map[key] = [0, 0]
+            metadata_map[key][version] += 1
+    for key in sorted(metadata_map, key=lambda k: k[1], reverse=True):
+        (num_old, num_new) = metadata_map[key]
+        if num_old > num_new:
+            yield (key[0], key[1], num_old, num_new)
+
+
+def get_folder_sizes(path):
+    # Return the number of records in a snapshot, a dict mapping the id of
+    # each folder to the size of its tree, as DriveFiles computes it, and
+    # the ids of parents missing from the snapshot (such as the root),
+    # which DriveFiles lists too.  Only folders are held: the sizes of other
+    # files are summed into their parents as they stream past, as only
+    # folders can be parents in Drive.  Memory is O(folders), not O(files).
+    num_records = 0
+    folders = []
+    folder_ids = set()
+    file_sizes = defaultdict(int)
+    for metadata in read_snapshot(path, raw=True):
+        num_records += 1
+        if metadata.get('mimeType') == FOLDER_MIME_TYPE:
+            folders.append(dict((k, metadata.get(k)) for k in ('id', 'parents', 'size')))
+            folder_ids.add(metadata['id'])
+        elif metadata.get('size') is not None:
+            for parent_id in metadata.get('parents') or []:
+                file_sizes[parent_id] += int(metadata['size'])
+
+    # Folders stand in for their files, with the files' sizes as their own
+    missing_ids = set(file_sizes).difference(folder_ids)
+    for f in folders:
+        f['size'] = int(f['size'] or 0) + file_sizes.pop(f['id'], 0)
+        missing_ids.update(p for p in f['parents'] or [] if p not in folder_ids)
+    folders.extend(dict(id=file_id, size=file_sizes.get(file_id, 0)) for file_id in missing_ids)
+
+    drive_files = DriveFiles()
+    drive_files.load(folders)
+    folder_sizes = dict(
+        (drive_files.file_ids[node], drive_files.sizes[node])
+        for node in range(len(drive_files.file_ids)))
+    return (num_records, folder_sizes, sorted(missing_ids))
+
+
+def compare_metadata_streaming(old_path, new_path, partition_records=PARTITION_RECORDS,
+                               tmp_dir=None):
+    # Memory-bounded version of compare_drive_files on snapshots.  A first
+    # pass over each snapshot counts its records and sums folder sizes
+    # (holding only the folders); a second pass hash-partitions keys
+    # into spill files of about partition_records records each, which are
+    # counted one partition at a time, and the sorted per-partition results
+    # are merged.
+    num_records = 0
+    folder_sizes = []
+    missing_ids = []
+    for path in (old_path, new_path):
+        LOGGER.info('Summing folder sizes in {}'.format(path))
+        (num_path_records, path_folder_sizes, path_missing_ids) = get_folder_sizes(path)
+        num_records += num_path_records
+        folder_sizes.append(path_folder_sizes)
+        missing_ids.append(path_missing_ids)
+    num_partitions = max(1, -(-num_records // partition_records))
+
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp_path:
+        partition_paths = [
+            os.path.join(tmp_path, 'partition-{}.jsonl'.format(i)) for i in range(num_partitions)]
+        partition_files = [open(path, 'w') for path in partition_paths]
+        try:
+            for (version, path) in ((0, old_path), (1, new_path)):
+                LOGGER.info('Partitioning {}'.format(path))
+                missing = [dict(id=file_id) for file_id in missing_ids[version]]
+                for metadata in itertools.chain(read_snapshot(path), missing):
+                    size = folder_sizes[version].get(metadata['id'])
+                    if size is None:
+                        size = int(metadata['size']) if metadata.get('size') is not None else 0
+                    key = json.dumps((
+                        metadata['name'] if metadata.get('name') is not None
+                        else '[id={}]'.format(metadata['id']),
+                        size,
+                        metadata.get('md5Checksum'),
+                    ))
+                    partition = zlib.crc32(key.encode('utf-8')) % num_partitions
+                    partition_files[partition].write('{}\t{}\n'.format(version, key))
+        finally:
+            for f in partition_files:
+                f.close()
+
+        result_paths = []
+        for partition_path in partition_paths:
+            counts = defaultdict(lambda: [0, 0])
+            with open(partition_path) as f:
+                for line in f:
+                    (version, key) = line.rstrip('\n').split('\t', 1)
+                    counts[key][int(version)] += 1
+            os.remove(partition_path)
+
+            results = sorted(
+                ((json.loads(key), num_old, num_new)
+                 for (key, (num_old, num_new)) in counts.items() if num_old > num_new),
+                key=lambda r: r[0][1], reverse=True)
+            result_path = partition_path + '.results'
+            with open(result_path, 'w') as f:
+                for ((name, size, _), num_old, num_new) in results:
+                    f.write(json.dumps((name, size, num_old, num_new)) + '\n')
+            result_paths.append(result_path)
+
+        result_files = [open(path) for path in result_paths]
+        try:
+            for row in heapq.merge(
+                    *[(json.loads(line) for line in f) for f in result_files],
+                    key=lambda r: r[1], reverse=True):
+                yield tuple(row)
+        finally:
+            for f in result_files:
+                f.close()
 
-    def add(self, metadata):
-        f = self.get(metadata['id'])
-        f.update(metadata)
 
-        for p in f.parents:
-            p.add(f)
-            if f.id in self.root_ids:
-                self.root_ids.remove(f.id)
+def load_drive_files(path, index_path=None, canonical_paths=False):
+    # Load a metadata snapshot into memory or, if index_path is given,
+    # into an index there (rebuilt if the snapshot has changed) to query lazily
+    if index_path is None:
+        drive_files = DriveFiles(canonical_paths=canonical_paths)
+        drive_files.load(read_snapshot(path, raw=True))
+        return drive_files
+
+    source = '{}:{}'.format(os.path.abspath(path), os.path.getmtime(path))
+    index = MetadataIndex(index_path)
+    if index.get_info('source') != source:
+        index.build(read_snapshot(path), source=source)
+    return IndexedDriveFiles(index)
+
+
+class SummaryAnalyzer(object):
+    # One check of summarize-drive-metadata: add is called with each file in
+    # a single pass over the snapshot, logging what it finds as it goes, and
+    # finish once all files have been added.
+    description = None
+
+    def add(self, df):
+        pass
+
+    def finish(self):
+        pass
 
+
+class ErrorAnalyzer(SummaryAnalyzer):
+    description = 'files whose metadata could not be downloaded'
+
+    def add(self, df):
+        if df.error:
+            LOGGER.warning('Error downloading metadata for {}'.format(df))
+
+
+class TrashedAnalyzer(SummaryAnalyzer):
+    description = 'trashed files'
+
+    def add(self, df):
+        if df.trashed:
+            LOGGER.warning('Trashed: {}'.format(df))
+
+
+class NoNameAnalyzer(SummaryAnalyzer):
+    description = 'files with no names'
+
+    def add(self, df):
+        if not df.has_name:
+            LOGGER.warning('No name: {}'.format(df))
+
+
+class TopLevelAnalyzer(SummaryAnalyzer):
+    description = 'top-level entries beyond root'
+
+    def __init__(self, root_id):
+        self.root_id = root_id
+
+    def add(self, df):
+        if df.id != self.root_id and not df.parent_ids:
+            LOGGER.warning('Top-level but not root: {}'.format(df))
+
+
+class MultipleParentsAnalyzer(SummaryAnalyzer):
+    description = 'multiple parents'
+
+    def add(self, df):
+        parent_ids = df.parent_ids
+        if len(parent_ids) > 1:
+            LOGGER.warning('{} parents: {}'.format(len(parent_ids), df))
+
+
+class DuplicateContentAnalyzer(SummaryAnalyzer):
+    # Files without checksums (folders and Google Docs) are not compared
+    description = 'duplicate content'
+
+    def __init__(self, drive_files):
+        self.drive_files = drive_files
+        self.checksum_counts = dict()
+
+    def add(self, df):
+        md5_checksum = df.md5_checksum
+        if md5_checksum is None:
+            pass
+        elif md5_checksum in self.checksum_counts:
+            self.checksum_counts[md5_checksum][0] += 1
+        else:
+            self.checksum_counts[md5_checksum] = [1, df.id]
+
+    def finish(self):
+        for (count, file_id) in self.checksum_counts.values():
+            if count > 1:
+                LOGGER.warning('{} copies of content here and elsewhere: {}'.format(
+                    count, self.drive_files.get(file_id).path))
+
+
+class DuplicateMetadataAnalyzer(SummaryAnalyzer):
+    # Groups of files with the same name, parents (and so path), size,
+    # content and permissions, of which email is an owner; after finish,
+    # duplicates holds the ids in each group.
+    description = 'duplicate content and metadata'
+
+    def __init__(self, drive_files, email):
+        self.drive_files = drive_files
+        self.email = email
+        self.metadata_counts = defaultdict(list)
+        self.duplicates = []
+
+    def add(self, df):
+        perms = tuple(sorted(
+            (p['type'], p.get('role'), p.get('emailAddress')) for p in df.permissions))
+        if ('user', 'owner', self.email) in perms:
+            self.metadata_counts[(
+                df.name, tuple(sorted(df.parent_ids)), df.size, df.md5_checksum, perms,
+            )].append(df.id)
+
+    def finish(self):
+        for file_ids in self.metadata_counts.values():
+            if len(file_ids) > 1:
+                LOGGER.warning('{} copies of path: {}'.format(
+                    len(file_ids), self.drive_files.get(file_ids[0]).path))
+                self.duplicates.append(file_ids)
+        self.metadata_counts = defaultdict(list)
+
+
+class LargestAnalyzer(SummaryAnalyzer):
+    # The num_files largest files, kept in a bounded heap
+    description = 'largest files by size'
+
+    def __init__(self, num_files):
+        self.num_files = num_files
+        self.heap = []
+        self.num_added = 0
+
+    def add(self, df):
+        # num_added breaks ties, so files themselves are never compared
+        item = (df.size, -self.num_added, df)
+        self.num_added += 1
+        if len(self.heap) < self.num_files:
+            heapq.heappush(self.heap, item)
+        elif item[:2] > self.heap[0][:2]:
+            heapq.heapreplace(self.heap, item)
+
+    def finish(self):
+        LOGGER.info('Listing {} largest files by size'.format(self.num_files))
+        for (_, _, df) in sorted(self.heap, key=lambda item: item[:2], reverse=True):
+            LOGGER.info('{:<8} {}'.format(df.human_friendly_size, df))
+
+
+SUMMARY_CHECKS = (
+    'errors', 'trashed', 'no-name', 'top-level', 'multiple-parents', 'duplicate-content',
+    'duplicate-metadata', 'largest',
+)
+
+
+def get_summary_analyzers(checks, drive_files, root_id=None, email=None, num_top_files=100):
+    # Analyzers for the named checks, in the order of SUMMARY_CHECKS
+    analyzers = dict(
+        (check, analyzer) for (check, analyzer) in (
+            ('errors', ErrorAnalyzer),
+            ('trashed', TrashedAnalyzer),
+            ('no-name', NoNameAnalyzer),
+            ('top-level', lambda: TopLevelAnalyzer(root_id)),
+            ('multiple-parents', MultipleParentsAnalyzer),
+            ('duplicate-content', lambda: DuplicateContentAnalyzer(drive_files)),
+            ('duplicate-metadata', lambda: DuplicateMetadataAnalyzer(drive_files, email)),
+            ('largest', lambda: LargestAnalyzer(num_top_files)),
+        ))
+    return [analyzers[check]() for check in SUMMARY_CHECKS if check in checks]
+
+
+def summarize_drive_files(drive_files, analyzers):
+    # Run the analyzers over the files in one pass
+    LOGGER.info('Checking for {}'.format(', '.join(a.description for a in analyzers)))
+    for df in drive_files.list():
+        for analyzer in analyzers:
+            analyzer.add(df)
+    for analyzer in analyzers:
+        analyzer.finish()
+
+
+GOOGLE_APPS_MIME_TYPE = 'application/vnd.google-apps'
+PLAN_OPERATIONS = ('remove_permission', 'copy', 'delete', 'transfer')
+
+
+def get_operation_id(operation):
+    return '{}:{}'.format(operation['op'], operation['file_id'])
+
+
+def write_plan(operations, path):
+    # Write operations to a jsonl plan, replacing it atomically
+    LOGGER.info('Writing plan to {}'.format(path))
+    tmp_path = path + '.tmp'
+    num_operations = 0
+    with open(tmp_path, 'w') as f:
+        for operation in operations:
+            if operation['op'] not in PLAN_OPERATIONS:
+                raise ValueError('unknown operation {}'.format(operation['op']))
+            f.write(json.dumps(operation) + '\n')
+            num_operations += 1
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    LOGGER.info('Wrote {} operations'.format(num_operations))
+    return num_operations
+
+
+def read_plan(path, shard=0, num_shards=1):
+    # Read the operations in one shard of a plan; operations are sharded by
+    # file, so that shards can be applied independently (e.g. on different
+    # machines)
+    with open(path) as f:
+        for line in f:
+            operation = json.loads(line)
+            if zlib.crc32(operation['file_id'].encode('utf-8')) % num_shards == shard:
+                yield operation
+
+
+COPY_OF_PROPERTY = 'migrateGoogleCopyOf'
+
+
+def find_copy(files, file_id):
+    response = execute(files.list(
+        q="appProperties has {{ key='{}' and value='{}' }} and trashed = false".format(
+            COPY_OF_PROPERTY, escape_query_string(file_id)),
+        pageSize=1, fields='files(id)'))
+    copies = response.get('files', [])
+    return copies[0]['id'] if copies else None
+
+
+def copy_once(files, file_id, body):
+    # Return the id of a copy of file_id made with body, tagged with the id
+    # of the original so that a copy made by an interrupted run (e.g. one
+    # that crashed before recording it) is found rather than made again
+    copy_id = find_copy(files, file_id)
+    if copy_id is None:
+        LOGGER.info('Copying {}'.format(body.get('name')))
+        body = dict(body, appProperties=dict(body.get('appProperties') or {},
+                                             **{COPY_OF_PROPERTY: file_id}))
+        copy_id = execute(files.copy(
+            fileId=file_id, enforceSingleParent=True, fields='id', body=body))['id']
+    else:
+        LOGGER.info('Found copy {} of {}'.format(copy_id, body.get('name')))
+    return copy_id
+
+
+class MigrationPlanner(object):
+    # Plans the work of the migrate-drive scripts from a jsonl metadata
+    # snapshot instead of the API.  load makes a first pass over the snapshot
+    # to find the files owned by to_email (the folders we may change); the
+    # plan_* methods make a second pass and yield operations for write_plan.
+    def __init__(self, from_email, to_email=None):
+        self.from_email = from_email
+        self.to_email = to_email
+        self.owned_ids = set()
+
+    def load(self, metadata_iter):
+        for metadata in metadata_iter:
+            if not metadata.get('error') and is_owned_by(metadata, self.to_email):
+                self.owned_ids.add(metadata['id'])
+
+    def in_owned_folders(self, metadata):
+        return all(parent_id in self.owned_ids for parent_id in metadata.get('parents') or [])
+
+    def iter_files(self, metadata_iter, owner_email):
+        for metadata in metadata_iter:
+            if not metadata.get('error') and is_owned_by(metadata, owner_email):
+                yield metadata
+
+    def plan_transfer(self, metadata_iter):
+        # migrate-drive-1: give Google Docs owned by from_email to to_email
+        for f in self.iter_files(metadata_iter, self.from_email):
+            if GOOGLE_APPS_MIME_TYPE in (f.get('mimeType') or ''):
+                yield dict(op='transfer', file_id=f['id'], name=f.get('name'),
+                           email=self.to_email)
+
+    def plan_remove_shared(self, metadata_iter):
+        # migrate-drive-2: remove from_email from files owned by to_email
+        for f in self.iter_files(metadata_iter, self.to_email):
+            if any(p.get('type') == 'user' and p.get('role') != 'owner' and
+                   p.get('emailAddress') == self.from_email
+                   for p in f.get('permissions') or []):
+                if not self.in_owned_folders(f):
+                    LOGGER.warning('Skipping {} in folder owned by someone else'.format(f.get('name')))
+                else:
+                    yield dict(op='remove_permission', file_id=f['id'], name=f.get('name'),
+                               email=self.from_email)
+
+    def plan_copy(self, metadata_iter):
+        # migrate-drive-3: copy files owned by from_email to to_email, then
+        # unshare the copy with from_email and the original with to_email
+        for f in self.iter_files(metadata_iter, self.from_email):
+            if GOOGLE_APPS_MIME_TYPE not in (f.get('mimeType') or ''):
+                if not self.in_owned_folders(f):
+                    LOGGER.warning('Skipping {} in folder owned by someone else'.format(f.get('name')))
+                else:
+                    if 'starred' not in f:
+                        raise ValueError('snapshot has no starred field for {}; download '
+                                         'it again to plan copies'.format(f['id']))
+                    yield dict(op='copy', file_id=f['id'], name=f.get('name'),
+                               starred=f['starred'],
+                               remove_from_copy=self.from_email,
+                               remove_from_original=self.to_email)
+
+    def plan_delete_orphans(self, metadata_iter):
+        # migrate-drive-4: delete unshared files owned by from_email that
+        # have no parents
+        for f in self.iter_files(metadata_iter, self.from_email):
+            if (GOOGLE_APPS_MIME_TYPE not in (f.get('mimeType') or '') and
+                    not f.get('parents') and
+                    all(p.get('type') == 'user' and p.get('emailAddress') == self.from_email
+                        for p in f.get('permissions') or [])):
+                yield dict(op='delete', file_id=f['id'], name=f.get('name'),
+                           if_unshared=self.from_email)
+
+
+class PlanExecutor(object):
+    # Applies a plan with a pool of workers, each with its own service from
+    # service_factory; requests go through execute, so they share its rate
+    # limit and retries.  Every operation can be repeated safely: removing a
+    # permission or deleting a file that is already gone succeeds, and
+    # copies are made with copy_once.
+
+    def __init__(self, service_factory, num_workers=8, max_pending=1000):
+        self.service_factory = service_factory
+        self.num_workers = num_workers
+        self.max_pending = max_pending
+        self.local = threading.local()
+
+    def apply(self, operations, checkpoint=None):
+        # Yield (operation, error) in plan order, where error is None on
+        # success or else the HTTP status of the failure.  Successful
+        # operations are marked done in checkpoint, if given, and skipped
+        # when the plan is applied again.  Transfers to the same owner are
+        # grouped and applied by one worker with an OwnershipTransferer, so
+        # that they are batched; each group is yielded when it is full (or
+        # at the end), rather than in plan order.
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            pending = deque()
+            transfers = defaultdict(list)
+            for operation in operations:
+                if checkpoint is not None and checkpoint.is_done(get_operation_id(operation)):
+                    continue
+                if operation['op'] == 'transfer':
+                    group = transfers[operation['email']]
+                    group.append(operation)
+                    if len(group) < OwnershipTransferer.BATCH_SIZE:
+                        continue
+                    del transfers[operation['email']]
+                    pending.append((group, executor.submit(self.transfer_in_worker, group)))
+                else:
+                    pending.append(([operation], executor.submit(self.apply_in_worker, operation)))
+                while len(pending) > self.max_pending:
+                    for result in self.finish(pending.popleft(), checkpoint):
+                        yield result
+
+            for group in transfers.values():
+                pending.append((group, executor.submit(self.transfer_in_worker, group)))
+            while pending:
+                for result in self.finish(pending.popleft(), checkpoint):
+                    yield result
+
+    def finish(self, pending, checkpoint):
+        (operations, future) = pending
+        errors = future.result()
+        for (operation, error) in zip(operations, errors):
+            if error is None and checkpoint is not None:
+                checkpoint.mark_done(get_operation_id(operation))
+        return zip(operations, errors)
+
+    def get_service(self):
+        if getattr(self.local, 'service', None) is None:
+            self.local.service = self.service_factory()
+        return self.local.service
+
+    def apply_in_worker(self, operation):
+        try:
+            return [getattr(self, 'apply_' + operation['op'])(self.get_service(), operation)]
+        except HttpError as ex:
+            LOGGER.warning('Failed to {} {}: {}'.format(
+                operation['op'], operation.get('name'), ex))
+            return [ex.resp.status]
+
+    def transfer_in_worker(self, operations):
+        LOGGER.info('Changing owner of {} files to {}'.format(
+            len(operations), operations[0]['email']))
+        transferer = OwnershipTransferer(self.get_service(), operations[0]['email'])
+        try:
+            results = transferer.transfer(
+                [dict(id=operation['file_id'], name=operation.get('name'))
+                 for operation in operations])
+        except HttpError as ex:
+            LOGGER.warning('Failed to change owner of {} files: {}'.format(len(operations), ex))
+            return [ex.resp.status] * len(operations)
+        return [results.get(operation['file_id']) for operation in operations]
+
+    def apply_remove_permission(self, service, operation):
+        LOGGER.info('Removing {} from {}'.format(operation['email'], operation.get('name')))
+        try:
+            remove_user_permissions(service.permissions(), operation['file_id'], operation['email'])
+        except HttpError as ex:
+            if ex.resp.status != 404:
+                raise
+
+    def apply_copy(self, service, operation):
+        files = service.files()
+        perms = service.permissions()
+        copy_id = copy_once(files, operation['file_id'], dict(
+            name=operation.get('name'), starred=operation.get('starred', False)))
+        remove_user_permissions(perms, copy_id, operation['remove_from_copy'])
+        LOGGER.debug('Copied file id: {}; removing {} from {}'.format(
+            copy_id, operation['remove_from_original'], operation['file_id']))
+        remove_user_permissions(perms, operation['file_id'], operation['remove_from_original'])
+
+    def apply_delete(self, service, operation):
+        files = service.files()
+        if operation.get('keep') is not None:
+            # Make sure this is still a copy of the one we are keeping, as
+            # when deleting duplicates directly
+            remover = DuplicateRemover(service, same_path=operation.get('same_path', True))
+            if not remover.verify_duplicate(operation['file_id'], operation['keep']):
+                LOGGER.warning('Not deleting {}: no longer a copy of {}'.format(
+                    operation.get('name'), operation['keep']))
+                return
+        if operation.get('if_unshared') is not None:
+            # Planned by plan_delete_orphans: make sure it is still an orphan
+            # owned by if_unshared and shared with no one else
+            try:
+                f = execute(files.get(
+                    fileId=operation['file_id'], fields='parents, owners(emailAddress)'))
+                if f.get('parents'):
+                    LOGGER.warning('Not deleting {}: no longer an orphan'.format(
+                        operation.get('name')))
+                    return
+                if [o.get('emailAddress') for o in f.get('owners', [])] != [
+                        operation['if_unshared']]:
+                    LOGGER.warning('Not deleting {}: no longer owned by {}'.format(
+                        operation.get('name'), operation['if_unshared']))
+                    return
+                perm_request = service.permissions().list(
+                    fileId=operation['file_id'], pageSize=10,
+                    fields="nextPageToken, permissions(id, type, emailAddress)")
+                for (p, _) in service_method_iter(
+                        perm_request, 'permissions', service.permissions().list_next):
+                    if p['type'] != 'user' or p.get('emailAddress') != operation['if_unshared']:
+                        LOGGER.warning('Not deleting shared file {}'.format(operation.get('name')))
+                        return
+            except HttpError as ex:
+                if ex.resp.status != 404:
+                    raise
+                return
+        LOGGER.info('Deleting {}'.format(operation.get('name')))
+        try:
+            execute(files.delete(fileId=operation['file_id']))
+        except HttpError as ex:
+            if ex.resp.status != 404:
+                raise
+
+
+def load_manifest(path):
+    # Read a json manifest of accounts for AccountOrchestrator:
+    #   {"jobs": [default jobs],
+    #    "accounts": [{"name": ..., "credentials_path": ..., "max_rate": ...,
+    #                  "jobs": [jobs overriding the defaults], ...}, ...]}
+    # where each job is {"script": ..., "args": [...], "credentials": true}.
+    # Relative credentials paths are taken from the manifest's directory.
+    with open(path) as f:
+        manifest = json.load(f)
+    manifest_dir = os.path.dirname(os.path.abspath(path))
+    names = set()
+    for account in manifest.get('accounts', []):
+        for key in ('name', 'credentials_path'):
+            if key not in account:
+                raise ValueError('account in {} has no {}'.format(path, key))
+        if account['name'] in names:
+            raise ValueError('account {} appears twice in {}'.format(account['name'], path))
+        names.add(account['name'])
+        account['credentials_path'] = os.path.join(manifest_dir, account['credentials_path'])
+        account.setdefault('jobs', manifest.get('jobs', []))
+        for job in account['jobs']:
+            if 'script' not in job:
+                raise ValueError('job for account {} has no script'.format(account['name']))
+    return manifest
+
+
+class AccountOrchestrator(object):
+    # Runs the jobs of many accounts, up to num_workers at a time.  Each job
+    # runs one of the scripts in its own process, within a working directory
+    # per account so that tokens, logs, checkpoints and caches stay apart,
+    # and with the account's own request rate limit (max_rate from the
+    # account, or else the default).  Job args are formatted with the
+    # account's fields, e.g. "{name}.jsonl"; jobs with credentials (the
+    # default) are given the account's credentials path first.  An account's
+    # jobs run in order, each retried up to retries times (the scripts resume
+    # from their checkpoints), and stop at the first that fails.  The status
+    # of every account and job, with the request metrics of each job, is
+    # saved to status_path as it changes.
+    METRICS_NAME = '{}-metrics.json'
+    LOG_NAME = '{}-output.log'
+
+    def __init__(self, manifest, work_dir, script_dir, num_workers=4, max_rate=None,
+                 retries=0, status_path=None, python=sys.executable):
+        self.accounts = manifest.get('accounts', [])
+        self.work_dir = work_dir
+        self.script_dir = script_dir
+        self.num_workers = num_workers
+        self.max_rate = max_rate
+        self.retries = retries
+        self.status_path = status_path
+        self.python = python
+        self.lock = threading.Lock()
+        self.status = OrderedDict(
+            (account['name'], dict(
+                state='pending',
+                work_dir=os.path.join(work_dir, account['name']),
+                jobs=[dict(script=job['script'], state='pending', attempts=0)
+                      for job in account['jobs']],
+            ))
+            for account in self.accounts)
+
+    def run(self):
+        # Return the status of every account once all have finished
+        LOGGER.info('Running jobs for {} accounts with {} workers'.format(
+            len(self.accounts), self.num_workers))
+        self.save_status()
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            for future in [executor.submit(self.run_account, a) for a in self.accounts]:
+                future.result()
+        num_failed = sum(1 for status in self.status.values() if status['state'] == 'failed')
+        LOGGER.info('{} accounts succeeded; {} failed'.format(
+            len(self.accounts) - num_failed, num_failed))
+        return self.status
+
+    def run_account(self, account):
+        status = self.status[account['name']]
+        os.makedirs(status['work_dir'], exist_ok=True)
+        self.update(status, state='running')
+        for (i, job) in enumerate(account['jobs']):
+            job_status = status['jobs'][i]
+            while True:
+                self.update(job_status, state='running', attempts=job_status['attempts'] + 1,
+                            started=time.time())
+                returncode = self.run_job(account, i, job, status['work_dir'], job_status)
+                self.update(job_status, returncode=returncode, finished=time.time(),
+                            metrics=self.read_metrics(job_status.get('metrics_path')))
+                if returncode == 0 or job_status['attempts'] > self.retries:
+                    break
+                LOGGER.warning('Retrying {} for {} after exit status {}'.format(
+                    job['script'], account['name'], returncode))
+            if returncode != 0:
+                LOGGER.warning('{} failed for {} with exit status {}; see {}'.format(
+                    job['script'], account['name'], returncode, job_status['log_path']))
+                self.update(job_status, state='failed')
+                self.update(status, state='failed')
+                return
+            self.update(job_status, state='succeeded')
+        LOGGER.info('Finished jobs for {}'.format(account['name']))
+        self.update(status, state='succeeded')
+
+    def run_job(self, account, i, job, work_dir, job_status):
+        job_name = '{}-{}'.format(i, os.path.splitext(os.path.basename(job['script']))[0])
+        args = [self.python, os.path.join(self.script_dir, job['script'])]
+        if job.get('credentials', True):
+            metrics_path = os.path.join(work_dir, self.METRICS_NAME.format(job_name))
+            max_rate = account.get('max_rate', self.max_rate)
+            args.append(account['credentials_path'])
+            args.extend(['--metrics', metrics_path])
+            if max_rate is not None:
+                args.extend(['--max-rate', str(max_rate)])
+            self.update(job_status, metrics_path=metrics_path)
+        args.extend(str(arg).format(**account) for arg in job.get('args', []))
+        log_path = os.path.join(work_dir, self.LOG_NAME.format(job_name))
+        self.update(job_status, log_path=log_path)
+
+        LOGGER.info('Running {} for {}'.format(job['script'], account['name']))
+        LOGGER.debug('Running {} in {}'.format(' '.join(args), work_dir))
+        with open(log_path, 'a') as log_file:
+            return subprocess.run(
+                args, cwd=work_dir, stdin=subprocess.DEVNULL, stdout=log_file,
+                stderr=subprocess.STDOUT).returncode
+
+    def read_metrics(self, metrics_path):
+        if metrics_path is None or not os.path.exists(metrics_path):
+            return None
+        with open(metrics_path) as f:
+            metrics = json.load(f)
+        endpoints = metrics.get('endpoints', {}).values()
+        # Only the totals, to keep the status small
+        return dict(
+            elapsed_seconds=metrics.get('elapsed_seconds'),
+            throttled_seconds=metrics.get('throttled_seconds'),
+            quota_errors=metrics.get('quota_errors'),
+            requests=sum(stats['cost'] for stats in endpoints),
+            items=sum(stats['items'] for stats in endpoints),
+            retries=sum(stats['retries'] for stats in endpoints),
+            failures=sum(stats['failures'] for stats in endpoints))
+
+    def update(self, status, **kwargs):
+        with self.lock:
+            status.update(kwargs)
+        self.save_status()
+
+    def save_status(self):
+        if self.status_path is not None:
+            with self.lock:
+                tmp_path = self.status_path + '.tmp'
+                with open(tmp_path, 'w') as f:
+                    json.dump(self.status, f, indent=2)
+                os.replace(tmp_path, self.status_path)
+
+
+class AsyncDriveClient(object):
+    # Non-blocking client for the Drive v3 REST API on an aiohttp session
+    # (an optional dependency), whose connection pool keeps up to
+    # max_connections connections alive.  Requests share the rate limiter and
+    # retry policies of EXECUTOR, and errors are raised as HttpError just as
+    # from googleapiclient.  Use as an async context manager:
+    #   async with AsyncDriveClient(creds) as client: ...
+    BASE_URL = 'https://www.googleapis.com/drive/v3/'
+
+    def __init__(self, creds, max_connections=100, timeout=60, executor=None):
+        if aiohttp is None:
+            raise ImportError('AsyncDriveClient requires aiohttp')
+        self.creds = creds
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.executor = executor if executor is not None else EXECUTOR
+        self.session = None
+        self.refresh_lock = None
+
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=self.timeout))
+        self.refresh_lock = asyncio.Lock()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def get_token(self):
+        async with self.refresh_lock:
+            if not self.creds.valid:
+                LOGGER.debug('Refreshing token')
+                await asyncio.get_running_loop().run_in_executor(
+                    None, self.creds.refresh, Request())
+        return self.creds.token
+
+    def get_params(self, params):
+        return dict(
+            (k, str(v).lower() if isinstance(v, bool) else v)
+            for (k, v) in (params or {}).items() if v is not None)
+
+    METHOD_NAMES = dict(GET='get', POST='create', PATCH='update', DELETE='delete')
+    # Methods named by the last part of their path, e.g. files/<id>/copy
+    CUSTOM_METHODS = dict(
+        copy='copy', export='export', watch='watch', generateIds='generateIds',
+        startPageToken='getStartPageToken')
+
+    def get_endpoint(self, method, path):
+        # Name the endpoint as googleapiclient does, e.g. files/<id>/permissions
+        # as drive.permissions.list for GET
+        parts = path.split('/')
+        if len(parts) > 1 and parts[-1] in self.CUSTOM_METHODS:
+            return 'drive.{}.{}'.format(
+                parts[-2] if len(parts) % 2 == 0 else parts[-3],
+                self.CUSTOM_METHODS[parts[-1]])
+        elif len(parts) % 2 == 1:
+            return 'drive.{}.{}'.format(parts[-1], 'list' if method == 'GET' else 'create')
+        else:
+            return 'drive.{}.{}'.format(parts[-2], self.METHOD_NAMES.get(method, method.lower()))
+
+    async def request(self, method, path, params=None, body=None, cost=1, idempotent=None):
+        # As RequestExecutor.execute, but a POST (which creates something in
+        # Drive) is only retried on quota errors unless idempotent is given
+        rate_limiter = self.executor.rate_limiter
+        metrics = self.executor.metrics
+        endpoint = self.get_endpoint(method, path)
+        if idempotent is None:
+            idempotent = method != 'POST'
+        attempt = 0
+        while True:
+            if rate_limiter is not None:
+                wait = rate_limiter.reserve(cost)
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                    if metrics is not None:
+                        metrics.record_throttle(wait)
+            start = time.monotonic()
+            try:
+                headers = {'Authorization': 'Bearer {}'.format(await self.get_token())}
+                async with self.session.request(
+                        method, self.BASE_URL + path, params=self.get_params(params),
+                        json=body, headers=headers) as response:
+                    content = await response.read()
+                    if response.status >= 400:
+                        raise HttpError(
+                            httplib2.Response({'status': response.status}), content,
+                            uri=str(response.url))
+            except (HttpError, aiohttp.ClientError, asyncio.TimeoutError) as ex:
+                if not self.executor.should_retry(ex, attempt, endpoint, idempotent):
+                    raise
+                delay = self.executor.backoff(attempt)
+                LOGGER.warning('Retrying in {:.1f}s after exception: {}'.format(delay, ex))
+                await asyncio.sleep(delay)
+                attempt += 1
+            else:
+                if metrics is not None:
+                    metrics.record_request(endpoint, time.monotonic() - start, len(content), cost)
+                if rate_limiter is not None:
+                    rate_limiter.on_success()
+                return json.loads(content) if content else {}
+
+
+async def async_service_page_iter(client, path, params, response_key):
+    # Like service_page_iter, for a GET of path with params on client
+    params = dict(params)
+    while True:
+        response = await client.request('GET', path, params=params)
+        items = response.get(response_key, [])
+        if client.executor.metrics is not None:
+            client.executor.metrics.record_items(client.get_endpoint('GET', path), len(items))
+        yield [
+            (
+                item,
+                dict(next_page_token=response.get('nextPageToken'),
+                     item_index=i,
+                     num_items=len(items)),
+            )
+            for (i, item) in enumerate(items)
+        ]
+        if response.get('nextPageToken') is None:
+            break
+        params['pageToken'] = response['nextPageToken']
+
+
+async def async_service_method_iter(client, path, params, response_key):
+    async for page in async_service_page_iter(client, path, params, response_key):
+        for (item, batch_info) in page:
+            yield (item, batch_info)
+
+
+async def async_get_child_by_name(client, parent_id, name, fields):
+    params = get_child_by_name_params(parent_id, name, fields)
+    child = None
+    async for (f, _) in async_service_method_iter(client, 'files', params, 'files'):
+        child = keep_first_child(child, f, name)
+    return child
+
+
+async def async_resolve_path(names, client, fields, path_cache):
+    # Returns None if an entry from path_cache turned out to be stale, after
+    # invalidating the entries used.
+    lookups = iter_path_lookups(names, path_cache)
+    f = None
+    try:
+        while True:
+            (parent_id, name) = lookups.send(f)
+            f = await async_get_child_by_name(client, parent_id, name, fields)
+    except StopIteration as ex:
+        return ex.value
+
+
+async def async_get_file_by_path(path, client, fields=('id', 'name'), path_cache=None):
+    (names, fields) = split_path(path, fields)
+    if names:
+        f = None
+        while f is None:
+            f = await async_resolve_path(names, client, fields, path_cache)
+            if f is None:
+                LOGGER.debug('Cached path {} is stale, resolving again'.format(path))
         return f
 
-    def get(self, file_id):
-        if file_id not in self.file_map:
-            self.file_map[file_id] = DriveFile(dict(id=file_id), self)
-            self.root_ids.add(file_id)
-        return self.file_map[file_id]
+    else:
+        return await client.request('GET', 'files/root', params=dict(fields=', '.join(fields)))
 
-    def list(self):
-        return self.file_map.values()
+
+async def async_list_children(client, parent_ids, fields):
+    params = list_children_params(parent_ids, fields)
+    children = dict((parent_id, []) for parent_id in parent_ids)
+    async for (f, _) in async_service_method_iter(client, 'files', params, 'files'):
+        add_child(children, f, fields)
+    return children
+
+
+async def async_walk(path, client, fields=('id', 'name', 'mimeType'), folders_per_query=20,
+                     max_pending=16, path_cache=None):
+    # Like walk, with up to max_pending queries in flight at once
+    fields = tuple(set(fields).union({'id', 'name', 'mimeType'}))
+
+    root = await async_get_file_by_path(path, client, fields=fields, path_cache=path_cache)
+    unlisted = deque([root])
+    seen = {root['id']}
+    pending = deque()
+    try:
+        while unlisted or pending:
+            while unlisted and len(pending) < max_pending:
+                group = pop_group(unlisted, folders_per_query)
+                pending.append((group, asyncio.ensure_future(async_list_children(
+                    client, [parent['id'] for parent in group], fields))))
+
+            (group, task) = pending.popleft()
+            for entry in walk_group(group, await task, seen, unlisted):
+                yield entry
+    finally:
+        for (_, task) in pending:
+            task.cancel()
+
+
+class AsyncFileMetadataDownloader(FileMetadataDownloader):
+    # Downloads metadata on an AsyncDriveClient: permissions are looked up
+    # concurrently, with up to max_pending_files files in flight while the
+    # listing continues, and metadata is yielded in listing order.
+    def __init__(self, client, max_pending_files=1000, **kwargs):
+        super().__init__(None, None, **kwargs)
+        self.client = client
+        self.max_pending_files = max_pending_files
+
+    async def list(self, page_token=None):
+        LOGGER.debug('Listing files ...')
+        params = dict(
+            pageToken=page_token,
+            pageSize=100,
+            fields='nextPageToken, files({})'.format(', '.join(self.get_list_fields())))
+        pending = deque()
+        try:
+            async for page in async_service_page_iter(self.client, 'files', params, 'files'):
+                for (f, batch_info) in page:
+                    LOGGER.info('Downloading metadata for {}'.format(f['name']))
+                    metadata = self.new_metadata(f, batch_info)
+                    if f.get('permissions') is not None:
+                        metadata['permissions'] = [self.filter_perm(p) for p in f['permissions']]
+                        task = None
+                    else:
+                        task = asyncio.ensure_future(self.get_permissions(f['id'], metadata))
+                    pending.append((metadata, task))
+
+                while len(pending) > self.max_pending_files:
+                    yield await self.finish(pending.popleft())
+
+            while pending:
+                yield await self.finish(pending.popleft())
+        finally:
+            for (_, task) in pending:
+                if task is not None:
+                    task.cancel()
+
+    async def finish(self, pending):
+        (metadata, task) = pending
+        if task is not None:
+            await task
+        return metadata
+
+    async def get(self, f, batch_info):
+        metadata = self.new_metadata(f, batch_info)
+        await self.get_permissions(f['id'], metadata)
+        return metadata
+
+    async def get_permissions(self, file_id, metadata):
+        params = dict(
+            pageSize=100,
+            fields='nextPageToken, permissions({})'.format(', '.join(self.perm_fields)))
+        try:
+            async for (p, _) in async_service_method_iter(
+                    self.client, 'files/{}/permissions'.format(file_id), params, 'permissions'):
+                metadata['permissions'].append(self.filter_perm(p))
+
+        except HttpError as ex:
+            self.set_error(metadata, ex)
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+import os
+
+from migrate_google import LOGGER, configure_logging, load_manifest, AccountOrchestrator
+
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Run download/migrate scripts for many accounts from a '
+                                        'manifest, several accounts at a time')
+    parser.add_argument('manifest_path',
+                        help='Path to json manifest: {"jobs": [{"script": ..., "args": [...]}], '
+                             '"accounts": [{"name": ..., "credentials_path": ..., '
+                             '"max_rate": ...}]}')
+    parser.add_argument('--work-dir', default='accounts',
+                        help='Directory under which each account gets a working directory '
+                             'for its tokens, logs, checkpoints and output')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Number of accounts to run jobs for at once')
+    parser.add_argument('--max-rate', type=float,
+                        help='Maximum number of API requests per second for each account '
+                             'without its own max_rate (default: unlimited)')
+    parser.add_argument('--retries', type=int, default=0,
+                        help='Number of times to rerun a failed job, resuming from its checkpoint')
+    parser.add_argument('--accounts', nargs='+',
+                        help='Names of the accounts to run jobs for (default: all)')
+    parser.add_argument('--status',
+                        help='Path to json status report of all accounts and jobs '
+                             '(default: <work dir>/status.json)')
+    args = parser.parse_args()
+
+    configure_logging('orchestrate-drive-accounts.log')
+
+    manifest = load_manifest(args.manifest_path)
+    if args.accounts is not None:
+        unknown = set(args.accounts) - set(a['name'] for a in manifest['accounts'])
+        if unknown:
+            parser.error('unknown accounts: {}'.format(', '.join(sorted(unknown))))
+        manifest['accounts'] = [a for a in manifest['accounts'] if a['name'] in args.accounts]
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    orchestrator = AccountOrchestrator(
+        manifest, os.path.abspath(args.work_dir), os.path.dirname(os.path.abspath(__file__)),
+        num_workers=args.workers, max_rate=args.max_rate, retries=args.retries,
+        status_path=args.status or os.path.join(args.work_dir, 'status.json'))
+    status = orchestrator.run()
+
+    for (name, account_status) in status.items():
+        if account_status['state'] != 'succeeded':
+            LOGGER.warning('{}: {}'.format(name, account_status['state']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+from migrate_google import (
+    LOGGER, configure_logging, read_snapshot, write_plan, MigrationPlanner,
+)
+
+
+PLANS = {
+    'transfer': ('plan_transfer', 'Change owner of Google Docs to new email (migrate-drive-1)'),
+    'remove-shared': ('plan_remove_shared',
+                      'Remove old email from files owned by new email (migrate-drive-2)'),
+    'copy': ('plan_copy',
+             'Copy files shared from old email and remove shared versions (migrate-drive-3)'),
+    'delete-orphans': ('plan_delete_orphans',
+                       'Remove unshared orphaned files of old email (migrate-drive-4)'),
+}
+
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Plan a migration offline from a metadata snapshot; '
+                                        'apply the plan with apply-drive-plan.py')
+    parser.add_argument('plan', choices=sorted(PLANS),
+                        help='Kind of plan: ' + '; '.join(
+                            '{}: {}'.format(name, PLANS[name][1]) for name in sorted(PLANS)))
+    parser.add_argument('input_path', help='Path to input jsonl metadata file')
+    parser.add_argument('output_path', help='Path to output jsonl plan file')
+    parser.add_argument('from_email', help='Email address of old account')
+    parser.add_argument('to_email', nargs='?', help='Email address of new account '
+                                                    '(not needed for delete-orphans)')
+    args = parser.parse_args()
+    if args.to_email is None and args.plan != 'delete-orphans':
+        parser.error('to_email is required for {} plans'.format(args.plan))
+
+    configure_logging()
+
+    planner = MigrationPlanner(args.from_email, args.to_email)
+    LOGGER.info('Loading folder ownership from {}'.format(args.input_path))
+    planner.load(read_snapshot(args.input_path))
+
+    LOGGER.info('Planning {}'.format(args.plan))
+    write_plan(
+        getattr(planner, PLANS[args.plan][0])(read_snapshot(args.input_path)),
+        args.output_path)
+
+
+if __name__ == '__main__':
+    main()
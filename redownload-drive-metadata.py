@@ -1,13 +1,16 @@
 #!/usr/bin/env python3
 
 import os
-import json
-import time
+import shutil
 
 from googleapiclient.errors import HttpError
 from googleapiclient.discovery import build
 
-from migrate_google import LOGGER, authenticate, configure_logging, FileMetadataDownloader
+from migrate_google import (
+    LOGGER, authenticate, configure_logging, configure_requests, execute,
+    Checkpoint, FileMetadataDownloader, PipelinedFileMetadataDownloader, get_changes_token_path,
+    is_snapshot_complete, iter_snapshot_pages, open_snapshot_writer,
+)
 
 
 def main():
@@ -17,40 +20,75 @@ def main():
     parser.add_argument('credentials_path', help='Path to credentials json file')
     parser.add_argument('input_path', help='Path to input jsonl file')
     parser.add_argument('output_path', help='Path to output jsonl file')
-    parser.add_argument('--sleep', type=float,
-                        help='Amount of time to sleep between files')
+    parser.add_argument('--max-rate', type=float,
+                        help='Maximum number of API requests per second '
+                             '(default: unlimited)')
+    parser.add_argument('--metrics',
+                        help='Path to write metrics of API requests to as json')
+    parser.add_argument('--progress-interval', type=float,
+                        help='Log request progress every this many seconds')
+    parser.add_argument('--batch', action='store_true',
+                        help='Fetch permissions for each page of files in batch requests')
+    parser.add_argument('--inline-permissions', action='store_true',
+                        help='Request permissions in the file listing where we have access')
+    parser.add_argument('--workers', type=int,
+                        help='Number of threads fetching permissions concurrently')
+    parser.add_argument('--checkpoint',
+                        help='Path to checkpoint journal for resuming '
+                             '(default: <output_path>.checkpoint)')
+    parser.add_argument('--input-checkpoint',
+                        help='Path to checkpoint journal of the download that wrote the input '
+                             '(default: <input_path>.checkpoint)')
     args = parser.parse_args()
+    if not is_snapshot_complete(args.input_path, checkpoint_path=args.input_checkpoint):
+        parser.error('{} is from an unfinished download; resume it with '
+                     'download-drive-metadata.py first'.format(args.input_path))
 
     credentials_name = os.path.splitext(os.path.basename(args.credentials_path))[0]
     configure_logging('redownload-drive-metadata-{}.log'.format(credentials_name))
+    configure_requests(max_rate=args.max_rate, metrics_path=args.metrics,
+                       progress_interval=args.progress_interval)
 
     creds = authenticate(args.credentials_path, token_path=credentials_name + '.pickle')
     service = build('drive', 'v3', credentials=creds)
     files = service.files()
     perms = service.permissions()
 
-    with open(args.input_path) as input_file, open(args.output_path, 'w') as output_file:
-        downloader = FileMetadataDownloader(files, perms)
-        page_token = None
-        batch_info = None
+    # The output can be synced from the same point in the changes feed
+    if os.path.exists(get_changes_token_path(args.input_path)):
+        shutil.copyfile(get_changes_token_path(args.input_path),
+                        get_changes_token_path(args.output_path))
+
+    with open_snapshot_writer(args.output_path, mode='a') as output_file:
+        try:
+            checkpoint = Checkpoint(
+                args.checkpoint or args.output_path + '.checkpoint', output_file=output_file,
+                config=dict(input_path=os.path.abspath(args.input_path)))
+        except ValueError as ex:
+            parser.error(str(ex))
+        output_file.truncate(checkpoint.offset or 0)
+
+        if args.workers:
+            downloader = PipelinedFileMetadataDownloader(
+                lambda: build('drive', 'v3', credentials=creds),
+                num_workers=args.workers,
+                batch=args.batch,
+                inline_permissions=args.inline_permissions)
+        else:
+            downloader = FileMetadataDownloader(
+                files, perms,
+                service=service if args.batch else None,
+                inline_permissions=args.inline_permissions)
 
         LOGGER.info('Looking for files with errors ...')
-        for line in input_file:
-            metadata = json.loads(line)
-
-            old_batch_info = batch_info
-            batch_info = metadata['batch_info']
-            if old_batch_info is not None and (
-                    batch_info['next_page_token'] !=
-                    old_batch_info['next_page_token']):
-                page_token = old_batch_info['next_page_token']
-
+        for (metadata, _) in checkpoint.iter(iter_snapshot_pages(
+                args.input_path, start=int(checkpoint.page_token or 0))):
             if metadata['error']:
                 LOGGER.info('Redownloading metadata for {}'.format(metadata['name']))
                 try:
-                    f = files.get(
+                    f = execute(files.get(
                         fileId=metadata['id'],
-                        fields=', '.join(FileMetadataDownloader.DEFAULT_FILE_FIELDS)).execute()
+                        fields=', '.join(FileMetadataDownloader.DEFAULT_FILE_FIELDS)))
                 except HttpError as ex:
                     if ex.resp.status == 404:
                         LOGGER.warning('Skipping file, caught 404: {}'.format(ex))
@@ -59,31 +97,13 @@ def main():
                         raise ex
                 else:
                     metadata = downloader.get(f, metadata['batch_info'])
-                    if args.sleep:
-                        time.sleep(args.sleep)
-
-            output_file.write(json.dumps(metadata) + '\n')
 
-        if batch_info is not None:
-            if batch_info['item_index'] + 1 == batch_info['num_items']:
-                page_token = batch_info['next_page_token']
-                skip = 0
-            elif page_token is not None:
-                skip = batch_info['item_index'] + 1
-            else:
-                raise Exception('Previous pagination stopped in middle of batch and '
-                                'we have no page token')
-
-            if page_token is not None:
-                LOGGER.info('Continuing pagination')
-                for metadata in downloader.list(page_token=page_token):
-                    if skip > 0:
-                        skip -= 1
-                    else:
-                        output_file.write(json.dumps(metadata) + '\n')
-                        if args.sleep:
-                            time.sleep(args.sleep)
+            output_file.write(metadata)
 
+        if not checkpoint.complete:
+            # Nothing in the input
+            checkpoint.end_page(None)
+        checkpoint.close()
 
 if __name__ == '__main__':
     main()
@@ -1,14 +1,14 @@
 #!/usr/bin/env python3
 
 import os
-import json
-import time
-from collections import defaultdict
 
 from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
 
-from migrate_google import LOGGER, authenticate, configure_logging, DriveFiles
+from migrate_google import (
+    LOGGER, authenticate, configure_logging, configure_requests, execute, load_drive_files,
+    get_summary_analyzers, summarize_drive_files, find_duplicates, Checkpoint,
+    DuplicateRemover, SUMMARY_CHECKS, write_plan,
+)
 
 
 def main():
@@ -17,96 +17,97 @@ def main():
     parser.add_argument('credentials_path', help='Path to credentials json file')
     parser.add_argument('email', help='Email address to use when filtering')
     parser.add_argument('input_path', help='Path to input jsonl metadata file')
+    parser.add_argument('--index', help='Path to SQLite index of metadata, '
+                                        'built if missing or out of date')
+    parser.add_argument('--canonical-paths', action='store_true',
+                        help='Show one path through the first parent for files '
+                             'with multiple parents')
+    parser.add_argument('--checks', nargs='+', choices=SUMMARY_CHECKS,
+                        default=list(SUMMARY_CHECKS),
+                        help='Checks to run, all in one pass over the files (default: all)')
     parser.add_argument('--num-top-files', type=int, default=100,
                         help='Number of top (largest) files to show')
-    parser.add_argument('--sleep', type=float,
-                        help='Amount of time to sleep between modifying files')
+    parser.add_argument('--max-rate', type=float,
+                        help='Maximum number of API requests per second '
+                             '(default: unlimited)')
+    parser.add_argument('--metrics',
+                        help='Path to write metrics of API requests to as json')
+    parser.add_argument('--progress-interval', type=float,
+                        help='Log request progress every this many seconds')
     parser.add_argument('--delete-duplicates', action='store_true',
                         help='Delete all but one copy of each file')
+    parser.add_argument('--plan-output',
+                        help='Write deletion of all but one copy of each file to this plan, '
+                             'to apply with apply-drive-plan.py, instead of deleting')
+    parser.add_argument('--keep', choices=DuplicateRemover.KEEP_POLICIES, default='first',
+                        help='Which copy of each file to keep: the first listed, the oldest '
+                             '(by creation time, when known), the one with the shortest path '
+                             'or the one with the most permissions')
+    parser.add_argument('--any-path', action='store_true',
+                        help='Treat copies in different folders or with different names as '
+                             'duplicates too')
+    parser.add_argument('--batch-size', type=int, default=DuplicateRemover.BATCH_SIZE,
+                        help='Number of files to verify or delete in each batch request')
+    parser.add_argument('--checkpoint',
+                        help='Path to checkpoint journal for resuming duplicate deletion '
+                             '(default: summarize-drive-metadata-<credentials name>.checkpoint)')
     args = parser.parse_args()
 
     credentials_name = os.path.splitext(os.path.basename(args.credentials_path))[0]
     configure_logging('summarize-drive-metadata-{}.log'.format(credentials_name))
+    configure_requests(max_rate=args.max_rate, metrics_path=args.metrics,
+                       progress_interval=args.progress_interval)
 
     creds = authenticate(args.credentials_path, token_path=credentials_name + '.pickle')
     service = build('drive', 'v3', credentials=creds)
     files = service.files()
 
     LOGGER.info('Loading data from {}'.format(args.input_path))
-    drive_files = DriveFiles()
-    with open(args.input_path) as f:
-        for line in f:
-            df = drive_files.add(json.loads(line))
-            if df.error:
-                LOGGER.warning('Error downloading metadata for {}'.format(df))
-
-    LOGGER.info('Checking for trashed files')
-    for df in drive_files.list():
-        if df.trashed:
-            LOGGER.warning('Trashed: {}'.format(df))
-
-    LOGGER.info('Checking for files with no names')
-    for df in drive_files.list():
-        if df.metadata.get('name') is None:
-            LOGGER.warning('No name: {}'.format(df))
-
-    LOGGER.info('Checking for top-level entries beyond root')
-    root_id = files.get(fileId='root').execute()['id']
-    LOGGER.info('Root id: {}'.format(root_id))
-    for df in drive_files.list():
-        if df.id != root_id and not df.parents:
-            LOGGER.warning('Top-level but not root: {}'.format(df))
-
-    LOGGER.info('Checking for multiple parents')
-    for df in drive_files.list():
-        parents = df.parents
-        if len(parents) > 1:
-            LOGGER.warning('{} parents: {}'.format(len(parents), df))
-
-    LOGGER.info('Checking for duplicate content')
-    checksum_counts = defaultdict(list)
-    for df in drive_files.list():
-        checksum_counts[df.md5_checksum].append(df.path)
-    for (cs, paths) in checksum_counts.items():
-        if len(paths) > 1:
-            LOGGER.warning('{} copies of content here and elsewhere: {}'.format(len(paths), paths[0]))
-
-    LOGGER.info('Checking for duplicate content and metadata')
-    metadata_counts = defaultdict(list)
-    for df in drive_files.list():
-        metadata_counts[(
-            df.path,
-            tuple(sorted(df.parent_ids)),
-            df.size,
-            df.md5_checksum,
-            tuple(sorted(
-                (
-                    p['type'],
-                    p.get('role'),
-                    p.get('emailAddress'),
-                ) for p in df.permissions
-            )),
-        )].append(df.id)
-    for (md, file_ids) in metadata_counts.items():
-        if len(file_ids) > 1 and ('user', 'owner', args.email) in md[-1]:
-            LOGGER.warning('{} copies of path: {}'.format(len(file_ids), md[0]))
-            if args.delete_duplicates:
-                try:
-                    retrieved_file_ids = [
-                        files.get(fileId=file_id).execute()['id'] for file_id in file_ids]
-                    if sorted(retrieved_file_ids) == sorted(file_ids):
-                        for file_id in retrieved_file_ids[1:]:
-                            LOGGER.warning('Deleting {}'.format(file_id))
-                            files.delete(fileId=file_id).execute()
-                except HttpError as ex:
-                    LOGGER.warning('Caught exception: {}'.format(ex))
-
-                time.sleep(args.sleep)
-
-    LOGGER.info('Listing {} largest files by size'.format(args.num_top_files))
-    files_by_size = sorted(drive_files.list(), key=lambda df: df.size, reverse=True)
-    for df in files_by_size[:args.num_top_files]:
-        LOGGER.info('{:<8} {}'.format(df.human_friendly_size, df))
+    drive_files = load_drive_files(
+        args.input_path, index_path=args.index, canonical_paths=args.canonical_paths)
+
+    checks = set(args.checks)
+    root_id = None
+    if 'top-level' in checks:
+        root_id = execute(files.get(fileId='root'))['id']
+        LOGGER.info('Root id: {}'.format(root_id))
+    analyzers = get_summary_analyzers(
+        checks, drive_files, root_id=root_id, email=args.email,
+        num_top_files=args.num_top_files)
+    summarize_drive_files(drive_files, analyzers)
+
+    if args.plan_output is not None or args.delete_duplicates:
+        groups = find_duplicates(drive_files, email=args.email, same_path=not args.any_path)
+    if args.plan_output is not None:
+        plan = []
+        for group in groups:
+            keeper = DuplicateRemover.choose_keeper(group, args.keep)
+            for f in group:
+                if f['id'] != keeper['id']:
+                    plan.append(dict(op='delete', file_id=f['id'], name=f['name'],
+                                     keep=keeper['id'], same_path=not args.any_path))
+        write_plan(plan, args.plan_output)
+    elif args.delete_duplicates:
+        checkpoint = Checkpoint(
+            args.checkpoint or 'summarize-drive-metadata-{}.checkpoint'.format(credentials_name))
+        remover = DuplicateRemover(
+            service, keep=args.keep, same_path=not args.any_path, batch_size=args.batch_size)
+        num_deleted = 0
+        for (group, keeper, results) in remover.remove(groups, checkpoint=checkpoint):
+            if keeper is None:
+                LOGGER.warning('Skipping {}: copies changed since the snapshot'.format(
+                    group[0]['path']))
+                continue
+            for (file_id, error) in results.items():
+                if error is None:
+                    num_deleted += 1
+                else:
+                    LOGGER.warning('Could not delete {} ({})'.format(file_id, error))
+            LOGGER.info('Kept {} of {} copies: {}'.format(
+                keeper['id'], len(group), keeper['path']))
+        LOGGER.info('Deleted {} duplicates'.format(num_deleted))
+        checkpoint.end_page(None)
+        checkpoint.close()
 
 
 if __name__ == '__main__':
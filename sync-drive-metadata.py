@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+import os
+
+from googleapiclient.discovery import build
+
+from migrate_google import (
+    LOGGER, authenticate, configure_logging, configure_requests, FileMetadataDownloader,
+    get_changes_token_path, save_start_page_token, sync_metadata,
+)
+
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description='Update saved metadata from drive files with the '
+                                        'changes made since it was downloaded')
+    parser.add_argument('credentials_path', help='Path to credentials json file')
+    parser.add_argument('snapshot_path', help='Path to jsonl metadata file to update in place')
+    parser.add_argument('--token-path',
+                        help='Path to changes token file (default: <snapshot_path>.changes-token)')
+    parser.add_argument('--init', action='store_true',
+                        help='Only record the current changes token, to sync from later')
+    parser.add_argument('--max-rate', type=float,
+                        help='Maximum number of API requests per second '
+                             '(default: unlimited)')
+    parser.add_argument('--metrics',
+                        help='Path to write metrics of API requests to as json')
+    parser.add_argument('--progress-interval', type=float,
+                        help='Log request progress every this many seconds')
+    parser.add_argument('--batch', action='store_true',
+                        help='Fetch permissions for each page of files in batch requests')
+    parser.add_argument('--inline-permissions', action='store_true',
+                        help='Request permissions in the file listing where we have access')
+    args = parser.parse_args()
+
+    credentials_name = os.path.splitext(os.path.basename(args.credentials_path))[0]
+    configure_logging('sync-drive-metadata-{}.log'.format(credentials_name))
+    configure_requests(max_rate=args.max_rate, metrics_path=args.metrics,
+                       progress_interval=args.progress_interval)
+
+    creds = authenticate(args.credentials_path, token_path=credentials_name + '.pickle')
+    service = build('drive', 'v3', credentials=creds)
+    files = service.files()
+    perms = service.permissions()
+    changes = service.changes()
+
+    token_path = args.token_path or get_changes_token_path(args.snapshot_path)
+    if args.init:
+        save_start_page_token(changes, token_path)
+    else:
+        downloader = FileMetadataDownloader(
+            files, perms,
+            service=service if args.batch else None,
+            inline_permissions=args.inline_permissions)
+        page_token = sync_metadata(args.snapshot_path, changes, downloader, token_path=token_path)
+        LOGGER.info('Synced to changes token {}'.format(page_token))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+import importlib.util
+import logging
+import os
+import sys
+
+import pytest
+
+# The library and the fake live next to the scripts, not in a package
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import migrate_google  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def fast_executor(monkeypatch):
+    # Requests to the fake need no rate limit, and retries no real backoff
+    monkeypatch.setattr(migrate_google.EXECUTOR, 'rate_limiter', None)
+    monkeypatch.setattr(migrate_google.EXECUTOR, 'base_delay', 0.001)
+
+
+@pytest.fixture
+def run_script(monkeypatch, tmp_path):
+    # Run the main of a script (such as migrate-drive-1.py) with args,
+    # authenticated against drive (a FakeDrive) and with its logs and
+    # other files in tmp_path
+    monkeypatch.chdir(tmp_path)
+    handlers = list(migrate_google.LOGGER.handlers)
+    level = migrate_google.LOGGER.level
+
+    def run(name, args, drive):
+        spec = importlib.util.spec_from_file_location(
+            name.replace('-', '_'), os.path.join(ROOT, name + '.py'))
+        script = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(script)
+        monkeypatch.setattr(script, 'authenticate', lambda *args, **kwargs: None)
+        monkeypatch.setattr(script, 'build', lambda *args, **kwargs: drive.build())
+        monkeypatch.setattr(sys, 'argv', [name + '.py'] + list(args))
+        script.main()
+
+    yield run
+    for handler in migrate_google.LOGGER.handlers:
+        if handler not in handlers:
+            handler.close()
+    migrate_google.LOGGER.handlers = handlers
+    migrate_google.LOGGER.setLevel(level)
+    logging.getLogger().setLevel(logging.WARNING)
@@ -0,0 +1,137 @@
+import asyncio
+import json
+import types
+
+import pytest
+from googleapiclient.errors import HttpError
+
+import migrate_google
+from fake_drive import FakeAsyncClient, FakeDrive
+from migrate_google import (
+    FOLDER_MIME_TYPE, AsyncDriveClient, PathCache, async_get_file_by_path, async_walk,
+    get_file_by_path, walk,
+)
+
+
+def add_folder(drive, name, parent_id):
+    return drive.add_file(dict(name=name, mimeType=FOLDER_MIME_TYPE, parents=[parent_id]))
+
+
+def summarize_walk(entries):
+    return sorted(
+        (parent['id'], sorted(f['id'] for f in dir_entries), sorted(f['id'] for f in file_entries))
+        for (parent, dir_entries, file_entries) in entries)
+
+
+async def collect(async_iter):
+    return [item async for item in async_iter]
+
+
+def test_async_walk_matches_walk():
+    drive = FakeDrive.generate(num_files=300, depth=2, fan_out=4)
+    expected = summarize_walk(walk('/', drive.build().files(), folders_per_query=3))
+    actual = summarize_walk(asyncio.run(collect(
+        async_walk('/', FakeAsyncClient(drive), folders_per_query=3, max_pending=4))))
+    assert actual == expected
+    assert len(expected) > 1
+
+
+def test_async_get_file_by_path_resolves_stale_cache_again():
+    drive = FakeDrive()
+    a = add_folder(drive, 'a', drive.root_id)
+    b = add_folder(drive, 'b', a['id'])
+    report = drive.add_file(dict(name='report.pdf', parents=[b['id']]))
+    files = drive.build().files()
+    client = FakeAsyncClient(drive)
+    path_cache = PathCache()
+
+    f = asyncio.run(async_get_file_by_path('/a/b/report.pdf', client, path_cache=path_cache))
+    assert f['id'] == report['id']
+    assert get_file_by_path('/a/b/report.pdf', files, path_cache=path_cache)['id'] == report['id']
+
+    # Replace b and its contents, leaving their entries in the cache stale
+    files.delete(fileId=report['id']).execute()
+    files.delete(fileId=b['id']).execute()
+    new_b = add_folder(drive, 'b', a['id'])
+    new_report = drive.add_file(dict(name='report.pdf', parents=[new_b['id']]))
+    f = asyncio.run(async_get_file_by_path(
+        'a/b/report.pdf', client, fields=('id', 'size'), path_cache=path_cache))
+    assert f['id'] == new_report['id']
+    assert path_cache.get(a['id'], 'b') == new_b['id']
+
+
+class StubResponse(object):
+    def __init__(self, status, content, url):
+        self.status = status
+        self.content = content
+        self.url = url
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        pass
+
+    async def read(self):
+        return self.content
+
+
+class StubSession(object):
+    # Stands in for an aiohttp session, answering requests with responses in
+    # turn; a response that is an exception is raised instead
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def request(self, method, url, params=None, json=None, headers=None):
+        self.requests.append((method, url, params, json, headers))
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        (status, content) = response
+        return StubResponse(status, content, url)
+
+
+def test_async_drive_client_request(monkeypatch):
+    client_error = type('ClientError', (Exception,), {})
+    monkeypatch.setattr(migrate_google, 'aiohttp', types.SimpleNamespace(ClientError=client_error))
+    server_error = json.dumps(dict(error=dict(
+        code=503, errors=[dict(reason='backendError')]))).encode('utf-8')
+
+    async def run(responses, *args, **kwargs):
+        client = AsyncDriveClient(types.SimpleNamespace(valid=True, token='token'))
+        client.session = StubSession(responses)
+        client.refresh_lock = asyncio.Lock()
+        try:
+            return await client.request(*args, **kwargs)
+        finally:
+            requests.extend(client.session.requests)
+
+    requests = []
+    response = asyncio.run(run(
+        [client_error('reset'), (503, server_error), (200, b'{"id": "f1"}')],
+        'GET', 'files/f1', params=dict(fields='id', supportsAllDrives=True, pageToken=None)))
+    assert response == dict(id='f1')
+    assert len(requests) == 3
+    assert requests[-1] == (
+        'GET', AsyncDriveClient.BASE_URL + 'files/f1',
+        dict(fields='id', supportsAllDrives='true'), None, {'Authorization': 'Bearer token'})
+
+    # A copy may have been made, so it is not retried on server errors
+    requests = []
+    with pytest.raises(HttpError):
+        asyncio.run(run([(503, server_error)], 'POST', 'files/f1/copy', body=dict(name='a')))
+    assert len(requests) == 1
+
+
+def test_async_drive_client_endpoints():
+    get_endpoint = FakeAsyncClient(FakeDrive()).get_endpoint
+    assert [get_endpoint(method, path) for (method, path) in [
+        ('GET', 'files'), ('POST', 'files'), ('GET', 'files/f1'), ('PATCH', 'files/f1'),
+        ('POST', 'files/f1/copy'), ('GET', 'files/f1/permissions'),
+        ('DELETE', 'files/f1/permissions/p1'), ('GET', 'changes/startPageToken'),
+    ]] == [
+        'drive.files.list', 'drive.files.create', 'drive.files.get', 'drive.files.update',
+        'drive.files.copy', 'drive.permissions.list', 'drive.permissions.delete',
+        'drive.changes.getStartPageToken',
+    ]
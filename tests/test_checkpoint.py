@@ -0,0 +1,209 @@
+import os
+
+import pytest
+
+from fake_drive import FakeDrive
+from migrate_google import (
+    Checkpoint, FileMetadataDownloader, ShardedLister, get_query_shards, is_snapshot_complete,
+    iter_snapshot_pages, open_snapshot_writer, read_snapshot,
+)
+
+
+SNAPSHOT_FORMATS = ('jsonl', 'jsonl.zst', 'msgpack', 'msgpack.zst')
+
+
+def open_resumed(snapshot_path, checkpoint_path, **kwargs):
+    # As download-drive-metadata.py does
+    output_file = open_snapshot_writer(snapshot_path, mode='a', batch_size=2)
+    checkpoint = Checkpoint(checkpoint_path, output_file=output_file, **kwargs)
+    output_file.truncate(checkpoint.offset or 0)
+    return (output_file, checkpoint)
+
+
+def crash(output_file, checkpoint):
+    output_file.raw_file.close()
+    checkpoint.journal.close()
+
+
+@pytest.mark.parametrize('snapshot_format', SNAPSHOT_FORMATS)
+def test_resume_flush_without_write(tmp_path, snapshot_format):
+    snapshot_path = str(tmp_path / ('snapshot.' + snapshot_format))
+    checkpoint_path = str(tmp_path / 'snapshot.checkpoint')
+    records = [dict(id='file{}'.format(i), name='name{}'.format(i)) for i in range(5)]
+
+    # Three records are journalled, two more written but lost in a crash
+    (output_file, checkpoint) = open_resumed(snapshot_path, checkpoint_path)
+    for metadata in records[:3]:
+        output_file.write(metadata)
+        checkpoint.mark_done(metadata['id'])
+    checkpoint.flush()
+    for metadata in records[3:]:
+        output_file.write(metadata)
+    output_file.flush()
+    crash(output_file, checkpoint)
+
+    # The rest of the page was done, so the journal is flushed with nothing
+    # written since the snapshot was truncated
+    (output_file, checkpoint) = open_resumed(snapshot_path, checkpoint_path)
+    assert checkpoint.resuming
+    checkpoint.end_page('next-page')
+    crash(output_file, checkpoint)
+
+    (output_file, checkpoint) = open_resumed(snapshot_path, checkpoint_path)
+    assert checkpoint.page_token == 'next-page'
+    assert checkpoint.offset == os.path.getsize(snapshot_path)
+    output_file.write(records[3])
+    checkpoint.close()
+    output_file.close()
+
+    assert [m['id'] for m in read_snapshot(snapshot_path)] == [
+        'file0', 'file1', 'file2', 'file3']
+
+
+def test_iter_skips_done_items(tmp_path):
+    checkpoint_path = str(tmp_path / 'checkpoint')
+    page = [
+        (dict(id=str(i)), dict(next_page_token='page2', item_index=i, num_items=3))
+        for i in range(3)
+    ]
+    checkpoint = Checkpoint(checkpoint_path)
+    for (item, _) in checkpoint.iter(page[:2]):
+        pass
+    checkpoint.flush()
+    checkpoint.journal.close()
+
+    checkpoint = Checkpoint(checkpoint_path)
+    assert checkpoint.page_token is None and checkpoint.done == {'0', '1'}
+    assert [item['id'] for (item, _) in checkpoint.iter(page)] == ['2']
+    assert checkpoint.page_token == 'page2' and not checkpoint.done
+    checkpoint.close()
+
+
+def test_resume_requires_same_config(tmp_path):
+    checkpoint_path = str(tmp_path / 'checkpoint')
+    sharded = dict(shards=4, shard_by='modifiedTime')
+    checkpoint = Checkpoint(checkpoint_path, config=sharded)
+    checkpoint.mark_done('file0')
+    checkpoint.close()
+
+    for config in (None, dict(shards=8, shard_by='modifiedTime')):
+        with pytest.raises(ValueError):
+            Checkpoint(checkpoint_path, config=config)
+    checkpoint = Checkpoint(checkpoint_path, config=sharded)
+    assert checkpoint.done == {'file0'}
+
+    # Once complete, a listing can start over with other options
+    checkpoint.end_page(None)
+    checkpoint.close()
+    Checkpoint(checkpoint_path, config=None).close()
+
+
+def download(drive, output_file, checkpoint, max_files=None):
+    # As download-drive-metadata.py does without shards, stopping (as if
+    # killed) before writing more than max_files files
+    service = drive.build()
+    downloader = FileMetadataDownloader(service.files(), service.permissions(), service=service)
+    for (i, (metadata, _)) in enumerate(checkpoint.iter(
+            (metadata, metadata['batch_info'])
+            for metadata in downloader.list(page_token=checkpoint.page_token))):
+        if i == max_files:
+            return
+        output_file.write(metadata)
+    checkpoint.close()
+    output_file.close()
+
+
+@pytest.mark.parametrize('snapshot_format', ('jsonl', 'msgpack.zst'))
+def test_download_resumes_after_crash(tmp_path, snapshot_format):
+    drive = FakeDrive.generate(num_files=350)
+    snapshot_path = str(tmp_path / ('snapshot.' + snapshot_format))
+    checkpoint_path = str(tmp_path / 'snapshot.checkpoint')
+
+    # Killed partway through the second page, and again on the third
+    for max_files in (130, 120, None):
+        (output_file, checkpoint) = open_resumed(snapshot_path, checkpoint_path, flush_every=20)
+        download(drive, output_file, checkpoint, max_files=max_files)
+        if max_files is not None:
+            crash(output_file, checkpoint)
+
+    assert [m['id'] for m in read_snapshot(snapshot_path)] == [
+        m['id'] for m in drive.iter_metadata()]
+
+
+def download_sharded(drive, output_file, checkpoint, max_files=None):
+    # As download-drive-metadata.py does with --shards 4
+    service = drive.build()
+    lister = ShardedLister(
+        drive.build, get_query_shards(num_shards=4), page_size=50, skip_ids=checkpoint.done)
+    downloader = FileMetadataDownloader(
+        service.files(), service.permissions(), service=service, lister=lister)
+    metadata_iter = downloader.list()
+    for (i, metadata) in enumerate(metadata_iter):
+        if i == max_files:
+            metadata_iter.close()
+            return
+        output_file.write(metadata)
+        checkpoint.mark_done(metadata['id'])
+    checkpoint.end_page(None)
+    checkpoint.close()
+    output_file.close()
+
+
+def test_sharded_download_resumes_after_crash(tmp_path):
+    drive = FakeDrive.generate(num_files=350)
+    snapshot_path = str(tmp_path / 'snapshot.jsonl')
+    checkpoint_path = str(tmp_path / 'snapshot.checkpoint')
+
+    for max_files in (130, 120, None):
+        (output_file, checkpoint) = open_resumed(
+            snapshot_path, checkpoint_path, flush_every=20,
+            config=dict(shards=4, shard_by='modifiedTime'))
+        download_sharded(drive, output_file, checkpoint, max_files=max_files)
+        if max_files is not None:
+            crash(output_file, checkpoint)
+
+    file_ids = [m['id'] for m in read_snapshot(snapshot_path)]
+    assert len(file_ids) == len(set(file_ids))
+    assert sorted(file_ids) == sorted(drive.files)
+
+
+def test_pass_over_snapshot_resumes_after_crash(tmp_path):
+    input_path = str(tmp_path / 'input.jsonl')
+    with open_snapshot_writer(input_path) as f:
+        for i in range(25):
+            f.write(dict(id='file{}'.format(i)))
+    snapshot_path = str(tmp_path / 'output.jsonl')
+    checkpoint_path = str(tmp_path / 'output.checkpoint')
+
+    # As redownload-drive-metadata.py does, killed twice along the way
+    for max_records in (12, 7, None):
+        (output_file, checkpoint) = open_resumed(snapshot_path, checkpoint_path, flush_every=5)
+        pages = iter_snapshot_pages(input_path, start=int(checkpoint.page_token or 0), page_size=10)
+        for (i, (metadata, _)) in enumerate(checkpoint.iter(pages)):
+            if i == max_records:
+                crash(output_file, checkpoint)
+                break
+            output_file.write(metadata)
+    assert checkpoint.complete
+    checkpoint.close()
+    output_file.close()
+    assert [m['id'] for m in read_snapshot(snapshot_path)] == [
+        'file{}'.format(i) for i in range(25)]
+
+
+def test_is_snapshot_complete(tmp_path):
+    snapshot_path = str(tmp_path / 'snapshot.jsonl')
+    with open_snapshot_writer(snapshot_path) as f:
+        f.write(dict(id='file0', batch_info=dict(
+            next_page_token='page2', item_index=0, num_items=1)))
+    # Without a journal, the last record shows whether the listing ended
+    assert not is_snapshot_complete(snapshot_path)
+
+    checkpoint = Checkpoint(snapshot_path + '.checkpoint', config=dict(shards=4))
+    checkpoint.mark_done('file0')
+    checkpoint.close()
+    assert not is_snapshot_complete(snapshot_path)
+    checkpoint = Checkpoint(snapshot_path + '.checkpoint', config=dict(shards=4))
+    checkpoint.end_page(None)
+    checkpoint.close()
+    assert is_snapshot_complete(snapshot_path)
@@ -0,0 +1,83 @@
+import os
+
+import pytest
+
+from fake_drive import FakeDrive
+from migrate_google import (
+    MetadataIndex, compare_drive_files, compare_metadata_streaming, load_drive_files,
+    open_snapshot_writer,
+)
+
+
+def write_snapshot(metadata_iter, path):
+    with open_snapshot_writer(path) as f:
+        for metadata in metadata_iter:
+            f.write(metadata)
+
+
+@pytest.mark.parametrize('snapshot_format', ('jsonl', 'msgpack.zst'))
+def test_streaming_compare_matches_in_memory(tmp_path, snapshot_format):
+    drive = FakeDrive.generate(num_files=2000, depth=2, fan_out=6, duplicate_ratio=0.05)
+    paths = dict(old=str(tmp_path / ('old.' + snapshot_format)),
+                 new=str(tmp_path / ('new.' + snapshot_format)))
+    write_snapshot(drive.iter_metadata(), paths['old'])
+    write_snapshot(
+        (metadata for (i, metadata) in enumerate(drive.iter_metadata()) if i % 50 != 7),
+        paths['new'])
+
+    expected = sorted(compare_drive_files(
+        load_drive_files(paths['old']), load_drive_files(paths['new'])))
+    # Folders, whose sizes are those of their trees, differ too
+    assert any(name.startswith('folder-') for (name, _, _, _) in expected)
+    for partition_records in (100, 100000):
+        rows = list(compare_metadata_streaming(
+            paths['old'], paths['new'], partition_records=partition_records,
+            tmp_dir=str(tmp_path)))
+        assert [size for (_, size, _, _) in rows] == sorted(
+            (size for (_, size, _, _) in rows), reverse=True)
+        assert sorted(rows) == expected
+
+
+def summarize_file(df):
+    metadata = dict((k, v) for (k, v) in df.metadata.items() if k != 'batch_info')
+    return (df.size, df.path, metadata, sorted(child.id for child in df.children))
+
+
+def test_index_matches_in_memory(tmp_path):
+    drive = FakeDrive.generate(num_files=500, depth=2, fan_out=4, shared_ratio=0.3)
+    snapshot_path = str(tmp_path / 'snapshot.jsonl')
+    index_path = str(tmp_path / 'snapshot.sqlite')
+    write_snapshot(drive.iter_metadata(), snapshot_path)
+
+    drive_files = load_drive_files(snapshot_path)
+    indexed = load_drive_files(snapshot_path, index_path=index_path)
+    assert indexed.root_ids == drive_files.root_ids
+    assert sorted(df.id for df in indexed.list()) == sorted(df.id for df in drive_files.list())
+    for df in drive_files.list():
+        assert summarize_file(indexed.get(df.id)) == summarize_file(df)
+    assert [df.size for df in indexed.largest(5)] == sorted(
+        (df.size for df in drive_files.list()), reverse=True)[:5]
+
+    # Rebuilt only when the snapshot changes
+    write_snapshot(list(drive.iter_metadata())[:100], snapshot_path)
+    os.utime(snapshot_path, (0, 0))
+    assert len(list(load_drive_files(snapshot_path, index_path=index_path).list())) == 100
+
+
+def test_index_compare_matches_in_memory(tmp_path):
+    drive = FakeDrive.generate(num_files=500, depth=2, fan_out=4, duplicate_ratio=0.05)
+    paths = dict(old=str(tmp_path / 'old.jsonl'), new=str(tmp_path / 'new.jsonl'))
+    write_snapshot(drive.iter_metadata(), paths['old'])
+    write_snapshot(
+        (metadata for (i, metadata) in enumerate(drive.iter_metadata()) if i % 20 != 3),
+        paths['new'])
+
+    expected = sorted(compare_drive_files(
+        load_drive_files(paths['old']), load_drive_files(paths['new'])))
+    assert expected
+    indexes = dict(
+        (version, load_drive_files(path, index_path=path + '.sqlite'))
+        for (version, path) in paths.items())
+    assert sorted(compare_drive_files(indexes['old'], indexes['new'])) == expected
+    old_index = MetadataIndex(paths['old'] + '.sqlite')
+    assert sorted(old_index.missing_from(MetadataIndex(paths['new'] + '.sqlite'))) == expected
@@ -0,0 +1,98 @@
+import pytest
+
+from fake_drive import FakeDrive
+from migrate_google import (
+    FOLDER_MIME_TYPE, FileMetadataDownloader, PipelinedFileMetadataDownloader, ShardedLister,
+    get_changes_token_path, get_query_shards, open_snapshot_writer, read_snapshot,
+    save_start_page_token, sync_metadata,
+)
+
+DOWNLOADERS = ('sequential', 'batch', 'inline', 'pipelined', 'pipelined-batch')
+
+
+def new_downloader(drive, kind):
+    service = drive.build()
+    if kind.startswith('pipelined'):
+        return PipelinedFileMetadataDownloader(
+            drive.build, num_workers=3, max_pending_files=50, batch=kind.endswith('batch'))
+    return FileMetadataDownloader(
+        service.files(), service.permissions(),
+        service=service if kind == 'batch' else None, inline_permissions=kind == 'inline')
+
+
+def without_batch_info(metadata):
+    return dict((k, v) for (k, v) in metadata.items() if k != 'batch_info')
+
+
+@pytest.mark.parametrize('kind', DOWNLOADERS)
+def test_downloader_lists_every_file(kind):
+    drive = FakeDrive.generate(num_files=250, shared_ratio=0.3)
+    expected = [without_batch_info(metadata) for metadata in drive.iter_metadata()]
+    actual = list(new_downloader(drive, kind).list())
+    assert [without_batch_info(metadata) for metadata in actual] == expected
+    # Pages of 100 files, in listing order
+    assert [m['batch_info']['item_index'] for m in actual[:101]] == list(range(100)) + [0]
+
+
+@pytest.mark.parametrize('kind', ('batch', 'pipelined-batch'))
+def test_downloader_retries_quota_errors(kind):
+    drive = FakeDrive.generate(num_files=150, quota_error_rate=0.1)
+    expected = [without_batch_info(metadata) for metadata in drive.iter_metadata()]
+    actual = [without_batch_info(metadata) for metadata in new_downloader(drive, kind).list()]
+    assert actual == expected
+    assert all(metadata['error'] is None for metadata in actual)
+
+
+@pytest.mark.parametrize('shard_by', ('modifiedTime', 'mimeType'))
+def test_sharded_lister_lists_every_file_once(shard_by):
+    drive = FakeDrive.generate(num_files=500)
+    # Folders are listed by two shards
+    shards = get_query_shards(by=shard_by, num_shards=5) + [
+        "mimeType = '{}'".format(FOLDER_MIME_TYPE)]
+    skip_ids = list(drive.files)[:10]
+    lister = ShardedLister(drive.build, shards, num_workers=3, page_size=40, skip_ids=skip_ids)
+    service = drive.build()
+    downloader = FileMetadataDownloader(service.files(), service.permissions(), lister=lister)
+    pages = list(downloader.iter_pages())
+    assert all(len(page) <= 40 for page in pages)
+    file_ids = [f['id'] for page in pages for (f, _) in page]
+    assert len(file_ids) == len(set(file_ids))
+    assert sorted(file_ids) == sorted(list(drive.files)[10:])
+
+
+def test_downloader_records_errors():
+    drive = FakeDrive.generate(num_files=20)
+    service = drive.build()
+    downloader = FileMetadataDownloader(service.files(), service.permissions(), service=service)
+    (page,) = list(downloader.iter_pages())
+    # Deleted after it was listed, so its permissions cannot be looked up
+    del drive.files[page[5][0]['id']]
+    metadata_list = downloader.get_page(page)
+    assert [metadata['error'] for metadata in metadata_list] == [None] * 5 + [404] + [None] * 14
+
+
+@pytest.mark.parametrize('snapshot_format', ('jsonl', 'msgpack.zst'))
+def test_sync_metadata_applies_changes(tmp_path, snapshot_format):
+    drive = FakeDrive.generate(num_files=300, shared_ratio=0.3)
+    service = drive.build()
+    downloader = FileMetadataDownloader(service.files(), service.permissions(), service=service)
+    snapshot_path = str(tmp_path / ('snapshot.' + snapshot_format))
+    save_start_page_token(service.changes(), get_changes_token_path(snapshot_path))
+    with open_snapshot_writer(snapshot_path) as output_file:
+        for metadata in downloader.list():
+            output_file.write(metadata)
+
+    files = service.files()
+    file_ids = list(drive.files)
+    files.update(fileId=file_ids[10], body=dict(name='renamed')).execute()
+    files.delete(fileId=file_ids[20]).execute()
+    service.permissions().create(
+        fileId=file_ids[30],
+        body=dict(type='user', role='reader', emailAddress='bob@example.com')).execute()
+    drive.add_file(dict(name='new.txt', parents=[drive.root_id]))
+
+    for _ in range(2):
+        token = sync_metadata(snapshot_path, service.changes(), downloader)
+        assert token == str(len(drive.changes))
+        assert [without_batch_info(metadata) for metadata in read_snapshot(snapshot_path)] == [
+            without_batch_info(metadata) for metadata in drive.iter_metadata()]
@@ -0,0 +1,83 @@
+from fake_drive import FakeDrive
+from migrate_google import FOLDER_MIME_TYPE, DriveFiles
+
+
+def new_file(file_id, name, parents, size=None, **kwargs):
+    metadata = dict(id=file_id, name=name, parents=parents, mimeType='text/plain',
+                    permissions=[], error=None, **kwargs)
+    if size is None:
+        metadata['mimeType'] = FOLDER_MIME_TYPE
+    else:
+        metadata['size'] = str(size)
+    return metadata
+
+
+TREE = [
+    new_file('root', 'My Drive', []),
+    new_file('a', 'a', ['root']),
+    new_file('b', 'b', ['a']),
+    new_file('c', 'c', ['root']),
+    new_file('x', 'x.txt', ['b'], size=10),
+    new_file('y', 'y.txt', ['a', 'c'], size=5),
+    new_file('z', 'z.txt', ['root'], size=1),
+]
+
+
+def test_load_sums_sizes_and_formats_paths():
+    drive_files = DriveFiles()
+    drive_files.load(TREE)
+    sizes = dict((df.id, df.size) for df in drive_files.list())
+    # y counts toward both of its parents, and so twice toward root
+    assert sizes == dict(root=21, a=15, b=10, c=5, x=10, y=5, z=1)
+    assert drive_files.get('x').path == 'My Drive/a/b/x.txt'
+    assert drive_files.get('y').path == '{My Drive/a,My Drive/c}/y.txt'
+    assert sorted(drive_files.get('y').all_paths()) == ['My Drive/a/y.txt', 'My Drive/c/y.txt']
+    assert drive_files.root_ids == {'root'}
+
+    drive_files = DriveFiles(canonical_paths=True)
+    drive_files.load(TREE)
+    assert drive_files.get('y').path == 'My Drive/a/y.txt'
+
+
+def test_add_matches_load():
+    drive = FakeDrive.generate(num_files=500)
+    loaded = DriveFiles()
+    loaded.load(drive.iter_metadata())
+    added = DriveFiles()
+    # Children before parents, so that links and sizes are updated as they go
+    for metadata in reversed(list(drive.iter_metadata())):
+        added.add(metadata)
+    for df in loaded.list():
+        other = added.get(df.id)
+        assert (other.size, other.path, other.metadata) == (df.size, df.path, df.metadata)
+
+
+def test_update_moves_sizes_and_paths():
+    drive_files = DriveFiles()
+    drive_files.load(TREE)
+    assert drive_files.get('x').path == 'My Drive/a/b/x.txt'
+
+    # Move b under c and rename it, and grow x
+    drive_files.get('b').update(new_file('b', 'b2', ['c']))
+    drive_files.get('x').update(new_file('x', 'x.txt', ['b'], size=20))
+    sizes = dict((df.id, df.size) for df in drive_files.list())
+    assert sizes == dict(root=31, a=5, b=20, c=25, x=20, y=5, z=1)
+    assert drive_files.get('x').path == 'My Drive/c/b2/x.txt'
+    assert drive_files.get('b').metadata['name'] == 'b2'
+
+
+def test_update_reorders_parents():
+    drive_files = DriveFiles(canonical_paths=True)
+    drive_files.load(TREE)
+    assert drive_files.get('y').path == 'My Drive/a/y.txt'
+    drive_files.get('y').update(new_file('y', 'y.txt', ['c', 'a'], size=5))
+    assert drive_files.get('y').path == 'My Drive/c/y.txt'
+
+
+def test_metadata_round_trips():
+    drive = FakeDrive.generate(num_files=200, shared_ratio=0.5)
+    drive_files = DriveFiles()
+    drive_files.load(drive.iter_metadata())
+    for metadata in drive.iter_metadata():
+        expected = dict((k, v) for (k, v) in metadata.items() if k != 'batch_info')
+        assert drive_files.get(metadata['id']).metadata == expected
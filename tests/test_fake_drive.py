@@ -0,0 +1,22 @@
+from fake_drive import FakeDrive
+from migrate_google import FOLDER_MIME_TYPE, DriveFiles
+
+
+def get_folders(drive):
+    return [f for f in drive.files.values() if f['mimeType'] == FOLDER_MIME_TYPE]
+
+
+def test_generate_caps_folders():
+    drive = FakeDrive.generate(num_files=1000)
+    assert len(drive.files) == 1000
+    assert len(get_folders(drive)) == 100
+    # Filled breadth-first, so every folder of the first level is there,
+    # and everything is under the root
+    drive_files = DriveFiles()
+    drive_files.load(drive.iter_metadata())
+    assert len(drive_files.get(drive.root_id).descendants()) == 1000
+    assert len([f for f in get_folders(drive) if f.get('parents') == [drive.root_id]]) == 8
+
+    # Or by the tree, if it is smaller
+    drive = FakeDrive.generate(num_files=100, depth=1, fan_out=4, folder_ratio=0.5)
+    assert (len(drive.files), len(get_folders(drive))) == (100, 5)
@@ -0,0 +1,257 @@
+import logging
+
+import pytest
+from googleapiclient.errors import HttpError
+
+from fake_drive import FakeDrive, new_http_error
+from migrate_google import (
+    FOLDER_MIME_TYPE, GOOGLE_APPS_MIME_TYPE, DriveFiles, DuplicateRemover, FileCache,
+    MigrationPlanner, OwnershipTransferer, PlanExecutor, copy_once, find_duplicates,
+)
+
+
+def test_copy_once_finds_earlier_copy():
+    drive = FakeDrive()
+    original = drive.add_file(dict(name='report.pdf', parents=[drive.root_id]))
+    files = drive.build().files()
+
+    copy_id = copy_once(files, original['id'], dict(name='report.pdf', starred=True))
+    assert drive.files[copy_id]['starred'] is True
+    # As when a run crashes after copying but before recording it
+    assert copy_once(files, original['id'], dict(name='report.pdf')) == copy_id
+    assert len(drive.files) == 3
+
+
+def test_plan_executor_batches_transfers():
+    drive = FakeDrive()
+    docs = [
+        drive.add_file(dict(name='doc{}'.format(i), parents=[drive.root_id],
+                            mimeType=GOOGLE_APPS_MIME_TYPE + '.document'))
+        for i in range(150)]
+    operations = [
+        dict(op='transfer', file_id=f['id'], name=f['name'], email='alice@example.com')
+        for f in docs]
+
+    results = list(PlanExecutor(drive.build, num_workers=2).apply(operations))
+    assert sorted(operation['file_id'] for (operation, _) in results) == [f['id'] for f in docs]
+    assert all(error is None for (_, error) in results)
+    for f in docs:
+        owners = [p['emailAddress'] for p in drive.files[f['id']]['permissions']
+                  if p['role'] == 'owner']
+        assert owners == ['alice@example.com']
+
+
+def test_plan_executor_verifies_duplicates_before_deleting():
+    drive = FakeDrive()
+    (keep, copy, other_keep, other_copy) = [
+        drive.add_file(dict(name=name, parents=[drive.root_id]), content=b'same content')
+        for name in ('a.txt', 'a.txt', 'b.txt', 'b.txt')]
+    operations = [
+        dict(op='delete', file_id=copy['id'], name='a.txt', keep=keep['id']),
+        dict(op='delete', file_id=other_copy['id'], name='b.txt', keep=other_keep['id']),
+    ]
+    # Changed after the plan was made, so no longer a duplicate
+    drive.files[other_copy['id']]['name'] = 'b (edited).txt'
+
+    results = list(PlanExecutor(drive.build, num_workers=2).apply(operations))
+    assert [error for (_, error) in results] == [None, None]
+    assert copy['id'] not in drive.files
+    assert other_copy['id'] in drive.files and keep['id'] in drive.files
+
+
+def test_plan_executor_rechecks_orphans_before_deleting():
+    drive = FakeDrive()
+    folder = drive.add_file(dict(name='folder', parents=[drive.root_id], mimeType=FOLDER_MIME_TYPE))
+    orphans = [drive.add_file(dict(name='orphan{}.txt'.format(i), parents=[])) for i in range(3)]
+    planner = MigrationPlanner(drive.email)
+    operations = list(planner.plan_delete_orphans(drive.iter_metadata()))
+    assert sorted(operation['file_id'] for operation in operations) == [f['id'] for f in orphans]
+    # Changed after the plan was made: filed into a folder, and shared
+    files = drive.build().files()
+    files.update(fileId=orphans[1]['id'], addParents=folder['id']).execute()
+    drive.build().permissions().create(
+        fileId=orphans[2]['id'],
+        body=dict(type='user', role='reader', emailAddress='bob@example.com')).execute()
+
+    results = list(PlanExecutor(drive.build, num_workers=2).apply(operations))
+    assert [error for (_, error) in results] == [None, None, None]
+    assert orphans[0]['id'] not in drive.files
+    assert orphans[1]['id'] in drive.files and orphans[2]['id'] in drive.files
+
+
+def test_plan_copy_keeps_starred():
+    planner = MigrationPlanner('bob@example.com', 'me@example.com')
+    owners = [dict(type='user', role='owner', emailAddress='bob@example.com')]
+    metadata = dict(id='f1', name='photo.jpg', mimeType='image/jpeg', permissions=owners)
+    assert [operation['starred'] for operation in planner.plan_copy(
+        [dict(metadata, starred=True)])] == [True]
+    with pytest.raises(ValueError):
+        list(planner.plan_copy([metadata]))
+
+
+def test_file_cache_prefetches_in_batches_and_persists(tmp_path):
+    drive = FakeDrive()
+    mine = [drive.add_file(dict(name='mine{}'.format(i), parents=[drive.root_id]))
+            for i in range(150)]
+    theirs = drive.add_file(dict(name='theirs', parents=[drive.root_id]),
+                            owner='bob@example.com')
+    service = drive.build()
+    now = [1000.0]
+    path = str(tmp_path / 'cache.sqlite')
+
+    cache = FileCache(service.files(), max_size=10, path=path, service=service,
+                      clock=lambda: now[0])
+    cache.prefetch([f['id'] for f in mine + [theirs]])
+    # One batch per 100 files, then answered without the API
+    assert drive.num_requests == 151
+    assert [cache.is_owned(f['id']) for f in (mine[0], mine[-1], theirs)] == [True, True, False]
+    assert drive.num_requests == 151
+    assert len(cache.file_id_map) == 10
+    cache.close()
+
+    # Reopened, entries last until they expire
+    cache = FileCache(service.files(), path=path, ttl=60, clock=lambda: now[0])
+    assert cache.is_owned(theirs['id']) is False
+    assert drive.num_requests == 151
+    now[0] += 61
+    assert cache.is_owned(mine[0]['id']) is True
+    assert drive.num_requests == 152
+    cache.close()
+
+
+def test_file_cache_loads_ownership_from_snapshot():
+    drive = FakeDrive()
+    theirs = drive.add_file(dict(name='theirs', parents=[drive.root_id]),
+                            owner='bob@example.com')
+    cache = FileCache(drive.build().files())
+    cache.load_metadata(drive.iter_metadata(), drive.email)
+    assert (cache.is_owned(drive.root_id), cache.is_owned(theirs['id'])) == (True, False)
+    assert drive.num_requests == 0
+
+
+def get_owners(drive, file_id):
+    return [p['emailAddress'] for p in drive.files[file_id]['permissions'] if p['role'] == 'owner']
+
+
+def test_ownership_transferer_updates_or_creates_permission():
+    drive = FakeDrive()
+    shared = drive.add_file(dict(name='shared.txt', parents=[drive.root_id], permissions=[
+        dict(type='user', role='writer', emailAddress='alice@example.com')]))
+    unshared = [
+        drive.add_file(dict(name='file{}.txt'.format(i), parents=[drive.root_id]))
+        for i in range(5)]
+    missing = dict(id='missing', name='missing.txt')
+
+    results = OwnershipTransferer(drive.build(), 'alice@example.com', batch_size=2).transfer(
+        [shared] + unshared + [missing])
+    assert results == dict(
+        [(f['id'], None) for f in [shared] + unshared] + [('missing', 404)])
+    for f in [shared] + unshared:
+        assert get_owners(drive, f['id']) == ['alice@example.com']
+    # The existing permission was made owner rather than another added
+    assert len(drive.files[shared['id']]['permissions']) == 2
+
+
+def test_ownership_transferer_requeues_quota_errors():
+    drive = FakeDrive(quota_error_rate=0.2)
+    docs = [drive.add_file(dict(name='doc{}'.format(i), parents=[drive.root_id]))
+            for i in range(50)]
+    results = OwnershipTransferer(drive.build(), 'alice@example.com', max_rounds=20).transfer(docs)
+    assert results == dict((f['id'], None) for f in docs)
+    assert all(get_owners(drive, f['id']) == ['alice@example.com'] for f in docs)
+
+
+def test_duplicate_remover_deletes_verified_duplicates():
+    drive = FakeDrive()
+    (keep, copy, changed, other) = [
+        drive.add_file(dict(name='a.txt', parents=[drive.root_id]), content=b'same content')
+        for _ in range(4)]
+    renamed = drive.add_file(dict(name='b.txt', parents=[drive.root_id]), content=b'same content')
+    drive_files = DriveFiles()
+    drive_files.load(drive.iter_metadata())
+
+    groups = list(find_duplicates(drive_files))
+    assert [sorted(f['id'] for f in group) for group in groups] == [
+        sorted([keep['id'], copy['id'], changed['id'], other['id']])]
+
+    # Changed or deleted since the snapshot
+    drive.files[changed['id']]['name'] = 'a (edited).txt'
+    drive.build().files().delete(fileId=other['id']).execute()
+
+    [(group, keeper, results)] = list(DuplicateRemover(drive.build(), batch_size=2).remove(groups))
+    assert keeper['id'] == keep['id']
+    assert results == {copy['id']: None, changed['id']: 'changed', other['id']: None}
+    assert set(drive.files) == {drive.root_id, keep['id'], changed['id'], renamed['id']}
+
+    # With any_path, files under other names are duplicates too
+    drive_files = DriveFiles()
+    drive_files.load(drive.iter_metadata())
+    groups = list(find_duplicates(drive_files, same_path=False))
+    results = list(DuplicateRemover(drive.build(), same_path=False, keep='oldest').remove(groups))
+    assert [len(r) for (_, _, r) in results] == [2]
+    assert len(drive.files) == 2
+
+
+def test_find_duplicates_keeps_oldest_from_snapshot():
+    # As when planning with summarize-drive-metadata.py --keep oldest, which
+    # only has the snapshot to go on
+    drive = FakeDrive()
+    (newer, older) = [
+        drive.add_file(dict(name='a.txt', parents=[drive.root_id], createdTime=created_time),
+                       content=b'same content')
+        for created_time in ('2021-01-01T00:00:00.000Z', '2019-01-01T00:00:00.000Z')]
+    drive_files = DriveFiles()
+    drive_files.load(drive.iter_metadata())
+
+    [group] = list(find_duplicates(drive_files))
+    assert [f['id'] for f in group] == [newer['id'], older['id']]
+    assert DuplicateRemover.choose_keeper(group, 'oldest')['id'] == older['id']
+
+
+def test_find_duplicates_counts_files_without_checksums(caplog):
+    drive = FakeDrive()
+    for _ in range(2):
+        drive.add_file(dict(name='notes', parents=[drive.root_id],
+                            mimeType=GOOGLE_APPS_MIME_TYPE + '.document'))
+        drive.add_file(dict(name='folder', parents=[drive.root_id],
+                            mimeType=FOLDER_MIME_TYPE))
+    drive_files = DriveFiles()
+    drive_files.load(drive.iter_metadata())
+
+    caplog.set_level(logging.INFO, logger='migrate_google')
+    assert list(find_duplicates(drive_files)) == []
+    assert 'Skipped 2 files without md5Checksums' in caplog.text
+
+
+def test_migrate_drive_1_retries_failed_transfers_on_resume(run_script, monkeypatch):
+    drive = FakeDrive()
+    docs = [
+        drive.add_file(dict(name='doc{}'.format(i), parents=[drive.root_id],
+                            mimeType=GOOGLE_APPS_MIME_TYPE + '.document'),
+                       owner='bob@example.com')
+        for i in range(150)]
+    (permissions_create, files_list) = (drive.permissions_create, drive.files_list)
+
+    def fail_doc2(fileId, **kwargs):
+        if fileId == docs[2]['id']:
+            raise new_http_error(403, 'insufficientFilePermissions')
+        return permissions_create(fileId, **kwargs)
+
+    def fail_second_page(pageToken=None, **kwargs):
+        if pageToken is not None:
+            raise new_http_error(400, 'invalidPageToken')
+        return files_list(pageToken=pageToken, **kwargs)
+
+    # Transferring doc2 fails, and then the run dies listing the next page
+    args = ['credentials.json', 'bob@example.com', 'me@example.com']
+    monkeypatch.setattr(drive, 'permissions_create', fail_doc2)
+    monkeypatch.setattr(drive, 'files_list', fail_second_page)
+    with pytest.raises(HttpError):
+        run_script('migrate-drive-1', args, drive)
+    assert [get_owners(drive, f['id']) for f in docs[:4]] == (
+        [['me@example.com']] * 2 + [['bob@example.com']] + [['me@example.com']])
+
+    monkeypatch.setattr(drive, 'permissions_create', permissions_create)
+    monkeypatch.setattr(drive, 'files_list', files_list)
+    run_script('migrate-drive-1', args, drive)
+    assert all(get_owners(drive, f['id']) == ['me@example.com'] for f in docs)
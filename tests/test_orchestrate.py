@@ -0,0 +1,87 @@
+import json
+import os
+
+import pytest
+
+from migrate_google import AccountOrchestrator, load_manifest
+
+# Records its arguments, writes the metrics asked for, and fails on its
+# first run in each working directory
+FLAKY_SCRIPT = """
+import json, os, sys
+with open('args.json', 'a') as f:
+    f.write(json.dumps(sys.argv[1:]) + '\\n')
+if '--metrics' in sys.argv:
+    with open(sys.argv[sys.argv.index('--metrics') + 1], 'w') as f:
+        json.dump(dict(elapsed_seconds=1.0, throttled_seconds=0.5, quota_errors=2, endpoints=dict(
+            list=dict(cost=3, items=30, retries=2, failures=0))), f)
+if not os.path.exists('ran'):
+    open('ran', 'w').close()
+    sys.exit(1)
+"""
+
+
+def write_manifest(tmp_path, manifest):
+    manifest_path = str(tmp_path / 'manifest.json')
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f)
+    return manifest_path
+
+
+def read_args(work_dir):
+    with open(os.path.join(work_dir, 'args.json')) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_orchestrator_runs_jobs_per_account(tmp_path):
+    script_dir = tmp_path / 'scripts'
+    script_dir.mkdir()
+    (script_dir / 'flaky.py').write_text(FLAKY_SCRIPT)
+    (script_dir / 'fail.py').write_text('import sys\nsys.exit(3)\n')
+    manifest_path = write_manifest(tmp_path, dict(
+        jobs=[dict(script='flaky.py', args=['{name}.jsonl'])],
+        accounts=[
+            dict(name='alice', credentials_path='alice.json', max_rate=5),
+            dict(name='bob', credentials_path='bob.json', jobs=[
+                dict(script='flaky.py', credentials=False, args=['--all']),
+                dict(script='fail.py'),
+                dict(script='flaky.py'),
+            ]),
+        ]))
+    status_path = str(tmp_path / 'status.json')
+
+    orchestrator = AccountOrchestrator(
+        load_manifest(manifest_path), str(tmp_path / 'work'), str(script_dir), num_workers=2,
+        max_rate=10, retries=1, status_path=status_path)
+    status = orchestrator.run()
+    with open(status_path) as f:
+        assert json.load(f) == json.loads(json.dumps(status))
+
+    alice = status['alice']
+    assert alice['state'] == 'succeeded'
+    [job] = alice['jobs']
+    assert (job['state'], job['attempts'], job['returncode']) == ('succeeded', 2, 0)
+    assert job['metrics'] == dict(
+        elapsed_seconds=1.0, throttled_seconds=0.5, quota_errors=2, requests=3, items=30,
+        retries=2, failures=0)
+    assert read_args(alice['work_dir'])[-1] == [
+        str(tmp_path / 'alice.json'), '--metrics', job['metrics_path'], '--max-rate', '5',
+        'alice.jsonl']
+
+    # bob's jobs stop at the first that fails after its retries
+    bob = status['bob']
+    assert bob['state'] == 'failed'
+    assert [(job['state'], job['attempts']) for job in bob['jobs']] == [
+        ('succeeded', 2), ('failed', 2), ('pending', 0)]
+    assert bob['jobs'][1]['returncode'] == 3
+    assert read_args(bob['work_dir']) == [['--all'], ['--all']]
+
+
+@pytest.mark.parametrize('manifest', [
+    dict(accounts=[dict(name='alice')]),
+    dict(accounts=[dict(name='alice', credentials_path='a.json')] * 2),
+    dict(jobs=[dict(args=[])], accounts=[dict(name='alice', credentials_path='a.json')]),
+])
+def test_load_manifest_rejects_bad_manifests(tmp_path, manifest):
+    with pytest.raises(ValueError):
+        load_manifest(write_manifest(tmp_path, manifest))
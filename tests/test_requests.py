@@ -0,0 +1,171 @@
+import json
+
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+import migrate_google
+from fake_drive import FakeDrive
+from migrate_google import RateLimiter, RequestExecutor, RequestMetrics, service_method_iter
+
+
+class FlakyRequest(object):
+    # Fails with the given status and reason the first time it is executed
+    def __init__(self, method_id, status, reason):
+        self.methodId = method_id
+        self.status = status
+        self.reason = reason
+        self.num_calls = 0
+
+    def execute(self, **kwargs):
+        self.num_calls += 1
+        if self.num_calls == 1:
+            content = json.dumps(dict(error=dict(
+                code=self.status, errors=[dict(reason=self.reason)]))).encode('utf-8')
+            raise HttpError(httplib2.Response({'status': self.status}), content)
+        return dict(id='copy')
+
+
+def new_executor():
+    return RequestExecutor(sleep=lambda delay: None)
+
+
+def test_execute_retries_idempotent_request():
+    request = FlakyRequest('drive.files.get', 500, 'internalError')
+    assert new_executor().execute(request) == dict(id='copy')
+    assert request.num_calls == 2
+
+
+def test_execute_does_not_retry_copy_on_server_error():
+    request = FlakyRequest('drive.files.copy', 500, 'internalError')
+    with pytest.raises(HttpError):
+        new_executor().execute(request)
+    assert request.num_calls == 1
+
+
+def test_execute_retries_copy_on_quota_error():
+    request = FlakyRequest('drive.files.copy', 403, 'userRateLimitExceeded')
+    assert new_executor().execute(request) == dict(id='copy')
+    assert request.num_calls == 2
+
+
+def test_execute_retries_copy_when_caller_opts_in():
+    request = FlakyRequest('drive.files.copy', 503, 'backendError')
+    assert new_executor().execute(request, idempotent=True) == dict(id='copy')
+    assert request.num_calls == 2
+
+
+class FlakyBatch(FlakyRequest):
+    # Has no methodId, and keeps its requests as BatchHttpRequest does
+    def __init__(self, method_ids, status, reason):
+        super(FlakyBatch, self).__init__(None, status, reason)
+        self._requests = dict(
+            (str(i), FlakyRequest(method_id, status, reason))
+            for (i, method_id) in enumerate(method_ids))
+
+
+def test_execute_retries_batch_unless_any_request_is_not_idempotent():
+    batch = FlakyBatch(['drive.permissions.update', 'drive.files.get'], 502, None)
+    new_executor().execute(batch)
+    assert batch.num_calls == 2
+
+    batch = FlakyBatch(['drive.permissions.update', 'drive.permissions.create'], 502, None)
+    with pytest.raises(HttpError):
+        new_executor().execute(batch)
+    assert batch.num_calls == 1
+
+    batch = FlakyBatch(['drive.permissions.create'], 429, None)
+    new_executor().execute(batch)
+    assert batch.num_calls == 2
+
+
+def test_execute_retries_connection_errors():
+    class DroppedRequest(FlakyRequest):
+        def execute(self, **kwargs):
+            self.num_calls += 1
+            if self.num_calls == 1:
+                raise httplib2.ServerNotFoundError('Unable to find the server')
+            return dict(id='file')
+
+    request = DroppedRequest('drive.files.get', None, None)
+    assert new_executor().execute(request) == dict(id='file')
+    assert request.num_calls == 2
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_rate_limiter_adapts_to_quota_errors():
+    clock = FakeClock()
+    rate_limiter = RateLimiter(rate=10.0, burst=5, min_rate=1.0, max_rate=10.5, clock=clock,
+                               sleep=clock.sleep)
+    # A burst goes out at once, then requests are spaced by 1 / rate
+    for _ in range(5):
+        rate_limiter.acquire()
+    assert clock.now == 0
+    rate_limiter.acquire(cost=2)
+    assert clock.now == pytest.approx(0.2)
+
+    # Additive increase up to max_rate, multiplicative decrease down to
+    # min_rate, with no burst after a quota error
+    for _ in range(20):
+        rate_limiter.on_success()
+    assert rate_limiter.rate == 10.5
+    clock.now += 10
+    rate_limiter.acquire()
+    rate_limiter.on_quota_error()
+    assert rate_limiter.rate == 5.25
+    assert rate_limiter.reserve() == pytest.approx(1 / 5.25)
+    for _ in range(5):
+        rate_limiter.on_quota_error()
+    assert rate_limiter.rate == 1.0
+
+
+def test_request_metrics_count_requests_items_and_errors(tmp_path):
+    clock = FakeClock()
+    metrics = RequestMetrics(path=str(tmp_path / 'metrics.json'), clock=clock)
+    rate_limiter = RateLimiter(rate=10.0, sleep=clock.sleep)
+    executor = RequestExecutor(rate_limiter=rate_limiter, sleep=clock.sleep, metrics=metrics)
+    assert executor.execute(FlakyRequest('drive.files.get', 403, 'rateLimitExceeded'))
+    # Halved by the quota error, then increased by the success
+    assert rate_limiter.rate == pytest.approx(5.05)
+    with pytest.raises(HttpError):
+        executor.execute(FlakyRequest('drive.files.copy', 500, 'internalError'))
+    for seconds in (0.005, 0.03, 3.0):
+        metrics.record_request('drive.files.list', seconds, num_bytes=100)
+    clock.now = 10.0
+    metrics.record_items('drive.files.list', 50)
+
+    metrics.close()
+    with open(str(tmp_path / 'metrics.json')) as f:
+        summary = json.load(f)
+    assert (summary['quota_errors'], summary['rate']) == (1, None)
+    assert summary['errors'] == {'rateLimitExceeded': 1, 'internalError': 1}
+    get_stats = summary['endpoints']['drive.files.get']
+    assert (get_stats['requests'], get_stats['retries'], get_stats['failures']) == (1, 1, 0)
+    copy_stats = summary['endpoints']['drive.files.copy']
+    assert (copy_stats['requests'], copy_stats['retries'], copy_stats['failures']) == (0, 0, 1)
+    list_stats = summary['endpoints']['drive.files.list']
+    assert (list_stats['requests'], list_stats['bytes'], list_stats['items']) == (3, 300, 50)
+    assert (list_stats['p50_seconds'], list_stats['p90_seconds']) == (0.05, 5.0)
+    assert list_stats['items_per_second'] == 5.0
+
+
+def test_request_metrics_count_listed_items(monkeypatch):
+    metrics = RequestMetrics()
+    monkeypatch.setattr(migrate_google.EXECUTOR, 'metrics', metrics)
+    drive = FakeDrive.generate(num_files=250)
+    files = drive.build().files()
+    listed = list(service_method_iter(
+        files.list(pageSize=100, fields='nextPageToken, files(id)'), 'files', files.list_next))
+    assert len(listed) == 250
+    stats = metrics.summarize()['endpoints']['drive.files.list']
+    assert (stats['requests'], stats['items']) == (3, 250)
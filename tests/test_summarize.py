@@ -0,0 +1,62 @@
+import logging
+
+from fake_drive import FakeDrive
+from migrate_google import (
+    FOLDER_MIME_TYPE, SUMMARY_CHECKS, DriveFiles, get_summary_analyzers, summarize_drive_files,
+)
+
+
+def new_drive():
+    drive = FakeDrive()
+    folder = drive.add_file(dict(name='folder', parents=[drive.root_id], mimeType=FOLDER_MIME_TYPE))
+    (keep, copy) = [
+        drive.add_file(dict(name='a.txt', parents=[folder['id']]), content=b'same content')
+        for _ in range(2)]
+    drive.add_file(dict(name='b.txt', parents=[drive.root_id]), content=b'same content')
+    drive.add_file(dict(name='big.bin', parents=[drive.root_id]), content=b'x' * 1000)
+    drive.add_file(dict(name='shared.txt', parents=[drive.root_id, folder['id']]),
+                   content=b'shared')
+    drive.add_file(dict(name='old.txt', parents=[drive.root_id], trashed=True), content=b'old')
+    drive.add_file(dict(name='orphan.txt', parents=[]), content=b'orphan')
+    drive_files = DriveFiles()
+    drive_files.load(drive.iter_metadata())
+    return (drive, drive_files, [keep['id'], copy['id']])
+
+
+def test_summarize_runs_every_check_in_one_pass(caplog, monkeypatch):
+    (drive, drive_files, duplicate_ids) = new_drive()
+    analyzers = get_summary_analyzers(
+        SUMMARY_CHECKS, drive_files, root_id=drive.root_id, email=drive.email, num_top_files=2)
+    assert [a.description for a in analyzers][:2] == [
+        'files whose metadata could not be downloaded', 'trashed files']
+    num_passes = []
+    list_files = drive_files.list
+    monkeypatch.setattr(
+        drive_files, 'list', lambda: num_passes.append(1) or list_files())
+
+    caplog.set_level(logging.INFO, logger='migrate_google')
+    summarize_drive_files(drive_files, analyzers)
+    assert len(num_passes) == 1
+    messages = [record.getMessage() for record in caplog.records]
+    assert any(m.startswith('Trashed: ') and 'old.txt' in m for m in messages)
+    assert any(m.startswith('Top-level but not root: ') and 'orphan.txt' in m for m in messages)
+    assert any(m.startswith('2 parents: ') and 'shared.txt' in m for m in messages)
+    assert 'Listing 2 largest files by size' in messages
+    # The whole drive, then the largest file
+    largest = messages[messages.index('Listing 2 largest files by size') + 1:][:2]
+    assert drive.root_id in largest[0] and 'big.bin' in largest[1]
+
+    [duplicate_content] = [m for m in messages if 'copies of content' in m]
+    assert duplicate_content.startswith('3 copies')
+    [duplicate_metadata] = [a for a in analyzers if a.description.endswith('metadata')]
+    assert duplicate_metadata.duplicates == [duplicate_ids]
+
+
+def test_summarize_runs_only_the_checks_given():
+    (drive, drive_files, _) = new_drive()
+    analyzers = get_summary_analyzers(('largest', 'errors'), drive_files, num_top_files=3)
+    assert [a.description for a in analyzers] == [
+        'files whose metadata could not be downloaded', 'largest files by size']
+    summarize_drive_files(drive_files, analyzers)
+    assert [df.size for (_, _, df) in sorted(analyzers[1].heap, reverse=True,
+                                              key=lambda item: item[:2])] == [1051, 1000, 30]
@@ -0,0 +1,104 @@
+import hashlib
+import os
+
+import httplib2
+
+from fake_drive import FakeDrive
+from migrate_google import (
+    FOLDER_MIME_TYPE, GOOGLE_APPS_MIME_TYPE, ContentVerifier, LocalHashCache, LocalTreeHasher,
+    diff_tree_checksums, get_drive_tree_checksums,
+)
+
+
+def add_files(drive):
+    files = [
+        drive.add_file(dict(name='file{}.bin'.format(i), parents=[drive.root_id]),
+                       content=bytes(range(256)) * i)
+        for i in range(8)]
+    files.append(drive.add_file(dict(name='notes', parents=[drive.root_id],
+                                     mimeType=GOOGLE_APPS_MIME_TYPE + '.document')))
+    return files
+
+
+def test_verifier_downloads_in_chunks_and_retries():
+    drive = FakeDrive(quota_error_rate=0.2)
+    files = add_files(drive)
+    # And a connection dropped once
+    files_get_media = drive.files_get_media
+    dropped = []
+
+    def drop_once(file_id, *args):
+        if file_id == files[5]['id'] and not dropped:
+            dropped.append(file_id)
+            raise httplib2.ServerNotFoundError('Unable to find the server')
+        return files_get_media(file_id, *args)
+
+    drive.files_get_media = drop_once
+    verifier = ContentVerifier(drive.build, num_workers=3, chunk_size=100, max_pending_files=2)
+    results = list(verifier.verify(files))
+    assert dropped
+    assert [f['id'] for (f, _) in results] == [f['id'] for f in files]
+    for (f, result) in results[:-1]:
+        content = drive.contents[f['id']]
+        assert (result['md5Checksum'], result['num_bytes'], result['error']) == (
+            hashlib.md5(content).hexdigest(), len(content), None)
+    # Google Docs have no content to download
+    assert results[-1][1]['error'] == 403
+    assert sum(stats['num_bytes'] for stats in verifier.worker_stats.values()) == sum(
+        len(content) for content in drive.contents.values())
+    assert sum(stats['num_files'] for stats in verifier.worker_stats.values()) == len(files)
+
+
+def test_verifier_reports_changed_content():
+    drive = FakeDrive()
+    files = add_files(drive)[:3]
+    drive.contents[files[2]['id']] = b'changed'
+    results = list(ContentVerifier(drive.build, chunk_size=100).verify(files))
+    assert [result['md5Checksum'] == f['md5Checksum'] for (f, result) in results] == [
+        True, True, False]
+
+
+def test_local_tree_diffs_against_drive(tmp_path):
+    root = tmp_path / 'tree'
+    (root / 'sub').mkdir(parents=True)
+    local_files = {
+        'same.txt': b'same', 'empty.txt': b'', 'sub/same.txt': b'same in sub',
+        'sub/changed.txt': b'local', 'missing.txt': b'only here',
+    }
+    for (rel_path, content) in local_files.items():
+        (root / rel_path).write_bytes(content)
+    os.symlink(str(root / 'same.txt'), str(root / 'link.txt'))
+
+    drive = FakeDrive()
+    sub = drive.add_file(dict(name='sub', parents=[drive.root_id], mimeType=FOLDER_MIME_TYPE))
+    for (name, parent_id, content) in [
+            ('same.txt', drive.root_id, b'same'), ('empty.txt', drive.root_id, b''),
+            ('same.txt', sub['id'], b'same in sub'), ('changed.txt', sub['id'], b'drive side'),
+            ('extra.txt', drive.root_id, b'only there')]:
+        drive.add_file(dict(name=name, parents=[parent_id]), content=content)
+    drive.add_file(dict(name='notes', parents=[drive.root_id],
+                        mimeType=GOOGLE_APPS_MIME_TYPE + '.document'))
+
+    cache_path = str(tmp_path / 'hashes.json')
+    hasher = LocalTreeHasher(num_workers=2, cache=LocalHashCache(cache_path),
+                             max_pending_files=2)
+    local_checksums = dict(
+        (rel_path, md5_checksum) for (rel_path, _, md5_checksum) in hasher.hash(str(root)))
+    hasher.cache.save()
+    assert local_checksums == dict(
+        (rel_path, hashlib.md5(content).hexdigest())
+        for (rel_path, content) in local_files.items())
+    (drive_checksums, num_skipped) = get_drive_tree_checksums('/', drive.build().files())
+    assert num_skipped == 1
+    assert list(diff_tree_checksums(local_checksums, drive_checksums)) == [
+        ('extra', 'extra.txt'), ('missing', 'missing.txt'), ('mismatch', 'sub/changed.txt')]
+
+    # Only files changed since (here in size too, as mtimes may be coarse) are
+    # hashed again
+    (root / 'sub' / 'changed.txt').write_bytes(b'drive side')
+    hasher = LocalTreeHasher(num_workers=2, cache=LocalHashCache(cache_path))
+    local_checksums = dict(
+        (rel_path, md5_checksum) for (rel_path, _, md5_checksum) in hasher.hash(str(root)))
+    assert (hasher.num_cached, hasher.num_hashed) == (4, 1)
+    assert list(diff_tree_checksums(local_checksums, drive_checksums)) == [
+        ('extra', 'extra.txt'), ('missing', 'missing.txt')]
@@ -0,0 +1,57 @@
+import pytest
+
+from fake_drive import FakeDrive
+from migrate_google import (
+    FOLDER_MIME_TYPE, PathCache, get_drive_tree_checksums, get_file_by_path, list_children,
+)
+
+
+def add_folder(drive, name, parent_id, **kwargs):
+    return drive.add_file(dict(name=name, mimeType=FOLDER_MIME_TYPE, parents=[parent_id],
+                               **kwargs))
+
+
+def test_trashed_files_are_left_out():
+    drive = FakeDrive()
+    docs = add_folder(drive, 'docs', drive.root_id)
+    add_folder(drive, 'old', docs['id'], trashed=True)
+    kept = drive.add_file(dict(name='a.txt', parents=[docs['id']]), content=b'kept')
+    drive.add_file(dict(name='a.txt', parents=[docs['id']], trashed=True), content=b'trashed')
+    drive.add_file(dict(name='b.txt', parents=[docs['id']], trashed=True), content=b'trashed')
+    files = drive.build().files()
+
+    assert get_file_by_path('docs/a.txt', files)['id'] == kept['id']
+    with pytest.raises(Exception):
+        get_file_by_path('docs/b.txt', files)
+    children = list_children(files, [drive.root_id, docs['id']], ('id', 'name'))
+    assert children == {drive.root_id: [dict(id=docs['id'], name='docs')],
+                        docs['id']: [dict(id=kept['id'], name='a.txt')]}
+    (checksums, num_skipped) = get_drive_tree_checksums('docs', files)
+    assert checksums == {'a.txt': [kept['md5Checksum']]} and num_skipped == 0
+
+
+def test_cached_path_checks_the_file_at_its_end():
+    drive = FakeDrive()
+    docs = add_folder(drive, 'docs', drive.root_id)
+    report = drive.add_file(dict(name='report.pdf', parents=[docs['id']]))
+    files = drive.build().files()
+    path_cache = PathCache()
+    assert get_file_by_path('docs/report.pdf', files, path_cache=path_cache)['id'] == report['id']
+
+    # Replaced, then moved away: the cached id must not come back either time
+    files.delete(fileId=report['id']).execute()
+    new_report = drive.add_file(dict(name='report.pdf', parents=[docs['id']]))
+    assert get_file_by_path(
+        'docs/report.pdf', files, path_cache=path_cache)['id'] == new_report['id']
+    files.update(fileId=new_report['id'], addParents=drive.root_id,
+                 removeParents=docs['id']).execute()
+    with pytest.raises(Exception):
+        get_file_by_path('docs/report.pdf', files, path_cache=path_cache)
+
+    # Folders along the way still come from the cache
+    num_requests = drive.num_requests
+    get_file_by_path('docs', files, path_cache=path_cache)
+    get_file_by_path('report.pdf', files, path_cache=path_cache)
+    drive.add_file(dict(name='notes.txt', parents=[docs['id']]))
+    get_file_by_path('docs/notes.txt', files, path_cache=path_cache)
+    assert drive.num_requests == num_requests + 3